@@ -9,8 +9,9 @@ from sklearn import metrics
 import torch.nn.functional as F
 
 from flcore.clients.clientbase import Client
-from flcore.losses.btLoss import AULoss, MixupLoss, mixup_data
-from flcore.optimizers.fedoptimizer import SAM, ASAM
+from flcore.losses.btLoss import AULoss, MixupLoss, ViewInfoNCE, mixup_data
+from flcore.optimizers.fedoptimizer import SAM, ASAM, LookSAM
+from flcore.trainmodel.precision import PrecisionPolicy
 
 
 class ClientFedRANE(Client):
@@ -31,11 +32,17 @@ class ClientFedRANE(Client):
         self.use_sam = args.use_sam
         self.rho = args.sam_rho
         self.eta = args.sam_eta
+        self.sam_k = args.sam_k  # sharpness-aware gradient every sam_k steps, LookSAM in between
+        self.sam_alpha = args.sam_alpha
         self.temperature = args.info_nce_temperature
+        self.info_nce = ViewInfoNCE(self.temperature)  # between a batch and its graph augmentation
+        self.precision = PrecisionPolicy(args.precision, args.device)  # base forward only
 
         self.L_ce = nn.CrossEntropyLoss()
         self.aggregate_all = args.aggregate_all
         self.nce_reg = args.nce_reg
+        self.model_version = 0  # bumped whenever the base may change, keys the feature cache
+        self._feature_cache = {}  # split -> (model_version, z, y)
 
         # fix the classifier
         for param in self.model.predictor.parameters():
@@ -69,45 +76,59 @@ class ClientFedRANE(Client):
             if self.train_slow:
                 time.sleep(0.1 * np.abs(np.random.rand()))
             # feature extractor maps input x to a vector on the unit hypersphere
-            z = self.model.base(torch.cat((x, mixed_x), dim=0))
+            z = self.precision(self.model.base, torch.cat((x, mixed_x), dim=0))
             return F.normalize(z), y_, y_a, y_b, lambd
         else:
+            # evaluation and the cached features stay in float32, only training runs under the precision policy
             with torch.no_grad():
                 z = self.model.base(x)
             z = F.normalize(z)
             return y_, z
 
-    def info_nce_loss(self, Z1, Z2, n_views=2):
-        N_BS = Z1.shape[0]
-        features = torch.cat((Z1, Z2))
-        labels = torch.cat([torch.arange(N_BS) for i in range(n_views)], dim=0)
-        labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-        labels = labels.to(self.device)
-
-        features = F.normalize(features, dim=1)
-
-        similarity_matrix = torch.matmul(features, features.T)
-        # assert similarity_matrix.shape == (
-        #     self.args.n_views * self.args.batch_size, self.args.n_views * self.args.batch_size)
-        # assert similarity_matrix.shape == labels.shape
-
-        # discard the main diagonal from both: labels and similarities matrix
-        mask = torch.eye(labels.shape[0], dtype=torch.bool).to(self.device)
-        labels = labels[~mask].view(labels.shape[0], -1)
-        similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
-        # assert similarity_matrix.shape == labels.shape
-
-        # select and combine multiple positives
-        positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
-
-        # select only the negatives
-        negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
-
-        logits = torch.cat([positives, negatives], dim=1)
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).to(self.device)
+    def cached_features(self, split):
+        """
+        Normalized base features z and labels y of the 'train' or 'test' split as feature_extract(is_train=False),
+        from one base pass per model version, kept on the cpu. Predictor fine-tuning and the metrics run on them.
 
-        logits = logits / self.temperature
-        return logits, labels
+        The base BN normalizes with batch statistics in eval too, so the features are frozen to the batches of this
+        unshuffled pass: fine-tuning reshuffles the cached features every epoch, not the images fed to the base.
+        A trailing single sample, which the BN cannot normalize alone, is extracted with the batch before it.
+        """
+        if split in self._feature_cache and self._feature_cache[split][0] == self.model_version:
+            return self._feature_cache[split][1:]
+        loader = self.load_train_data() if split == 'train' else self.load_test_data()
+        training = self.model.base.training
+        self.model.base.eval()
+        zs, ys = [], []
+
+        def extract(x, y):
+            y_, z = self.feature_extract(x, y, is_train=False)
+            zs.append(z.cpu())
+            ys.append(y)
+
+        pending = None
+        for x, y in loader:
+            if pending is not None and len(y) < 2:
+                x, y = torch.cat((pending[0], x)), torch.cat((pending[1], y))
+            elif pending is not None:
+                extract(*pending)
+            pending = (x, y)
+        if pending is not None and len(pending[1]) > 1:  # a split of one sample has no batch statistics
+            extract(*pending)
+        self.model.base.train(training)
+        z, y = (torch.cat(zs), torch.cat(ys)) if zs else (torch.empty(0), torch.empty(0, dtype=torch.long))
+        self._feature_cache[split] = (self.model_version, z, y)
+        return self._feature_cache[split][1:]
+
+    def feature_batches(self, split, shuffle=False):
+        """Batches (z, y) of the cached features, reshuffled on every call with shuffle as the train loader."""
+        z, y = self.cached_features(split)
+        if len(y) == 0:
+            return iter(())
+        if shuffle:
+            order = torch.randperm(len(y))
+            z, y = z[order], y[order]
+        return zip(z.split(self.batch_size), y.split(self.batch_size))
 
     def train_mixup(self, mixup_x, y_a, y_b, lambd):
         out_mix = self.model.predictor(mixup_x)
@@ -124,6 +145,7 @@ class ClientFedRANE(Client):
             max_local_steps = np.random.randint(1, max_local_steps // 2)
 
         for step in range(max_local_steps):
+            epoch_loss = 0.
             for i, (x, y) in enumerate(trainloader):
                 y=y.to(self.device)
                 self.optimizer.zero_grad()
@@ -134,19 +156,17 @@ class ClientFedRANE(Client):
                 loss = 0
 
                 if self.alpha != 1:   # 1 for not use graph
-                    A = self.model.graph_generator.get_graph(out)
+                    # raw and mixup graphs from one batched factorization
+                    A, A_mix = self.model.graph_generator.get_graphs(out, z_mix)
                     Z1_aug = self.model.gnn(out, A)
                     Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
+                    loss = self.nce_reg * self.info_nce(out, Z1_aug)
                     out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
 
                     # mixup
-                    A_mix = self.model.graph_generator.get_graph(z_mix)
                     Z1_aug_mix = self.model.gnn(z_mix, A_mix)
                     Z1_aug_mix = F.normalize(Z1_aug_mix, dim=-1)
-                    logits_mix, label_mix = self.info_nce_loss(z_mix, Z1_aug_mix, 2)
-                    loss+= self.nce_reg * self.L_ce(logits_mix, label_mix)
+                    loss+= self.nce_reg * self.info_nce(z_mix, Z1_aug_mix)
                     z_mix = self.alpha * z_mix + (1 - self.alpha) * Z1_aug_mix  # careful
 
                 out  = self.model.predictor(out)
@@ -158,7 +178,9 @@ class ClientFedRANE(Client):
                 # loss += self.train_mixup(z_mix, y_a, y_b, lambd)
                 # print('no mixup')
                 loss.backward()
+                epoch_loss += loss.detach()
                 self.optimizer.step()
+        self.train_loss = epoch_loss / len(trainloader)  # mean loss of the last local epoch
         self.scheduler.step()
 
         self.model.cpu()
@@ -173,6 +195,7 @@ class ClientFedRANE(Client):
             max_local_steps = np.random.randint(1, max_local_steps // 2)
 
         for step in range(max_local_steps):
+            epoch_loss = 0.
             for i, (x, y) in enumerate(trainloader):
                 # p = self.model.predictor.weight.data[y.to(self.device)]
                 z, y, y_a, y_b, lambd = self.feature_extract(x, y)
@@ -183,8 +206,7 @@ class ClientFedRANE(Client):
                     A = self.model.graph_generator.get_graph(out)
                     Z1_aug = self.model.gnn(out, A)
                     Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
+                    loss = self.nce_reg * self.info_nce(out, Z1_aug)
                     out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
 
                 out = self.model.predictor(out)
@@ -193,7 +215,9 @@ class ClientFedRANE(Client):
                 # loss = (1 - self.loss(z, p)).pow(2).sum()
                 loss += self.train_mixup(z_mix, y_a, y_b, lambd)
                 loss.backward()
+                epoch_loss += loss.detach()
                 self.optimizer.step()
+        self.train_loss = epoch_loss / len(trainloader)  # mean loss of the last local epoch
         self.scheduler.step()
 
         self.model.cpu()
@@ -207,47 +231,34 @@ class ClientFedRANE(Client):
         if self.train_slow:
             max_local_steps = np.random.randint(1, max_local_steps // 2)
 
+        # minimizer = SAM(self.optimizer, self.model, self.rho, self.eta)
+        minimizer = LookSAM(ASAM(self.optimizer, self.model, self.rho, self.eta), self.sam_k, self.sam_alpha)
         for step in range(max_local_steps):
-
-            # minimizer = SAM(self.optimizer, self.model, self.rho, self.eta)
-            minimizer = ASAM(self.optimizer, self.model, self.rho, self.eta)
+            epoch_loss = 0.
             for i, (x, y) in enumerate(trainloader):
                 # p = self.model.predictor.weight.data[y.to(self.device)]
-                z, y_, y_a, y_b, lambd = self.feature_extract(x, y)
-                out = z[:x.shape[0]]
-                z_mix = z[x.shape[0]:]
-                loss = 0
-                if self.alpha != 1:   # if use graph
-                    A = self.model.graph_generator.get_graph(out)
-                    Z1_aug = self.model.gnn(out, A)
-                    Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
-                    out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
-
-                out = self.model.predictor(out)
-                loss += self.loss(out, y_)  # ||wz - one_hot(y)||^2]
-                loss += self.train_mixup(z_mix, y_a, y_b, lambd)
-                loss.backward()
-                minimizer.ascent_step()
 
-                z, y_, y_a, y_b, lambd = self.feature_extract(x, y)
-                out = z[:x.shape[0]]
-                z_mix = z[x.shape[0]:]
-                loss = 0
-                if self.alpha != 1:   # if use graph
-                    A = self.model.graph_generator.get_graph(out)
-                    Z1_aug = self.model.gnn(out, A)
-                    Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
-                    out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
-                out = self.model.predictor(out)
-                loss += self.loss(out, y_)  # ||wz - one_hot(y)||^2]
-                # loss+=0.1 * self.info_nce_loss(out, Z1_aug,2)
-                loss += self.train_mixup(z_mix, y_a, y_b, lambd)
-                loss.backward()
-                minimizer.descent_step()
+                def closure():
+                    z, y_, y_a, y_b, lambd = self.feature_extract(x, y)
+                    out = z[:x.shape[0]]
+                    z_mix = z[x.shape[0]:]
+                    loss = 0
+                    if self.alpha != 1:   # if use graph
+                        A = self.model.graph_generator.get_graph(out)
+                        Z1_aug = self.model.gnn(out, A)
+                        Z1_aug = F.normalize(Z1_aug, dim=-1)
+                        loss = self.nce_reg * self.info_nce(out, Z1_aug)
+                        out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
+                    out = self.model.predictor(out)
+                    loss += self.loss(out, y_)  # ||wz - one_hot(y)||^2]
+                    # loss+=0.1 * self.info_nce_loss(out, Z1_aug,2)
+                    loss += self.train_mixup(z_mix, y_a, y_b, lambd)
+                    loss.backward()
+                    return loss
+
+                # the loss at the weights before the step, the perturbed one of sharp steps is not recorded
+                epoch_loss += minimizer.step(closure).detach()
+        self.train_loss = epoch_loss / len(trainloader)  # mean loss of the last local epoch
         self.scheduler.step()
 
         self.model.cpu()
@@ -257,17 +268,17 @@ class ClientFedRANE(Client):
             self.train_raw()
         else:
             self.train_sam()
+        self.model_version += 1
 
     def ffc_compute(self):
         """ Compute V and U for the Fast Federated Calibration algorithm."""
 
-        trainloader = self.load_train_data()
-
         self.model.to(self.device)
         self.model.eval()
         v, u = 0, 0
-        for i, (x, y) in enumerate(trainloader):
-            y, z = self.feature_extract(x, y, is_train=False)
+        for z, y in self.feature_batches('train'):
+            z = z.to(self.device)
+            y = F.one_hot(y.to(self.device).to(torch.int64), self.num_classes).float()
             # dimension of y is [batch_size, num_classes], z is [batch_size, feature_dimension]
             v += (z.unsqueeze(2) @ z.unsqueeze(1)).sum(dim=0)  # \sum z_i^T z_i
             u += (z.unsqueeze(2) @ y.unsqueeze(1)).sum(dim=0)  # \sum z_i^T one_hot(y)
@@ -275,7 +286,8 @@ class ClientFedRANE(Client):
         return v, u
 
     def fine_tune(self, epochs: int):
-        train_loader = self.load_train_data()
+        # the base is frozen: one base pass (cached for the model version, see cached_features), then the predictor
+        # on the reshuffled features every epoch
         self.model.to(self.device)
         # freeze base
         self.model.base.eval()
@@ -292,8 +304,9 @@ class ClientFedRANE(Client):
             momentum=0.9
         )
         for _ in range(epochs):
-            for x, y in train_loader:
-                y, z = self.feature_extract(x, y, is_train=False)
+            for z, y in self.feature_batches('train', shuffle=True):
+                z = z.to(self.device)
+                y = F.one_hot(y.to(self.device).to(torch.int64), self.num_classes).float()
                 output = self.model.predictor(z)
                 loss = self.loss(output, y)
                 optimizer.zero_grad()
@@ -302,68 +315,38 @@ class ClientFedRANE(Client):
         self.model.cpu()
 
     def train_metrics(self):
-        trainloader = self.load_train_data()
         self.model.to(self.device)
         self.model.eval()
-        train_num = 0
-        loss = 0
-        for x, y in trainloader:
-            # p = self.model.predictor.weight.data[y.to(self.device)]
-            y, z = self.feature_extract(x, y, is_train=False)
+
+        def step(z, y):
             output = self.model.predictor(z)
-            train_num += y.shape[0]
             # loss += (1 - self.loss(z, p)).pow(2).sum()
-            loss += self.loss(output, y).item() * y.shape[0]
+            return output, self.loss(output, F.one_hot(y.to(torch.int64), self.num_classes).float())
+
+        stats = self.inference_metrics(self.feature_batches('train'), step)
         self.model.cpu()
-        return loss, train_num
+        return stats['loss'], stats['num']
 
     def test_metrics(self):
-        testloaderfull = self.load_test_data()
         self.model.to(self.device)
         self.model.eval()
-        test_acc = 0
-        test_num = 0
-        p_m_y_sum = 0
-        test_acc_pm = 0
-        y_prob = []
-        y_true = []
-        with torch.no_grad():
-            for x, y in testloaderfull:
-                if len(y) == 1:
-                    continue
-                x = x.to(self.device)
-                y = y.to(self.device)
-                z = F.normalize(self.model.base(x))
-                output = self.model.predictor(z)
-                result = torch.argmax(output, dim=1) == y
-                test_acc += torch.sum(result).item()
-                test_num += y.shape[0]
-                y_prob.append(output.detach().cpu().numpy())
-                y_true.append(label_binarize(y.detach().cpu().numpy(), classes=np.arange(self.num_classes)))
+
+        def step(z, y):
+            return self.model.predictor(z), None
+
+        stats = self.inference_metrics(self.feature_batches('test'), step, keep_scores=True)
         self.model.cpu()
-        y_prob = np.concatenate(y_prob, axis=0)
-        y_true = np.concatenate(y_true, axis=0)
-        auc = metrics.roc_auc_score(y_true, y_prob, average='micro')
-        if self.test_pm:
-            test_acc_pm /= p_m_y_sum
-        return test_acc, test_num, auc, test_acc_pm
+        return stats['correct'], stats['num'], self.auc(stats), stats['acc_pm']
 
     def save_features(self):
-        loader = self.load_test_data()
         self.model.to(self.device)
         self.model.eval()
-        features = []
-        with torch.no_grad():
-            for x, y in loader:
-                x = x.to(self.device)
-                y = y.to(self.device)
-                z = F.normalize(self.model.base(x))
-                features.append(z.cpu().numpy())
+        features = self.cached_features('test')[0].numpy()
         self.model.cpu()
-        features = np.concatenate(features)
         np.save(f'../data/feature_output/spherefed_local_{self.id}_features.npy', features)
 
     def set_parameters(self, model):
+        self.model_version += 1
         if self.aggregate_all:
             for new_param, old_param in zip(model.parameters(), self.model.parameters()):
                 old_param.data = new_param.data.clone()
@@ -9,8 +9,9 @@ from sklearn import metrics
 import torch.nn.functional as F
 
 from flcore.clients.clientbase_cl import ClientCLAug
-from flcore.losses.btLoss import AULoss, MixupLoss, mixup_data
-from flcore.optimizers.fedoptimizer import SAM, ASAM
+from flcore.losses.btLoss import AULoss, MixupLoss, ViewInfoNCE, mixup_data
+from flcore.optimizers.fedoptimizer import SAM, ASAM, LookSAM
+from flcore.trainmodel.precision import PrecisionPolicy
 from torchvision import transforms
 import random
 from PIL import ImageFilter
@@ -56,7 +57,12 @@ class ClientSphereGAug(ClientCLAug):
         self.use_sam = args.use_sam
         self.rho = args.sam_rho
         self.eta = args.sam_eta
+        self.sam_k = args.sam_k  # sharpness-aware gradient every sam_k steps, LookSAM in between
+        self.sam_alpha = args.sam_alpha
         self.temperature = args.info_nce_temperature
+        self.info_nce = ViewInfoNCE(self.temperature)  # between a batch and its graph augmentation
+        self.graph_views = args.graph_views  # graph of the two augmented views, see GraphGenerator.get_view_graphs
+        self.precision = PrecisionPolicy(args.precision, args.device)  # base forward only
 
         self.L_ce = nn.CrossEntropyLoss()
         self.aggregate_all = args.aggregate_all
@@ -96,46 +102,15 @@ class ClientSphereGAug(ClientCLAug):
             if self.train_slow:
                 time.sleep(0.1 * np.abs(np.random.rand()))
             # feature extractor maps input x to a vector on the unit hypersphere
-            z = self.model.base(torch.cat((x, mixed_x), dim=0))
+            z = self.precision(self.model.base, torch.cat((x, mixed_x), dim=0))
             return F.normalize(z), y_, y_a, y_b, lambd
         else:
+            # evaluation and the cached features stay in float32, only training runs under the precision policy
             with torch.no_grad():
                 z = self.model.base(x)
             z = F.normalize(z)
             return y_, z
 
-    def info_nce_loss(self, Z1, Z2, n_views=2):
-        N_BS = Z1.shape[0]
-        features = torch.cat((Z1, Z2))
-        labels = torch.cat([torch.arange(N_BS) for i in range(n_views)], dim=0)
-        labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-        labels = labels.to(self.device)
-
-        features = F.normalize(features, dim=1)
-
-        similarity_matrix = torch.matmul(features, features.T)
-        # assert similarity_matrix.shape == (
-        #     self.args.n_views * self.args.batch_size, self.args.n_views * self.args.batch_size)
-        # assert similarity_matrix.shape == labels.shape
-
-        # discard the main diagonal from both: labels and similarities matrix
-        mask = torch.eye(labels.shape[0], dtype=torch.bool).to(self.device)
-        labels = labels[~mask].view(labels.shape[0], -1)
-        similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
-        # assert similarity_matrix.shape == labels.shape
-
-        # select and combine multiple positives
-        positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
-
-        # select only the negatives
-        negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
-
-        logits = torch.cat([positives, negatives], dim=1)
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).to(self.device)
-
-        logits = logits / self.temperature
-        return logits, labels
-
     def train_mixup(self, mixup_x, y_a, y_b, lambd):
         out_mix = self.model.predictor(mixup_x)
         loss = self.loss8(out_mix, y_a, y_b, lambd)
@@ -151,6 +126,7 @@ class ClientSphereGAug(ClientCLAug):
             max_local_steps = np.random.randint(1, max_local_steps // 2)
 
         for step in range(max_local_steps):
+            epoch_loss = 0.
             for i, (x,x_aug, y) in enumerate(self.trainloader):
                 y=y.to(self.device)
                 self.optimizer.zero_grad()
@@ -161,19 +137,17 @@ class ClientSphereGAug(ClientCLAug):
                 loss = 0
 
                 if self.alpha != 1:   # 1 for not use graph
-                    A = self.model.graph_generator.get_graph(out)
+                    # raw and mixup graphs from one batched factorization
+                    A, A_mix = self.model.graph_generator.get_graphs(out, z_mix)
                     Z1_aug = self.model.gnn(out, A)
                     Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
+                    loss = self.nce_reg * self.info_nce(out, Z1_aug)
                     out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
 
                     # mixup
-                    A_mix = self.model.graph_generator.get_graph(z_mix)
                     Z1_aug_mix = self.model.gnn(z_mix, A_mix)
                     Z1_aug_mix = F.normalize(Z1_aug_mix, dim=-1)
-                    logits_mix, label_mix = self.info_nce_loss(z_mix, Z1_aug_mix, 2)
-                    loss+= self.nce_reg * self.L_ce(logits_mix, label_mix)
+                    loss+= self.nce_reg * self.info_nce(z_mix, Z1_aug_mix)
                     z_mix = self.alpha * z_mix + (1 - self.alpha) * Z1_aug_mix  # careful
 
                 out  = self.model.predictor(out)
@@ -185,7 +159,9 @@ class ClientSphereGAug(ClientCLAug):
                 # loss += self.train_mixup(z_mix, y_a, y_b, lambd)
                 # print('no mixup')
                 loss.backward()
+                epoch_loss += loss.detach()
                 self.optimizer.step()
+        self.train_loss = epoch_loss / len(self.trainloader)  # mean loss of the last local epoch
         self.scheduler.step()
 
         self.model.cpu()
@@ -200,6 +176,7 @@ class ClientSphereGAug(ClientCLAug):
             max_local_steps = np.random.randint(1, max_local_steps // 2)
 
         for step in range(max_local_steps):
+            epoch_loss = 0.
             for i, (x,x_aug, y) in enumerate(self.trainloader):
                 # p = self.model.predictor.weight.data[y.to(self.device)]
                 x_cat= torch.cat((x,x_aug))
@@ -209,13 +186,15 @@ class ClientSphereGAug(ClientCLAug):
                 z_mix = z[x_cat.shape[0]:]
                 loss = 0
                 if self.alpha != 1:   # 1 for not use graph
-                    A = self.model.graph_generator.get_graph(out)
-                    Z1_aug = self.model.gnn(out, A)
+                    out1, out2 = out[:x.shape[0]], out[x.shape[0]:]
+                    # the rows of out are unit: the cosine similarity of the views is one B x B product
+                    S = torch.matmul(out1, out2.t()) if self.graph_views == 'bipartite' else None
+                    graphs = self.model.graph_generator.get_view_graphs(out1, out2, self.graph_views, S)
+                    Z1_aug = torch.cat([self.model.gnn(nodes, A) for nodes, A in graphs])
                     Z1_aug = F.normalize(Z1_aug, dim=-1)
                     # cl loss (z1,z2)
                     z1, z2= Z1_aug[:x.shape[0]], Z1_aug[x.shape[0]:]
-                    logits_cl, label_cl = self.info_nce_loss(z1, z2, 2)
-                    loss += 10*self.nce_reg * self.L_ce(logits_cl, label_cl)
+                    loss += 10*self.nce_reg * self.info_nce(z1, z2)
 
                     # cd loss (z, z_aug)
                     # logits, label = self.info_nce_loss(out, Z1_aug, 2)
@@ -228,7 +207,9 @@ class ClientSphereGAug(ClientCLAug):
                 # loss = (1 - self.loss(z, p)).pow(2).sum()
                 # loss += self.train_mixup(z_mix, y_a, y_b, lambd)
                 loss.backward()
+                epoch_loss += loss.detach()
                 self.optimizer.step()
+        self.train_loss = epoch_loss / len(self.trainloader)  # mean loss of the last local epoch
         self.scheduler.step()
 
         self.model.cpu()
@@ -242,47 +223,34 @@ class ClientSphereGAug(ClientCLAug):
         if self.train_slow:
             max_local_steps = np.random.randint(1, max_local_steps // 2)
 
+        # minimizer = SAM(self.optimizer, self.model, self.rho, self.eta)
+        minimizer = LookSAM(ASAM(self.optimizer, self.model, self.rho, self.eta), self.sam_k, self.sam_alpha)
         for step in range(max_local_steps):
-
-            # minimizer = SAM(self.optimizer, self.model, self.rho, self.eta)
-            minimizer = ASAM(self.optimizer, self.model, self.rho, self.eta)
+            epoch_loss = 0.
             for i, (x, y) in enumerate(self.trainloader):
                 # p = self.model.predictor.weight.data[y.to(self.device)]
-                z, y_, y_a, y_b, lambd = self.feature_extract(x, y)
-                out = z[:x.shape[0]]
-                z_mix = z[x.shape[0]:]
-                loss = 0
-                if self.alpha != 1:   # if use graph
-                    A = self.model.graph_generator.get_graph(out)
-                    Z1_aug = self.model.gnn(out, A)
-                    Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
-                    out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
-
-                out = self.model.predictor(out)
-                loss += self.loss(out, y_)  # ||wz - one_hot(y)||^2]
-                loss += self.train_mixup(z_mix, y_a, y_b, lambd)
-                loss.backward()
-                minimizer.ascent_step()
 
-                z, y_, y_a, y_b, lambd = self.feature_extract(x, y)
-                out = z[:x.shape[0]]
-                z_mix = z[x.shape[0]:]
-                loss = 0
-                if self.alpha != 1:   # if use graph
-                    A = self.model.graph_generator.get_graph(out)
-                    Z1_aug = self.model.gnn(out, A)
-                    Z1_aug = F.normalize(Z1_aug, dim=-1)
-                    logits, label = self.info_nce_loss(out, Z1_aug, 2)
-                    loss = self.nce_reg * self.L_ce(logits, label)
-                    out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
-                out = self.model.predictor(out)
-                loss += self.loss(out, y_)  # ||wz - one_hot(y)||^2]
-                # loss+=0.1 * self.info_nce_loss(out, Z1_aug,2)
-                loss += self.train_mixup(z_mix, y_a, y_b, lambd)
-                loss.backward()
-                minimizer.descent_step()
+                def closure():
+                    z, y_, y_a, y_b, lambd = self.feature_extract(x, y)
+                    out = z[:x.shape[0]]
+                    z_mix = z[x.shape[0]:]
+                    loss = 0
+                    if self.alpha != 1:   # if use graph
+                        A = self.model.graph_generator.get_graph(out)
+                        Z1_aug = self.model.gnn(out, A)
+                        Z1_aug = F.normalize(Z1_aug, dim=-1)
+                        loss = self.nce_reg * self.info_nce(out, Z1_aug)
+                        out = self.alpha * out + (1 - self.alpha) * Z1_aug  # careful
+                    out = self.model.predictor(out)
+                    loss += self.loss(out, y_)  # ||wz - one_hot(y)||^2]
+                    # loss+=0.1 * self.info_nce_loss(out, Z1_aug,2)
+                    loss += self.train_mixup(z_mix, y_a, y_b, lambd)
+                    loss.backward()
+                    return loss
+
+                # the loss at the weights before the step, the perturbed one of sharp steps is not recorded
+                epoch_loss += minimizer.step(closure).detach()
+        self.train_loss = epoch_loss / len(self.trainloader)  # mean loss of the last local epoch
         self.scheduler.step()
 
         self.model.cpu()
@@ -340,48 +308,27 @@ class ClientSphereGAug(ClientCLAug):
         # trainloader = self.load_train_data()
         self.model.to(self.device)
         self.model.eval()
-        train_num = 0
-        loss = 0
-        for x,_, y in self.trainloader:
-            # p = self.model.predictor.weight.data[y.to(self.device)]
-            y, z = self.feature_extract(x, y, is_train=False)
-            output = self.model.predictor(z)
-            train_num += y.shape[0]
+
+        def step(x, y):
+            output = self.model.predictor(F.normalize(self.model.base(x)))
             # loss += (1 - self.loss(z, p)).pow(2).sum()
-            loss += self.loss(output, y).item() * y.shape[0]
+            return output, self.loss(output, F.one_hot(y.to(torch.int64), self.num_classes).float())
+
+        stats = self.inference_metrics(((x, y) for x, _, y in self.trainloader), step)
         self.model.cpu()
-        return loss, train_num
+        return stats['loss'], stats['num']
 
     def test_metrics(self):
         # testloaderfull = self.load_test_data()
         self.model.to(self.device)
         self.model.eval()
-        test_acc = 0
-        test_num = 0
-        p_m_y_sum = 0
-        test_acc_pm = 0
-        y_prob = []
-        y_true = []
-        with torch.no_grad():
-            for x, y in self.testloader:
-                if len(y) == 1:
-                    continue
-                x = x.to(self.device)
-                y = y.to(self.device)
-                z = F.normalize(self.model.base(x))
-                output = self.model.predictor(z)
-                result = torch.argmax(output, dim=1) == y
-                test_acc += torch.sum(result).item()
-                test_num += y.shape[0]
-                y_prob.append(output.detach().cpu().numpy())
-                y_true.append(label_binarize(y.detach().cpu().numpy(), classes=np.arange(self.num_classes)))
+
+        def step(x, y):
+            return self.model.predictor(F.normalize(self.model.base(x))), None
+
+        stats = self.inference_metrics(self.testloader, step, keep_scores=True, min_batch=2)
         self.model.cpu()
-        y_prob = np.concatenate(y_prob, axis=0)
-        y_true = np.concatenate(y_true, axis=0)
-        auc = metrics.roc_auc_score(y_true, y_prob, average='micro')
-        if self.test_pm:
-            test_acc_pm /= p_m_y_sum
-        return test_acc, test_num, auc, test_acc_pm
+        return stats['correct'], stats['num'], self.auc(stats), stats['acc_pm']
 
     def save_features(self):
         loader = self.load_test_data()
@@ -77,52 +77,70 @@ class Client(object):
         for param, new_param in zip(model.parameters(), new_params):
             param.data = new_param.data.clone()
 
+    def inference_metrics(self, loader, step, keep_scores=False, min_batch=1):
+        """
+        One pass over loader under torch.inference_mode, shared by the train_metrics / test_metrics of the clients.
+        step(x, y, *rest) returns the class scores of a batch and its mean loss, or None. Correct predictions, losses
+        and the test_pm weighted accuracy are summed in device tensors and read back with a single sync.
+
+        Returns a dict with correct, loss (summed over samples), num, acc_pm and, with keep_scores, the scores and
+        labels as numpy arrays. Batches smaller than min_batch are skipped.
+        """
+        correct = torch.zeros((), device=self.device)
+        loss = torch.zeros((), device=self.device)
+        correct_pm = torch.zeros((), device=self.device)
+        weight_pm = torch.zeros((), device=self.device)
+        class_weights = self.sample_per_class_total.to(self.device) if self.test_pm else None
+        num = 0
+        scores_list, labels = [], []
+        with torch.inference_mode():
+            for x, y, *rest in loader:
+                if len(y) < min_batch:
+                    continue
+                if type(x) == type([]):
+                    x[0] = x[0].to(self.device)
+                else:
+                    x = x.to(self.device)
+                y = y.to(self.device)
+                rest = [r.to(self.device) if torch.is_tensor(r) else r for r in rest]
+                scores, batch_loss = step(x, y, *rest)
+                result = torch.argmax(scores, dim=1) == y
+                correct += result.sum()
+                if batch_loss is not None:
+                    loss += batch_loss * y.shape[0]
+                if class_weights is not None:
+                    p_m_y = class_weights[y]
+                    correct_pm += (result * p_m_y).sum()
+                    weight_pm += p_m_y.sum()
+                if keep_scores:
+                    scores_list.append(scores.to(torch.float32, copy=True))
+                    labels.append(y)
+                num += y.shape[0]
+
+        correct, loss, correct_pm, weight_pm = torch.stack([correct, loss, correct_pm, weight_pm]).tolist()
+        stats = {'correct': correct, 'loss': loss, 'num': num,
+                 'acc_pm': correct_pm / weight_pm if class_weights is not None else 0}
+        if keep_scores:
+            stats['scores'] = torch.cat(scores_list).cpu().numpy()
+            stats['labels'] = torch.cat(labels).cpu().numpy()
+        return stats
+
+    def auc(self, stats):
+        y_true = label_binarize(stats['labels'], classes=np.arange(self.num_classes))
+        return metrics.roc_auc_score(y_true, stats['scores'], average='micro')
+
     def test_metrics(self):
         testloaderfull = self.load_test_data()
         # self.model = self.load_model('model')
         self.model.to(self.device)
         self.model.eval()
 
-        test_acc = 0
-        test_num = 0
-        p_m_y_sum = 0
-        test_acc_pm = 0
-        y_prob = []
-        y_true = []
-
-        with torch.no_grad():
-            for x, y in testloaderfull:
-                if type(x) == type([]):
-                    x[0] = x[0].to(self.device)
-                else:
-                    x = x.to(self.device)
-                y = y.to(self.device)
-                output = self.model(x)
-                result = torch.argmax(output, dim=1) == y
-                test_acc += (torch.sum(result)).item()
-                if self.test_pm:
-                    p_m_y = y.float()
-                    for i in range(len(y)):
-                        p_m_y[i] = self.sample_per_class_total[int(y[i])]
-                    test_acc_pm += torch.sum(result * p_m_y)
-                    p_m_y_sum += torch.sum(p_m_y)
-                test_num += y.shape[0]
-
-                y_prob.append(output.detach().cpu().numpy())
-                y_true.append(label_binarize(y.detach().cpu().numpy(), classes=np.arange(self.num_classes)))
+        stats = self.inference_metrics(testloaderfull, lambda x, y: (self.model(x), None), keep_scores=True)
 
         self.model.cpu()
         # self.save_model(self.model, 'model')
 
-        y_prob = np.concatenate(y_prob, axis=0)
-        y_true = np.concatenate(y_true, axis=0)
-
-        auc = metrics.roc_auc_score(y_true, y_prob, average='micro')
-
-        if self.test_pm:
-            test_acc_pm /= p_m_y_sum
-
-        return test_acc, test_num, auc, test_acc_pm
+        return stats['correct'], stats['num'], self.auc(stats), stats['acc_pm']
 
     def train_metrics(self):
         trainloader = self.load_train_data()
@@ -130,23 +148,16 @@ class Client(object):
         self.model.to(self.device)
         self.model.eval()
 
-        train_num = 0
-        loss = 0
-        with torch.no_grad():
-            for x, y in trainloader:
-                if type(x) == type([]):
-                    x[0] = x[0].to(self.device)
-                else:
-                    x = x.to(self.device)
-                y = y.to(self.device)
-                output = self.model(x)
-                train_num += y.shape[0]
-                loss += self.loss(output, y).item() * y.shape[0]
+        def step(x, y):
+            output = self.model(x)
+            return output, self.loss(output, y)
+
+        stats = self.inference_metrics(trainloader, step)
 
         self.model.cpu()
         # self.save_model(self.model, 'model')
 
-        return loss, train_num
+        return stats['loss'], stats['num']
 
     # def get_next_train_batch(self):
     #     try:
@@ -14,10 +14,13 @@ from flcore.clients.clientbase import Client
 from flcore.clients.clientbase_cl import ClientCL, ClientCLY
 from utils.privacy import *
 from flcore.losses.btLoss import AULoss, MixupLoss, mixup_data
-from flcore.losses.costripletLoss import CosTripletLoss, InfoNCE, ArcCoshLoss, ACoshTripletLoss
+from flcore.losses.costripletLoss import CosTripletLoss, InfoNCE, ArcCoshLoss, ACoshTripletLoss, PoincareTripletLoss, PrototypeTable
 import torch.nn.functional as F
 from sklearn.preprocessing import label_binarize
 from geoopt import PoincareBall
+from flcore.trainmodel.hyperbolic_head import HyperbolicPrototypeHead
+from flcore.trainmodel.dual_view import dual_view_forward
+from flcore.trainmodel.precision import PrecisionPolicy
 import geoopt
 
 
@@ -31,9 +34,12 @@ class clientHyperbolicCLY(ClientCLY):
     def __init__(self, args, id, train_samples, test_samples, **kwargs):
         super(clientHyperbolicCLY, self).__init__(args, id, train_samples, test_samples, **kwargs)
         self.ball = PoincareBall(args.curvature)
+        self.head = HyperbolicPrototypeHead(self.model.predictor, args.curvature,
+                                            mode=args.prediction_mode)  # inference path
+        self.dual_view_bn = args.dual_view_bn  # batch norm of the clean and the mixup view in one forward
+        self.precision = PrecisionPolicy(args.precision, args.device)  # base forward only
         self.global_params = copy.deepcopy(list(self.model.parameters()))
 
-        self.loss6 = ACoshTripletLoss(manifold=self.ball, margin=args.margin_triplet)
         self.loss8 = MixupLoss(alpha=0.5)
         self.optimizer = geoopt.optim.RiemannianSGD(self.model.parameters(), lr=self.learning_rate, momentum=0.9,
                                                     weight_decay=1e-5)
@@ -43,6 +49,9 @@ class clientHyperbolicCLY(ClientCLY):
         self.dims = args.HyperbolicFed_dim
         self.one_hot = torch.eye(self.num_classes)
         self.polars = args.predictor.weight.data  # args.classpolars
+        self.prototypes = PrototypeTable(self.polars, args.curvature)  # polars are fixed
+        self.loss6 = PoincareTripletLoss(manifold=self.ball, margin=args.margin_triplet,
+                                         prototypes=self.prototypes)
         self.c = args.curvature
         self.fine_tuning_steps = args.fine_tuning_steps
 
@@ -91,19 +100,17 @@ class clientHyperbolicCLY(ClientCLY):
                 #     time.sleep(0.1 * np.abs(np.random.rand()))
                 self.optimizer.zero_grad()
 
-                y_exp_map = self.polars[y]  # note refer to prototype
-                output_pos = self.model.base(x_pos)  # note E representation
+                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
+                output_pos, output_mixed = self.precision(dual_view_forward, self.model.base, x_pos, mixed_x,
+                                                          self.dual_view_bn)
                 output_pos_exp_map = self.ball.expmap0(output_pos)  # project on the hyperbolic
 
 
                 # # loss 6
-                y_neg_exp_map = self.polars[y_neg]
-                loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
+                loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
 
 
                 # # loss8
-                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-                output_mixed = self.model.base(mixed_x)  # note E representation
                 output_mixed_exp_map = self.ball.expmap0(output_mixed)  # project on the hyperbolic
                 normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
                 preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
@@ -140,51 +147,22 @@ class clientHyperbolicCLY(ClientCLY):
 
     def train_metrics(self):
         trainloader = self.load_train_data()
-        # self.model = self.load_model('model')
-        # self.model.to(self.device)
         self.model.eval()
 
-        train_num = 0
-        loss = 0
-        train_acc = 0.
-        for i, (x_pos, y, y_neg) in enumerate(trainloader):
-            if type(x_pos) == type([]):
-                x_pos[0] = x_pos[0].to(self.device)
-            else:
-                x_pos = x_pos.to(self.device)
-            train_num += y.shape[0]
-            y = y.to(self.device)
-
-            y_exp_map = self.polars[y]  # note refer to prototype
+        def step(x_pos, y, y_neg):
             output_pos = self.model.base(x_pos)  # note E representation
-            # output_pos_exp_map = pmath.expmap0(output_pos, c=self.c)  # project on the hyperbolic
             output_pos_exp_map = self.ball.expmap0(output_pos)  # project on the hyperbolic
-
-            y_neg_exp_map = self.polars[y_neg]
-            loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
-
+            loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
 
             # loss 8
             mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-            output_mixed = self.model.base(mixed_x)  # note E representation
-            output_mixed_exp_map = self.ball.expmap0(output_mixed)  # project on the hyperbolic
-            normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
-            preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
+            output_mixed_exp_map = self.ball.expmap0(self.model.base(mixed_x))  # project on the hyperbolic
+            preds_mix = self.model.predictor(F.normalize(output_mixed_exp_map, p=2, dim=1)).float()
             loss8 = self.loss8(preds_mix, y_a, y_b, lambd)
+            return self.head(output_pos), loss6 + 2 * loss8
 
-            loss += (loss6.item() + 2 * loss8.item()) * y.shape[0]
-
-            # eval acc for train set
-            normed_output_pos_exp_map = F.normalize(output_pos_exp_map, p=2, dim=1)
-            output = self.model.predictor(normed_output_pos_exp_map).float()
-            pred = output.max(1, keepdim=True)[1]
-            train_acc += pred.eq(y.view_as(pred)).sum().item()
-
-        # self.model.cpu()
-        # self.save_model(self.model, 'model')
-        # print("Eval acc in train set:", train_acc / train_num)
-
-        return loss, train_num
+        stats = self.inference_metrics(trainloader, step)
+        return stats['loss'], stats['num']
 
     def test_metrics(self):
         # # self.model.to(self.device)
@@ -217,70 +195,14 @@ class clientHyperbolicCLY(ClientCLY):
         testloaderfull = self.load_test_data()
         # self.model.to(self.device)
         self.model.eval()
-        test_acc = 0.
-        test_acc_pm = 0
-        test_loss = 0
-        test_num = 0
-        y_prob = []
-        y_true = []
-        p_m_y_sum = 0
-        output_vectors = []
-        gt_labels = []
-
-        with torch.no_grad():
-            for x, y in testloaderfull:
-                test_num += y.shape[0]
-                if type(x) == type([]):
-                    x[0] = x[0].to(self.device)
-                else:
-                    x = x.to(self.device)
-                y = y.to(self.device)
-                if self.train_slow:
-                    time.sleep(0.1 * np.abs(np.random.rand()))
-                self.optimizer.zero_grad()
-
-                y_exp_map = self.polars[y]  # note refer to prototype
-                output = self.model.base(x)  # note E representation
-                # output_exp_map = pmath.expmap0(output, c=self.c)  # project on the hyperbolic
-                output_exp_map = self.ball.expmap0(output)  # project on the hyperbolic
-                output_exp_map_norm = F.normalize(output_exp_map, dim=-1, p=2)
-                output = self.model.predictor(output_exp_map_norm).float()
-                pred = output.max(1, keepdim=True)[1]
-
-                # output_exp_map = output_exp_map.repeat(1, self.num_classes).reshape(y.shape[0], self.num_classes,
-                #                                                                     self.polars.shape[1])
-                # y_exp_map = self.polars.repeat(y.shape[0], 1).reshape(y.shape[0], self.num_classes,
-                #                                                            self.polars.shape[1])
-                # dist = self.ball.dist(output_exp_map, y_exp_map, dim=-1)
-                # pred = dist.min(1, keepdim=True)[1]
-                # for visualization
-                if self.visualize:
-                    output_vectors.extend(output_exp_map.cpu().numpy().tolist())
-                    gt_labels.extend(y.cpu().numpy().tolist())
-
-                test_acc += pred.eq(y.view_as(pred)).sum().item()
-                if self.test_pm:
-                    result = torch.argmax(output, dim=1) == y
-                    p_m_y = y.float()
-                    for i in range(len(y)):
-                        p_m_y[i] = self.sample_per_class_total[int(y[i])]
-                    test_acc_pm += torch.sum(result * p_m_y)
-                    p_m_y_sum += torch.sum(p_m_y)
-
-                # test_loss += self.loss(output_exp_map, y_exp_map)
-                y_prob.append(output.cpu().numpy())
-                y_true.append(label_binarize(y.cpu().numpy(), classes=np.arange(self.num_classes)))
-
-        # self.model.cpu()
-        # y_prob = np.concatenate(y_prob, axis=0)
-        # y_true = np.concatenate(y_true, axis=0)
-
-        # auc = metrics.roc_auc_score(y_true, y_prob, average='micro')
 
-        if self.test_pm:
-            test_acc_pm /= p_m_y_sum
+        def step(x, y):
+            if self.train_slow:
+                time.sleep(0.1 * np.abs(np.random.rand()))
+            return self.head(self.model.base(x), reuse_output=True), None
 
-        return test_acc, test_num, 0, test_acc_pm
+        stats = self.inference_metrics(testloaderfull, step)
+        return stats['correct'], stats['num'], 0, stats['acc_pm']
 
     # def set_parameters(self, model):
     #     for new_param, global_param, param in zip(model.parameters(), self.global_params, self.model.parameters()):
@@ -299,17 +221,15 @@ class clientHyperbolicCLY(ClientCLY):
                 y = y.to(self.device)
                 self.optimizer.zero_grad()
 
-                y_exp_map = self.polars[y]  # note refer to prototype
-                output_pos = self.model.base(x_pos)  # note E representation
+                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
+                output_pos, output_mixed = self.precision(dual_view_forward, self.model.base, x_pos, mixed_x,
+                                                          self.dual_view_bn)
                 output_pos_exp_map = self.ball.expmap0(output_pos)  # project on the hyperbolic
 
                 # loss5 = self.loss5(output_pos_exp_map, y_exp_map).mean()
 
-                y_neg_exp_map = self.polars[y_neg]
-                loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
+                loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
 
-                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-                output_mixed = self.model.base(mixed_x)  # note E representation
                 output_mixed_exp_map = self.ball.expmap0(output_mixed)  # project on the hyperbolic
                 normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
                 preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
@@ -4,11 +4,14 @@ import numpy as np
 import time
 
 from flcore.clients.clientbase_cl import ClientCLY
-from flcore.losses.costripletLoss import ArcCoshLoss, ACoshTripletLoss
+from flcore.losses.costripletLoss import ArcCoshLoss, ACoshTripletLoss, PoincareTripletLoss, PrototypeTable
 from flcore.losses.btLoss import MixupLoss, mixup_data
 import torch.nn.functional as F
 from sklearn.preprocessing import label_binarize
 from geoopt import PoincareBall
+from flcore.trainmodel.hyperbolic_head import HyperbolicPrototypeHead
+from flcore.trainmodel.dual_view import dual_view_forward
+from flcore.trainmodel.precision import PrecisionPolicy
 import geoopt
 from torch.autograd import Variable
 
@@ -23,7 +26,10 @@ class ClientMGDA(ClientCLY):
     def __init__(self, args, id, train_samples, test_samples, **kwargs):
         super(ClientMGDA, self).__init__(args, id, train_samples, test_samples, **kwargs)
         self.ball = PoincareBall(args.curvature)
-        self.loss6 = ACoshTripletLoss(manifold=self.ball, margin=args.margin_triplet)
+        self.head = HyperbolicPrototypeHead(self.model.predictor, args.curvature,
+                                            mode=args.prediction_mode)  # inference path
+        self.dual_view_bn = args.dual_view_bn  # batch norm of the clean and the mixup view in one forward
+        self.precision = PrecisionPolicy(args.precision, args.device)  # base forward only
         self.loss8 = MixupLoss(alpha=0.5)
 
         self.optimizer = geoopt.optim.RiemannianSGD(self.model.parameters(), lr=self.learning_rate, momentum=0.9,
@@ -32,6 +38,9 @@ class ClientMGDA(ClientCLY):
                                                          gamma=0.1)
         self.fine_tuning_steps = args.fine_tuning_steps
         self.polars = args.predictor.weight.data
+        self.prototypes = PrototypeTable(self.polars, args.curvature)  # polars are fixed
+        self.loss6 = PoincareTripletLoss(manifold=self.ball, margin=args.margin_triplet,
+                                         prototypes=self.prototypes)
 
     def train(self):
         trainloader = self.load_train_data()
@@ -47,22 +56,21 @@ class ClientMGDA(ClientCLY):
 
         # avgloss, avglosscount, newloss, acc, newacc = 0., 0, 0., 0., 0.
         for step in range(max_local_steps):
+            epoch_loss = 0.
             for i, (x_pos, y, y_neg) in enumerate(trainloader):
                 x_pos = x_pos.to(self.device)
                 y = y.to(self.device)
                 self.optimizer.zero_grad()
 
-                y_exp_map = self.polars[y]
-                output_pos = self.model.base(x_pos)
+                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
+                output_pos, output_mixed = self.precision(dual_view_forward, self.model.base, x_pos, mixed_x,
+                                                          self.dual_view_bn)
                 output_pos_exp_map = self.ball.expmap0(output_pos)
 
                 # loss 6
-                y_neg_exp_map = self.polars[y_neg]
-                loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
+                loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
 
                 # loss8
-                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-                output_mixed = self.model.base(mixed_x)
                 output_mixed_exp_map = self.ball.expmap0(output_mixed)
                 normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
                 preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
@@ -72,7 +80,9 @@ class ClientMGDA(ClientCLY):
                 loss = loss6 + 2 * loss8  # careful
 
                 loss.backward()
+                epoch_loss += loss.detach()
                 self.optimizer.step()
+            self.train_loss = epoch_loss / len(trainloader)  # mean loss of the last local epoch
             self.scheduler.step()
 
         self.train_time_cost['num_rounds'] += 1
@@ -86,16 +96,14 @@ class ClientMGDA(ClientCLY):
             x_pos = x_pos.to(self.device)
             y = y.to(self.device)
             self.optimizer.zero_grad()
-            y_exp_map = self.polars[y]
-            output_pos = self.model.base(x_pos)
+            mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
+            output_pos, output_mixed = self.precision(dual_view_forward, self.model.base, x_pos, mixed_x,
+                                                      self.dual_view_bn)
             output_pos_exp_map = self.ball.expmap0(output_pos)
 
             # loss 6
-            y_neg_exp_map = self.polars[y_neg]
-            loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
+            loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
             # loss8
-            mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-            output_mixed = self.model.base(mixed_x)
             output_mixed_exp_map = self.ball.expmap0(output_mixed)
             normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
             preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
@@ -118,64 +126,34 @@ class ClientMGDA(ClientCLY):
     def train_metrics(self):
         trainloader = self.load_train_data()
         self.model.eval()
-        train_num = 0
-        loss = 0
-        with torch.no_grad():
-            for i, (x_pos, y, y_neg) in enumerate(trainloader):
-                x_pos = x_pos.to(self.device)
-                train_num += y.shape[0]
-                y = y.to(self.device)
-
-                y_exp_map = self.polars[y]  # note refer to prototype
-                output_pos = self.model.base(x_pos)  # note E representation
-                output_pos_exp_map = self.ball.expmap0(output_pos)  # project on the hyperbolic
-
-
-                # loss 6
-                y_neg_exp_map = self.polars[y_neg]
-                loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
 
-                # loss 8
-                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-                output_mixed = self.model.base(mixed_x)  # note E representation
-                output_mixed_exp_map = self.ball.expmap0(output_mixed)  # project on the hyperbolic
-                normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
-                preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
-                loss8 = self.loss8(preds_mix, y_a, y_b, lambd)
+        def step(x_pos, y, y_neg):
+            output_pos = self.model.base(x_pos)  # note E representation
+            output_pos_exp_map = self.ball.expmap0(output_pos)  # project on the hyperbolic
+            loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
 
-                loss += (loss6.item() + 2 * loss8.item()) * y.shape[0]
+            # loss 8
+            mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
+            output_mixed_exp_map = self.ball.expmap0(self.model.base(mixed_x))  # project on the hyperbolic
+            preds_mix = self.model.predictor(F.normalize(output_mixed_exp_map, p=2, dim=1)).float()
+            loss8 = self.loss8(preds_mix, y_a, y_b, lambd)
+            return self.head(output_pos), loss6 + 2 * loss8
 
-        return loss, train_num
+        stats = self.inference_metrics(trainloader, step)
+        return stats['loss'], stats['num']
 
     def test_metrics(self):
         testloaderfull = self.load_test_data()
         # self.model.to(self.device)
         self.model.eval()
-        test_acc = 0.
-        test_num = 0
-        y_prob = []
-        y_true = []
-
-        with torch.no_grad():
-            for x, y in testloaderfull:
-                test_num += y.shape[0]
-                x = x.to(self.device)
-                y = y.to(self.device)
-                if self.train_slow:
-                    time.sleep(0.1 * np.abs(np.random.rand()))
-                self.optimizer.zero_grad()
 
-                output = self.model.base(x)
-                output_exp_map = self.ball.expmap0(output)
-                output_exp_map_norm = F.normalize(output_exp_map, dim=-1, p=2)
-                output = self.model.predictor(output_exp_map_norm).float()
-                pred = output.max(1, keepdim=True)[1]
-                test_acc += pred.eq(y.view_as(pred)).sum().item()
+        def step(x, y):
+            if self.train_slow:
+                time.sleep(0.1 * np.abs(np.random.rand()))
+            return self.head(self.model.base(x), reuse_output=True), None
 
-                y_prob.append(output.cpu().numpy())
-                y_true.append(label_binarize(y.cpu().numpy(), classes=np.arange(self.num_classes)))
-
-        return test_acc, test_num, 0, 0
+        stats = self.inference_metrics(testloaderfull, step)
+        return stats['correct'], stats['num'], 0, 0
 
 
     def fine_tune(self, which_module=['base', 'predictor']):
@@ -190,15 +168,13 @@ class ClientMGDA(ClientCLY):
                 y = y.to(self.device)
                 self.optimizer.zero_grad()
 
-                y_exp_map = self.polars[y]  # note refer to prototype
-                output_pos = self.model.base(x_pos)  # note E representation
+                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
+                output_pos, output_mixed = self.precision(dual_view_forward, self.model.base, x_pos, mixed_x,
+                                                          self.dual_view_bn)
                 output_pos_exp_map = self.ball.expmap0(output_pos)  # project on the hyperbolic
 
-                y_neg_exp_map = self.polars[y_neg]
-                loss6 = self.loss6(output_pos_exp_map, y_exp_map, y_neg_exp_map).mean()
+                loss6 = self.loss6(output_pos_exp_map, y, y_neg).mean()
 
-                mixed_x, y_a, y_b, lambd = mixup_data(x_pos, y, self.loss8.alpha)
-                output_mixed = self.model.base(mixed_x)  # note E representation
                 output_mixed_exp_map = self.ball.expmap0(output_mixed)  # project on the hyperbolic
                 normed_output_mixed_exp_map = F.normalize(output_mixed_exp_map, p=2, dim=1)
                 preds_mix = self.model.predictor(normed_output_mixed_exp_map).float()
@@ -107,27 +107,22 @@ class clientProto(Client):
             model = self.model
         model.eval()
 
-        test_acc = 0
-        test_num = 0
-        
-        with torch.no_grad():
-            for x, y in testloader:
-                if type(x) == type([]):
-                    x[0] = x[0].to(self.device)
-                else:
-                    x = x.to(self.device)
-                y = y.to(self.device)
-                rep = self.model.base(x)
+        if self.global_protos is not None:
+            classes = torch.tensor(list(self.global_protos.keys()), device=self.device)
+            protos = torch.stack(list(self.global_protos.values())).to(self.device)
+
+        def step(x, y):
+            rep = self.model.base(x)
 
-                output = float('inf') * torch.ones(y.shape[0], self.num_classes).to(self.device)
-                for i, r in enumerate(rep):
-                    for j, pro in self.global_protos.items():
-                        output[i, j] = self.loss_mse(r, pro)
+            # the MSE of every representation to every global prototype, classes without one stay at inf
+            output = float('inf') * torch.ones(y.shape[0], self.num_classes).to(self.device)
+            if self.global_protos is not None:
+                output[:, classes] = (rep.unsqueeze(1) - protos.unsqueeze(0)).pow(2).mean(dim=-1)
+            return -output, None
 
-                test_acc += (torch.sum(torch.argmin(output, dim=1) == y)).item()
-                test_num += y.shape[0]
+        stats = self.inference_metrics(testloader, step)
 
-        return test_acc, test_num, 0
+        return stats['correct'], stats['num'], 0
 
 
 # https://github.com/yuetan031/fedproto/blob/main/lib/utils.py#L205
@@ -1,3 +1,5 @@
+import time
+
 from torch import nn
 import torch
 import torch.nn.functional as F
@@ -77,6 +79,38 @@ class AULoss(nn.Module):
         return loss_align.mean() + ((uniform_z1 + uniform_z2) / 2)
 
 
+class ViewInfoNCE(nn.Module):
+    def __init__(self, temperature=0.8):
+        '''
+        InfoNCE between two views z1, z2 [B, d] of a batch: cross entropy of each of the 2B samples against its
+        other view, over its similarities to the 2B - 1 others. Computed on the 2B x 2B similarity with the main
+        diagonal set to -inf in place, with the index of the positives cached per (B, device), instead of gathering
+        positives and negatives into new logits.
+
+        Args:
+            temperature: of the cosine similarities
+        '''
+        super(ViewInfoNCE, self).__init__()
+        self.temperature = temperature
+        self._positives = {}
+
+    def positives(self, batch_size, device):
+        key = (batch_size, device)
+        if key not in self._positives:
+            index = torch.arange(batch_size, device=device)
+            self._positives[key] = torch.cat((index + batch_size, index))
+        return self._positives[key]
+
+    def similarity(self, z1, z2):
+        features = F.normalize(torch.cat((z1, z2)), dim=1)
+        return torch.matmul(features, features.T) / self.temperature
+
+    def forward(self, z1, z2):
+        logits = self.similarity(z1, z2)
+        logits.fill_diagonal_(-float('inf'))
+        return F.cross_entropy(logits, self.positives(z1.shape[0], z1.device))
+
+
 def mixup_data(x, y, alpha=1.):
     if alpha > 0:
         lambd = np.random.beta(alpha, alpha)
@@ -100,3 +134,40 @@ class MixupLoss(nn.Module):
         # mixed_x, y_a, y_b, lambd = mixup_data(x,y, self.alpha)
         return lambd * self.loss(mixed_preds, y1) + (1 - lambd) * self.loss(mixed_preds, y2)
 
+
+
+def benchmark_view_info_nce(batch_sizes=(64, 256, 1024), dim=512, temperature=0.8, steps=20, seed=0):
+    """Forward + backward time of ViewInfoNCE against the former gathered logits, with the loss difference."""
+    def former(z1, z2):
+        n = z1.shape[0]
+        labels = torch.cat([torch.arange(n) for _ in range(2)], dim=0)
+        labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
+        features = F.normalize(torch.cat((z1, z2)), dim=1)
+        similarity_matrix = torch.matmul(features, features.T)
+        mask = torch.eye(labels.shape[0], dtype=torch.bool)
+        labels = labels[~mask].view(labels.shape[0], -1)
+        similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
+        positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
+        negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
+        logits = torch.cat([positives, negatives], dim=1) / temperature
+        return F.cross_entropy(logits, torch.zeros(logits.shape[0], dtype=torch.long))
+
+    torch.manual_seed(seed)
+    criterion = ViewInfoNCE(temperature)
+    for batch_size in batch_sizes:
+        z1 = torch.randn(batch_size, dim, requires_grad=True)
+        z2 = torch.randn(batch_size, dim, requires_grad=True)
+        losses = {}
+        for name, fn in [('former', former), ('cached', criterion)]:
+            losses[name] = fn(z1, z2).item()
+            start = time.time()
+            for _ in range(steps):
+                fn(z1, z2).backward()
+            cost = (time.time() - start) / steps
+            print(f"B={batch_size:5d}, {name:>6}: {cost * 1e3:7.2f} ms/step, "
+                  f"loss - former {losses[name] - losses['former']:.1e}")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    benchmark_view_info_nce()
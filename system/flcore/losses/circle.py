@@ -4,6 +4,8 @@ import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
 
+from flcore.losses.costripletLoss import InfoNCE
+
 '''
 https://github.com/TinyZeaMays/CircleLoss/blob/master/circle_loss.py
 https://github.com/qianjinhao/circle-loss/blob/master/circle_loss.py
@@ -45,27 +47,6 @@ class CircleLoss(nn.Module):
         return loss
 
 
-class InfoNCE(nn.Module):
-    def __init__(self, manifold, tau=0.1):
-        super(InfoNCE, self).__init__()
-        self.tau = tau
-        self.manifold = manifold
-        self.CE = nn.CrossEntropyLoss()
-
-    def forward(self, x, y, y_neg):
-        batch_n_neg_classes, _ = y_neg.shape
-        batch = y.shape[0]
-        loss_pos = self.manifold.dist(x, y).reshape(-1, 1)
-        x_neg = x.repeat(1, batch_n_neg_classes // batch).reshape(y_neg.shape)
-        loss_neg = self.manifold.dist(x_neg, y_neg)
-        loss_neg = loss_neg.reshape(batch, -1)
-        logits = torch.cat((loss_pos, loss_neg), dim=1)
-        logits /= (-1) * self.tau
-        target = torch.zeros(batch, device=x.device).long()
-        loss = self.CE(logits, target)  # todo careful
-        return loss
-
-
 class CircleLoss4(nn.Module):
     def __init__(self, m, gamma, manifold):
         super(CircleLoss4, self).__init__()
@@ -75,12 +56,10 @@ class CircleLoss4(nn.Module):
         self.soft_plus = nn.Softplus()
 
     def forward(self, x, y, y_neg):
-        batch_n_neg_classes, _ = y_neg.shape
         batch = y.shape[0]
         dist_pos = self.dist(x, y).reshape(-1, 1)
-        x_neg = x.repeat(1, batch_n_neg_classes // batch).reshape(y_neg.shape)
-        loss_neg = self.dist(x_neg, y_neg)
-        dist_neg = loss_neg.reshape(batch, -1)
+        # anchors broadcast against their B x M negatives, without repeating them
+        dist_neg = self.dist(x.unsqueeze(1), y_neg.reshape(batch, -1, x.shape[-1]))
         sp = torch.exp(-dist_pos / 2)
         sn = torch.exp(-dist_neg / 2)
 
@@ -1,5 +1,8 @@
+import time
+
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class CosTripletLoss(nn.Module):
@@ -31,24 +34,49 @@ class ArcCoshLoss(nn.Module):
 
 
 class InfoNCE(nn.Module):
-    def __init__(self, manifold, tau=0.1):
+    """
+    Hyperbolic InfoNCE with the distance to the positive as the target logit, -d / tau.
+    The negatives are B x M x D points (or the former flat (B * M) x D layout), or B x M class labels with a
+    PrototypeTable. Anchors are broadcast against their negatives instead of repeated, and with chunk_size the
+    logsumexp runs over chunks of negatives, each recomputed in the backward, so memory does not grow with M.
+    """
+
+    def __init__(self, manifold, tau=0.1, prototypes=None, chunk_size=None):
         super(InfoNCE, self).__init__()
         self.tau = tau
         self.manifold = manifold
-        self.CE = nn.CrossEntropyLoss()
+        self.prototypes = prototypes  # PrototypeTable, to pass class labels as y and y_neg
+        self.chunk_size = chunk_size
+
+    def _neg_logsumexp(self, x, y_neg, labels):
+        if labels:
+            dist_neg = self.prototypes.dist(x, y_neg)
+        else:
+            dist_neg = self.manifold.dist(x.unsqueeze(1), y_neg)
+        return torch.logsumexp(dist_neg / (-1 * self.tau), dim=1)
 
     def forward(self, x, y, y_neg):
-        batch_n_neg_classes, _ = y_neg.shape
-        batch = y.shape[0]
-        loss_pos = self.manifold.dist(x, y).reshape(-1, 1)
-        x_neg = x.repeat(1, batch_n_neg_classes // batch).reshape(y_neg.shape)
-        loss_neg = self.manifold.dist(x_neg, y_neg)
-        loss_neg = loss_neg.reshape(batch, -1)
-        logits = torch.cat((loss_pos, loss_neg), dim=1)
-        logits /= (-1) * self.tau
-        target = torch.zeros(batch, device=x.device).long()
-        loss = self.CE(logits, target)  # todo careful
-        return loss
+        batch = x.shape[0]
+        labels = self.prototypes is not None and not y.is_floating_point()
+        if labels:
+            logit_pos = self.prototypes.dist(x, y) / (-1 * self.tau)
+            y_neg = y_neg.reshape(batch, -1)
+        else:
+            logit_pos = self.manifold.dist(x, y) / (-1 * self.tau)
+            y_neg = y_neg.reshape(batch, -1, x.shape[-1])
+
+        num_neg = y_neg.shape[1]
+        chunk_size = self.chunk_size or num_neg
+        lse = logit_pos
+        for beg in range(0, num_neg, chunk_size):
+            chunk = y_neg[:, beg:beg + chunk_size]
+            if chunk_size < num_neg and torch.is_grad_enabled():
+                chunk_lse = checkpoint(self._neg_logsumexp, x, chunk, labels, use_reentrant=False)
+            else:
+                chunk_lse = self._neg_logsumexp(x, chunk, labels)
+            lse = torch.logaddexp(lse, chunk_lse)
+        # cross entropy with the positive at index 0
+        return (lse - logit_pos).mean()
 
 
 class ACoshTripletLoss(nn.Module):  # todo
@@ -63,3 +91,218 @@ class ACoshTripletLoss(nn.Module):  # todo
         # loss = torch.maximum(an_distance - ap_distance + self.margin, torch.tensor(0.))
         loss = torch.maximum(ap_distance - an_distance + self.margin, torch.tensor(0.))
         return loss
+
+
+def arcosh1p(w):
+    """arcosh(1 + w) for w >= 0 without cancellation, with a finite gradient at w = 0."""
+    return torch.log1p(w + torch.sqrt((w * (w + 2)).clamp_min(1e-15)))
+
+
+def poincare_pairwise_dist(x, prototypes, curvature=1., proto_sq_norms=None, chunk_size=1024, eps=1e-7, out=None):
+    """
+    B x C Poincare distances between the rows of x and of prototypes, from the squared norms and one B x C inner
+    product matmul per chunk of chunk_size classes, so no B x C x D tensor is built.
+    """
+    c = float(curvature)
+    x_sq_norms = x.pow(2).sum(-1, keepdim=True)
+    a = (1 - c * x_sq_norms).clamp_min(eps)
+    if proto_sq_norms is None:
+        proto_sq_norms = prototypes.pow(2).sum(-1)
+    b = (1 - c * proto_sq_norms).clamp_min(eps)
+    num_classes = prototypes.shape[0]
+    if out is None:
+        out = x.new_empty(x.shape[0], num_classes)
+    for beg in range(0, num_classes, chunk_size):
+        end = min(beg + chunk_size, num_classes)
+        # |x - p|^2 = |x|^2 - 2 <x, p> + |p|^2
+        u = torch.addmm(x_sq_norms + proto_sq_norms[beg:end], x, prototypes[beg:end].t(), alpha=-2).clamp_min_(0)
+        w = u.mul_(2 * c).div_(a).div_(b[beg:end])
+        out[:, beg:end] = arcosh1p(w) / c ** 0.5
+    return out
+
+
+class PrototypeTable:
+    """
+    Fixed class prototypes on the Poincare ball of curvature -c, with the per-class terms of
+    d(x, p) = arcosh(1 + 2c |x - p|^2 / ((1 - c|x|^2) (1 - c|p|^2))) / sqrt(c) computed once: the squared norms, the
+    conformal factors 1 - c|p|^2 and lambda_p = 2 / (1 - c|p|^2). Losses gather rows by label instead of
+    recomputing them on the indexed prototypes.
+    """
+
+    def __init__(self, polars, curvature=1., eps=1e-7):
+        self.c = float(curvature)
+        self.eps = eps
+        self.polars = polars.detach()
+        self.sq_norms = self.polars.pow(2).sum(-1)
+        self.conformal = (1 - self.c * self.sq_norms).clamp_min(eps)
+        self.lambdas = 2 / self.conformal
+
+    def gather(self, labels):
+        """Prototypes and conformal factors of `labels`, of shape labels.shape + (D,) and labels.shape."""
+        labels = labels.to(self.polars.device)
+        return self.polars[labels], self.conformal[labels]
+
+    def dist(self, x, labels):
+        """d(x_i, p_labels[i, ...]) for a B x D batch x and B or B x M labels."""
+        p, b = self.gather(labels)
+        x = x.reshape(x.shape[:1] + (1,) * (labels.dim() - 1) + x.shape[1:])
+        a = (1 - self.c * x.pow(2).sum(-1)).clamp_min(self.eps)
+        w = 2 * self.c * (x - p).pow(2).sum(-1) / (a * b)
+        return arcosh1p(w) / self.c ** 0.5
+
+    def pairwise_dist(self, x, chunk_size=1024, out=None):
+        """B x C distances of the batch x to every prototype."""
+        return poincare_pairwise_dist(x, self.polars, self.c, self.sq_norms, chunk_size, self.eps, out)
+
+
+class _PoincareTripletFunction(torch.autograd.Function):
+    """
+    relu(d(a, p) - d(a, n) + margin) on the Poincare ball of curvature -c, with
+    d(x, y) = arcosh(1 + w) / sqrt(c), w = 2c |x - y|^2 / ((1 - c|x|^2) (1 - c|y|^2)).
+    The conformal factor of the anchor is shared by both distances, the ones of the points, b = 1 - c|y|^2 clamped
+    to eps, are given (see PrototypeTable), arcosh(1 + w) = log1p(w + sqrt(w (w + 2))) is evaluated without
+    cancellation, and the backward is in closed form, so only per-sample scalars are saved.
+    """
+
+    @staticmethod
+    def forward(ctx, anchor, x_pos, x_neg, b_pos, b_neg, c, margin, eps):
+        a = (1 - c * anchor.pow(2).sum(-1)).clamp_min(eps)
+        sides = []
+        for y, b in ((x_pos, b_pos), (x_neg, b_neg)):
+            u = (anchor - y).pow(2).sum(-1)
+            w = 2 * c * u / (a * b)
+            sides.extend([u, b, w])
+        u_p, b_p, w_p, u_n, b_n, w_n = sides
+        d_p = torch.log1p(w_p + torch.sqrt(w_p * (w_p + 2)))
+        d_n = torch.log1p(w_n + torch.sqrt(w_n * (w_n + 2)))
+        loss = ((d_p - d_n) / c ** 0.5 + margin).clamp_min(0)
+        ctx.save_for_backward(anchor, x_pos, x_neg, a, u_p, b_p, w_p, u_n, b_n, w_n, loss)
+        ctx.c, ctx.eps = c, eps
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        anchor, x_pos, x_neg, a, u_p, b_p, w_p, u_n, b_n, w_n, loss = ctx.saved_tensors
+        c, eps = ctx.c, ctx.eps
+        g = grad_output * (loss > 0).to(grad_output.dtype)
+        # the clamped conformal factors do not depend on the points
+        a_grad = (a > eps).to(a.dtype) * 2 * c / a
+        grad_anchor = torch.zeros_like(anchor)
+        grads = []
+        for sign, y, u, b, w in ((1., x_pos, u_p, b_p, w_p), (-1., x_neg, u_n, b_n, w_n)):
+            # d'(w) * dw/d(.) shared factor: 2c / (a b) / (sqrt(c) sqrt(w (w + 2)))
+            scale = sign * g * 2 * c / (a * b) / (c ** 0.5 * torch.sqrt(w * (w + 2)).clamp_min(eps))
+            diff = anchor - y
+            grad_anchor += scale.unsqueeze(-1) * (2 * diff + (u * a_grad).unsqueeze(-1) * anchor)
+            if ctx.needs_input_grad[1 if sign > 0 else 2]:
+                b_grad = (b > eps).to(b.dtype) * 2 * c / b
+                grads.append(scale.unsqueeze(-1) * (-2 * diff + (u * b_grad).unsqueeze(-1) * y))
+            else:
+                grads.append(None)
+        return grad_anchor, grads[0], grads[1], None, None, None, None, None
+
+
+class PoincareTripletLoss(nn.Module):
+    """
+    Drop-in for ACoshTripletLoss on a PoincareBall with fixed curvature: the same per-sample
+    max(d(anchor, x_pos) - d(anchor, x_neg) + margin, 0), computed by _PoincareTripletFunction.
+    With a PrototypeTable, x_pos and x_neg may be class labels, whose prototype terms are gathered from the table.
+    """
+
+    def __init__(self, manifold, margin=1., eps=1e-7, prototypes=None):
+        super(PoincareTripletLoss, self).__init__()
+        self.margin = margin
+        self.manifold = manifold
+        self.c = float(manifold.c)
+        self.eps = eps
+        self.prototypes = prototypes
+
+    def _points(self, y):
+        if self.prototypes is not None and not y.is_floating_point():
+            return self.prototypes.gather(y)
+        return y, (1 - self.c * y.pow(2).sum(-1)).clamp_min(self.eps)
+
+    def forward(self, anchor, x_pos, x_neg):
+        (x_pos, b_pos), (x_neg, b_neg) = self._points(x_pos), self._points(x_neg)
+        anchor, x_pos, x_neg = torch.broadcast_tensors(anchor, x_pos, x_neg)
+        b_pos, b_neg = b_pos.expand(anchor.shape[:-1]), b_neg.expand(anchor.shape[:-1])
+        return _PoincareTripletFunction.apply(anchor, x_pos, x_neg, b_pos, b_neg, self.c, self.margin, self.eps)
+
+
+def benchmark_triplet(batch_size=256, dim=20, num_classes=100, repeats=50, curvature=1., mult_slope=0.9):
+    """
+    Forward + backward time and saved activations of ACoshTripletLoss against PoincareTripletLoss on CPU, on
+    indexed prototypes and on labels with a PrototypeTable.
+    """
+    from geoopt import PoincareBall
+    from utils.mem_utils import saved_bytes
+    ball = PoincareBall(curvature)
+    # prototypes inside the ball, scaled as in main.py
+    polars = torch.nn.functional.normalize(torch.randn(num_classes, dim), dim=-1) * mult_slope / curvature ** 0.5
+    features = torch.randn(batch_size, dim, requires_grad=True)
+    y = torch.randint(num_classes, (batch_size,))
+    y_neg = torch.randint(num_classes, (batch_size,))
+
+    table = PrototypeTable(polars, curvature)
+    criteria = [('geoopt', ACoshTripletLoss(ball, margin=1.), lambda: (polars[y], polars[y_neg])),
+                ('fused', PoincareTripletLoss(ball, margin=1.), lambda: (polars[y], polars[y_neg])),
+                ('table', PoincareTripletLoss(ball, margin=1., prototypes=table), lambda: (y, y_neg))]
+    for name, criterion, targets in criteria:
+        loss, saved = saved_bytes(lambda: criterion(ball.expmap0(features), *targets()).mean())
+        loss.backward()
+        grad = features.grad.clone()
+        features.grad = None
+        start = time.time()
+        for _ in range(repeats):
+            criterion(ball.expmap0(features), *targets()).mean().backward()
+        cost = (time.time() - start) / repeats
+        features.grad = None
+        print(f"{name:>7}: loss {loss.item():.6f}, fwd+bwd {cost * 1e3:.3f} ms, saved for backward {saved / 1024:.1f} KB")
+        if name == 'geoopt':
+            ref_grad = grad
+        else:
+            print(f"max |grad diff|: {(grad - ref_grad).abs().max().item():.2e}")
+
+
+def benchmark_info_nce(batch_size=128, dim=20, num_neg=128, chunk_size=32, repeats=10, curvature=1.):
+    """Forward + backward time and saved activations of the former repeated-anchor InfoNCE and the broadcast one."""
+    from geoopt import PoincareBall
+    from utils.mem_utils import saved_bytes
+    ball = PoincareBall(curvature)
+    features = torch.randn(batch_size, dim, requires_grad=True)
+    y = ball.expmap0(torch.randn(batch_size, dim))
+    y_neg = ball.expmap0(torch.randn(batch_size * num_neg, dim))
+
+    def former(x):
+        loss_pos = ball.dist(x, y).reshape(-1, 1)
+        x_neg = x.repeat(1, num_neg).reshape(y_neg.shape)
+        loss_neg = ball.dist(x_neg, y_neg).reshape(batch_size, -1)
+        logits = torch.cat((loss_pos, loss_neg), dim=1) / (-0.1)
+        return nn.functional.cross_entropy(logits, torch.zeros(batch_size, dtype=torch.long))
+
+    criteria = [('former', former), ('broadcast', lambda x: InfoNCE(ball)(x, y, y_neg)),
+                ('chunked', lambda x: InfoNCE(ball, chunk_size=chunk_size)(x, y, y_neg))]
+    for name, criterion in criteria:
+        loss, saved = saved_bytes(lambda: criterion(ball.expmap0(features)))
+        loss.backward()
+        grad = features.grad.clone()
+        features.grad = None
+        start = time.time()
+        for _ in range(repeats):
+            criterion(ball.expmap0(features)).backward()
+        cost = (time.time() - start) / repeats
+        features.grad = None
+        if name == 'former':
+            ref_loss, ref_grad = loss, grad
+        print(f"{name:>9}: fwd+bwd {cost * 1e3:8.2f} ms, saved for backward {saved / 1024:8.1f} KB, "
+              f"|loss diff| {(loss - ref_loss).abs().item():.1e}, max |grad diff| {(grad - ref_grad).abs().max().item():.1e}")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    for batch_size in [64, 256, 1024]:
+        print(f"batch size {batch_size}")
+        benchmark_triplet(batch_size=batch_size)
+    for num_neg in [16, 128, 1024]:
+        print(f"InfoNCE, batch size 128, {num_neg} negatives")
+        benchmark_info_nce(num_neg=num_neg)
@@ -1,21 +1,20 @@
 import time
 import copy
 from typing import Optional
-from copy import deepcopy
 
-import cvxpy as cp
 import numpy as np
 import torch
 import torch.linalg
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import wandb
-from scipy.optimize import minimize
 
 from utils.data_utils import read_global_test_data
-from flcore.clients.clientSphereG import ClientSphereG
+from flcore.clients.clientFedRANE import ClientFedRANE
 from flcore.servers.serverbase import Server
-from utils.min_norm_solvers_cag import MinNormSolver
+from utils.aggregation_utils import make_blocks, AggregationContext, AGGREGATION_DIAGNOSTICS
+from utils.min_norm_solvers import gradient_normalizers
+from utils.aggregation_utils import cagrad_weights, mgda_weights, pcgrad_weights, NashSolver
 
 
 class FedRANE(Server):
@@ -33,7 +32,7 @@ class FedRANE(Server):
 
         # select slow clients
         self.set_slow_clients()
-        self.set_clients(args, ClientSphereG)
+        self.set_clients(args, ClientFedRANE)
         self.args = args
         print(f"\nJoin ratio / total clients: {self.join_ratio} / {self.num_clients}")
         print("Finished creating server and clients.")
@@ -51,37 +50,12 @@ class FedRANE(Server):
 
         if self.method == "CAG":
             self.cagrad_c = args.cagrad_c
-        elif self.method == "Nash":
-            num_clients = self.join_clients
-            for i in range(self.join_clients):
-                if self.clients[i].train_samples < args.batch_size:
-                    num_clients -= 1
-            self.alpha_param = cp.Variable(shape=(num_clients,), nonneg=True)
-            self.prvs_alpha_param = cp.Parameter(
-                shape=(num_clients,), value=np.ones(num_clients, dtype=np.float32)
-            )
-            self.G_param = cp.Parameter(
-                shape=(num_clients, num_clients), value=np.eye(num_clients)
-            )
-            self.normalization_factor_param = cp.Parameter(
-                shape=(1,), value=np.array([1.0])
-            )
-            G_prvs_alpha = self.G_param @ self.prvs_alpha_param
-            prvs_phi_tag = 1 / self.prvs_alpha_param + (1 / G_prvs_alpha) @ self.G_param
-            self.phi_alpha = prvs_phi_tag @ (self.alpha_param - self.prvs_alpha_param)
-            self.prvs_alpha = np.ones(num_clients, dtype=np.float32)
-            G_alpha = self.G_param @ self.alpha_param
-            constraint = []
-            for i in range(num_clients):
-                constraint.append(
-                    -cp.log(self.alpha_param[i] * self.normalization_factor_param)
-                    - cp.log(G_alpha[i])
-                    <= 0
-                )
-            obj = cp.Minimize(
-                cp.sum(G_alpha) + self.phi_alpha / self.normalization_factor_param
-            )
-            self.prob = cp.Problem(obj, constraint)
+        self.nash_solvers = dict()  # one NashSolver per parameter block, keeps the warm start across rounds
+
+        # blockwise conflict-averse aggregation
+        self.aggregation_blocks = args.aggregation_blocks
+        self.aggregation_block_size = args.aggregation_block_size
+        self.grad_normalization = args.grad_normalization or 'none'
 
     def train(self):
         for i in range(self.global_rounds + 1):
@@ -100,6 +74,9 @@ class FedRANE(Server):
             if self.method == "AVG":
                 self.receive_models()
                 self.aggregate_parameters()
+                # plain averaging needs no Gram matrix: pad the diagnostics to keep them aligned with the rounds
+                for name in AGGREGATION_DIAGNOSTICS:
+                    self.rs_aggregation.setdefault(name, []).append(float('nan'))
             else:
                 self.update_global()
 
@@ -109,6 +86,7 @@ class FedRANE(Server):
         # self.save_global_model()
         self.send_models()
         self.evaluate()
+        self.save_results()
 
         # Fine-tune clients' classifier for personalization
         if self.fine_tune_epochs is not None:
@@ -225,6 +203,14 @@ class FedRANE(Server):
                     possible_i = i
                     break
 
+        if self.aggregate_all:
+            named_params = self.global_model.named_parameters()
+            client_params = self.selected_clients[possible_i].model.parameters()
+        else:
+            named_params = self.global_model.base.named_parameters(prefix='base')
+            client_params = self.selected_clients[possible_i].model.base.parameters()
+        grad_names = [name for (name, _), param in zip(named_params, client_params) if param.grad is not None]
+
         grads = torch.Tensor(sum(grad_dims), self.join_clients)
         no_grad_id_list = []
 
@@ -255,14 +241,23 @@ class FedRANE(Server):
                 grads = torch.index_select(grads, dim=1, index=torch.tensor(keep_columns))
                 no_grad_id_list.append(client.id)
 
-        if self.method == "CAG":
-            new_grads = self.cagrad(grads, no_grad_id_list)  # grads: dim x K clients
-        elif self.method == "MGDA":
-            new_grads = self.mgda(grads)
-        elif self.method == "PCG":
-            new_grads = self.pcgrad(grads)
-        elif self.method == "Nash":
-            new_grads = self.nash(grads, no_grad_id_list)
+        sample_weights = self.client_sample_weights(no_grad_id_list)
+        blocks = make_blocks(list(zip(grad_names, grad_dims)), self.aggregation_blocks, self.aggregation_block_size)
+        context = AggregationContext(grads.t(), sample_weights, blocks)
+        gram_scale = 1.
+        if self.grad_normalization != 'none':
+            # solve for the normalized updates delta_k / gn_k, and apply the weights to the raw updates
+            losses = None
+            if self.grad_normalization in ('loss', 'loss+'):
+                losses = [client.train_loss for client in self.selected_clients if client.id not in no_grad_id_list]
+            normalizers = gradient_normalizers(context.updates, losses, self.grad_normalization,
+                                               norms=context.norms).clamp_min(1e-12)
+            gram_scale = torch.outer(normalizers, normalizers)
+        weights = context.weights(lambda block, gram: self.solve_weights(block, gram, sample_weights), gram_scale)
+        new_grads = context.combine(weights)
+
+        for name, value in context.diagnostics().items():
+            self.rs_aggregation.setdefault(name, []).append(value)
 
         self.global_model.train()
         cnt = 0
@@ -287,134 +282,24 @@ class FedRANE(Server):
 
         self.global_optimizer.step()
 
-    def cagrad(self, grads, no_grad_id_list):
-        grad_vec = grads.t()
-        tot_samples = 0
-        sample_weights = dict()
-        for client in self.selected_clients:
-            sample_weights[client.id] = client.train_samples
-            tot_samples += client.train_samples
-
-        x_start = np.array([sample_weights[client.id] / tot_samples for client in self.selected_clients if
-                            client.id not in no_grad_id_list])
-        # x_start = np.ones(self.join_clients) / self.join_clients
-
-        grads = grad_vec / 100.
-        g0 = grads.mean(0)
-        GG = grads.mm(grads.t())
-        bnds = tuple((0, 1) for x in x_start)
-        cons = ({'type': 'eq', 'fun': lambda x: 1 - sum(x)})
-        A = GG.cpu().numpy()
-        b = x_start.copy()
-        c = (self.cagrad_c * g0.norm()).cpu().item()
-
-        num_clients = self.join_clients - len(no_grad_id_list)
-
-        def objfn(x):
-            return (x.reshape(1, num_clients).dot(A).dot(b.reshape(num_clients, 1)) +
-                    c * np.sqrt(
-                        x.reshape(1, num_clients).dot(A).dot(x.reshape(num_clients, 1)) + 1e-8)).sum()
-
-        res = minimize(objfn, x_start, bounds=bnds, constraints=cons)
-        w_cpu = res.x
-        ww = torch.Tensor(w_cpu).to(grad_vec.device)
-        gw = (grads * ww.view(-1, 1)).sum(0)
-        gw_norm = gw.norm()
-        lmbda = c / (gw_norm + 1e-4)
-        g = (g0 + lmbda * gw) / (1 + lmbda)
-        return g * 100
-
-    def mgda(self, grads):
-        tot_samples = 0
-        sample_weights = dict()
-        for client in self.selected_clients:
-            sample_weights[client.id] = client.train_samples
-            tot_samples += client.train_samples
-
-        grads_cpu = grads.t().cpu()
-        sol, min_norm = MinNormSolver.find_min_norm_element([grads_cpu[t] for t in range(grads.shape[-1])],
-                                                            sample_weights=[sample_weights[client.id] / tot_samples
-                                                                            for client in self.selected_clients])
-        w = torch.FloatTensor(sol).to(grads.device)
-        g = grads.mm(w.view(-1, 1)).view(-1)
-        return g
-
-    def pcgrad(self, grads):
-        rng = np.random.default_rng()
-        grad_vec = grads.t()
-
-        shuffled_task_indices = np.zeros((self.join_clients, self.join_clients - 1), dtype=int)
-        for i in range(self.join_clients):
-            task_indices = np.arange(self.join_clients)
-            task_indices[i] = task_indices[-1]
-            shuffled_task_indices[i] = task_indices[:-1]
-            rng.shuffle(shuffled_task_indices[i])
-        shuffled_task_indices = shuffled_task_indices.T
-
-        normalized_grad_vec = grad_vec / (grad_vec.norm(dim=1, keepdim=True) + 1e-8)  # num_tasks x dim
-        modified_grad_vec = deepcopy(grad_vec)
-        for task_indices in shuffled_task_indices:
-            normalized_shuffled_grad = normalized_grad_vec[task_indices]  # num_tasks x dim
-            dot = (modified_grad_vec * normalized_shuffled_grad).sum(dim=1, keepdim=True)  # num_tasks x dim
-            modified_grad_vec -= torch.clamp_max(dot, 0) * normalized_shuffled_grad
-        g = modified_grad_vec.mean(dim=0)
-        return g
-
-    def nash(self, grads, no_grad_id_list):
-        def stop_criteria(gtg, alpha_t):
-            return (
-                    (self.alpha_param.value is None)
-                    or (np.linalg.norm(gtg @ alpha_t - 1 / (alpha_t + 1e-10)) < 1e-3)
-                    or (np.linalg.norm(self.alpha_param.value - self.prvs_alpha_param.value) < 1e-6)
-            )
-
-        def solve_optimization(gtg, no_grad_id_list):
-            self.G_param.value = gtg
-            self.normalization_factor_param.value = self.normalization_factor
-            tot_samples = 0
-            sample_weights = dict()
-            for client in self.selected_clients:
-                sample_weights[client.id] = client.train_samples
-                tot_samples += client.train_samples
-
-            alpha_t = np.array([sample_weights[client.id] / tot_samples for client in self.selected_clients if
-                                client.id not in no_grad_id_list])
-
-            for _ in range(20):  # optim_niter
-                self.alpha_param.value = alpha_t
-                self.prvs_alpha_param.value = alpha_t
-                try:
-                    self.prob.solve(solver=cp.ECOS, warm_start=True, max_iters=100)
-                except:
-                    self.alpha_param.value = self.prvs_alpha_param.value
-                if stop_criteria(gtg, alpha_t):
-                    break
-                alpha_t = self.alpha_param.value
-
-            if alpha_t is not None:
-                self.prvs_alpha = alpha_t
-            return self.prvs_alpha
-
-        # grads: dim x num_clients
-        GTG = torch.mm(grads.t(), grads)
-        self.normalization_factor = (
-            torch.norm(GTG).detach().cpu().numpy().reshape((1,))
-        )
-        GTG = GTG / self.normalization_factor.item()
-        alpha = solve_optimization(GTG.cpu().detach().numpy(), no_grad_id_list)
-        w = torch.FloatTensor(alpha).to(grads.device)
-
-        w /= sum(alpha)
+    def client_sample_weights(self, no_grad_id_list):
+        # normalized over the clients whose updates take part in the aggregation
+        train_samples = np.array([client.train_samples for client in self.selected_clients if
+                                  client.id not in no_grad_id_list], dtype=float)
+        return train_samples / train_samples.sum()
 
-        g = grads.mm(w.view(-1, 1)).view(-1)
-        return g
-
-    def add_parameters(self, w, client_model):
-        if self.aggregate_all:
-            for server_param, client_param in zip(self.global_model.parameters(), client_model.parameters()):
-                server_param.data += client_param.data.clone() * w
+    def solve_weights(self, block, gram, sample_weights):
+        """ Map the K x K Gram matrix of the client updates in one parameter block to the K aggregation weights."""
+        if self.method == "CAG":
+            return cagrad_weights(gram, sample_weights, self.cagrad_c)
+        elif self.method == "MGDA":
+            return mgda_weights(gram, sample_weights)
+        elif self.method == "PCG":
+            return pcgrad_weights(gram)
+        elif self.method == "Nash":
+            num_clients = gram.shape[0]
+            if self.nash_solvers.get(block) is None or self.nash_solvers[block].num_clients != num_clients:
+                self.nash_solvers[block] = NashSolver(num_clients)
+            return self.nash_solvers[block].weights(gram, sample_weights)
         else:
-            for server_param, client_param in zip(self.global_model.base.parameters(), client_model.base.parameters()):
-                server_param.data += client_param.data.clone() * w
-            for server_param, client_param in zip(self.global_model.predictor.parameters(), client_model.predictor.parameters()):
-                server_param.data += client_param.data.clone() * w
+            raise NotImplementedError
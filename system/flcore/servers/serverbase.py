@@ -47,6 +47,7 @@ class Server(object):
         self.rs_test_acc = []
         self.rs_test_auc = []
         self.rs_train_loss = []
+        self.rs_aggregation = dict()  # diagnostics of the aggregation, one list per statistic
 
         self.times = times
         self.eval_gap = args.eval_gap
@@ -193,6 +194,8 @@ class Server(object):
                 hf.create_dataset('rs_test_acc', data=self.rs_test_acc)
                 hf.create_dataset('rs_test_auc', data=self.rs_test_auc)
                 hf.create_dataset('rs_train_loss', data=self.rs_train_loss)
+                for name, values in self.rs_aggregation.items():
+                    hf.create_dataset('rs_agg_' + name, data=values)
 
     def save_item(self, item, item_name):
         if not os.path.exists(self.save_folder_name):
@@ -18,6 +18,7 @@ from torch.utils.data import Dataset, DataLoader
 import torch.nn.functional as F
 
 from geoopt import PoincareBall
+from flcore.trainmodel.hyperbolic_head import HyperbolicPrototypeHead
 import wandb
 from utils.data_utils import read_global_test_data
 from openTSNE import TSNE
@@ -131,6 +132,8 @@ class HyperbolicFed(Server):
         gt_labels = []
         if global_test:
             test_data1, test_data2 = read_global_test_data(self.dataset)
+            head = HyperbolicPrototypeHead(self.global_model.predictor, self.args.curvature,
+                                           mode=self.args.prediction_mode)
             data_loader = DataLoader(test_data1, self.batch_size, drop_last=False, shuffle=True)
             # self.global_model.to(self.device)
             self.global_model.eval()
@@ -139,17 +142,8 @@ class HyperbolicFed(Server):
                 for x, y in data_loader:
                     x = x.to(self.device)
                     y = y.to(self.device)
-                    output = self.global_model.base(x)
-                    output_exp_map = PoincareBall(self.args.curvature).expmap0(output)  # project on the hyperbolic
-                    output_exp_map_norm = F.normalize(output_exp_map, dim=-1, p=2)
-                    output = self.global_model.predictor(output_exp_map_norm).float()
+                    output = head(self.global_model.base(x), reuse_output=True)
                     pred = output.max(1, keepdim=True)[1]
-                    # output_exp_map = output_exp_map.repeat(1, self.num_classes).reshape(y.shape[0], self.num_classes,
-                    #                                                                     self.polars.shape[1])
-                    # y_exp_map = self.polars.repeat(y.shape[0], 1).reshape(y.shape[0], self.num_classes,
-                    #                                                       self.polars.shape[1])
-                    # dist = PoincareBall(self.args.curvature).dist(output_exp_map, y_exp_map, dim=-1)
-                    # pred = dist.min(1, keepdim=True)[1]
                     test_acc += pred.eq(y.view_as(pred)).sum().item()
                     test_num += y.shape[0]
             global_test1_acc = test_acc / test_num
@@ -165,20 +159,13 @@ class HyperbolicFed(Server):
                     x = x.to(self.device)
                     y = y.to(self.device)
                     output = self.global_model.base(x)
-                    output_exp_map = PoincareBall(self.args.curvature).expmap0(output)  # project on the hyperbolic
                     if self.args.visualize:
+                        output_exp_map = head.expmap0(output)  # project on the hyperbolic
                         output_vectors.extend(output_exp_map.cpu().numpy().tolist())
                         gt_labels.extend(y.cpu().numpy().tolist())
 
-                    output_exp_map_norm = F.normalize(output_exp_map, dim=-1, p=2)
-                    output = self.global_model.predictor(output_exp_map_norm).float()
+                    output = head(output, reuse_output=True)
                     pred = output.max(1, keepdim=True)[1]
-                    # output_exp_map = output_exp_map.repeat(1, self.num_classes).reshape(y.shape[0], self.num_classes,
-                    #                                                                     self.polars.shape[1])
-                    # y_exp_map = self.polars.repeat(y.shape[0], 1).reshape(y.shape[0], self.num_classes,
-                    #                                                       self.polars.shape[1])
-                    # dist = PoincareBall(self.args.curvature).dist(output_exp_map, y_exp_map, dim=-1)
-                    # pred = dist.min(1, keepdim=True)[1]
                     test_acc += pred.eq(y.view_as(pred)).sum().item()
                     test_num += y.shape[0]
 
@@ -9,10 +9,11 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 import torch.nn.functional as F
-from geoopt import PoincareBall
+from flcore.trainmodel.hyperbolic_head import HyperbolicPrototypeHead
 import wandb
 from utils.data_utils import read_global_test_data
 from utils.min_norm_solvers import MinNormSolver, gradient_normalizers
+from utils.aggregation_utils import flatten_params, unflatten_params, make_blocks, AggregationContext
 from torch.autograd import Variable
 
 
@@ -32,9 +33,19 @@ class MGDA(Server):
         self.num_classes = args.num_classes
         self.args = args
 
-        self.grads = dict()
         self.sample_weights = dict()
-        self.scale = dict()
+        self.scale = dict()  # client id -> one weight per parameter block
+        self.update_buffer = None  # K x P flattened client updates
+        self.normalizers = None  # per-client normalizers of the updates
+        self.global_flat = None
+        self.global_params = []
+        self.aggregate_budget = []
+
+        # blockwise min-norm weighting
+        self.aggregation_blocks = args.aggregation_blocks
+        self.aggregation_block_size = args.aggregation_block_size
+        self.grad_normalization = args.grad_normalization or 'l2'
+        self.blocks = [(0, 0)]
 
     def train(self):
         self.selected_clients = self.select_clients()
@@ -50,8 +61,13 @@ class MGDA(Server):
             for client in self.selected_clients:
                 client.train()
 
+            a_t = time.time()
             self.calculate_weight()
             self.aggregate_parameters()
+            if self.device == "cuda":
+                torch.cuda.synchronize()
+            self.aggregate_budget.append(time.time() - a_t)
+            print("-" * 25, 'aggregation time cost', '-' * 25, self.aggregate_budget[-1])
 
             self.send_models()
             self.Budget.append(time.time() - s_t)
@@ -66,41 +82,69 @@ class MGDA(Server):
     def calculate_weight(self):
         tot_samples = 0
         for client in self.selected_clients:
-            self.grads[client.id] = []
             self.sample_weights[client.id] = client.train_samples
             tot_samples += client.train_samples
-            for server_param, client_param in zip(self.global_model.parameters(), client.model.parameters()):
-                if client_param.grad is not None:
-                    # self.grads[client.id].append(server_param.data.clone() - client_param.data.clone())
-                    self.grads[client.id].append(client_param.data.clone() - server_param.data.clone())
-        # for client in self.selected_clients:
-        #     self.grads[client.id] = client.get_gradient()
-
-        gn = {}
-        for t in self.grads:
-            gn[t] = np.sqrt(sum([gr.pow(2).sum().data.cpu() for gr in self.grads[t]]))
-        for client in self.selected_clients:
-            for gr_i in range(len(self.grads[client.id])):
-                self.grads[client.id][gr_i] = self.grads[client.id][gr_i] / gn[client.id]
 
-        sol, min_norm = MinNormSolver.find_min_norm_element(
-            [self.grads[client.id] for client in self.selected_clients],
-            sample_weights=[self.sample_weights[client.id] / tot_samples for client in self.selected_clients])
+        # only the parameters updated by local training take part in the weighting
+        has_grad = None
+        for client in self.selected_clients:
+            has_grad = [client_param.grad is not None for client_param in client.model.parameters()]
+            if any(has_grad):
+                break
+        named_params = [(name, server_param) for (name, server_param), g in
+                        zip(self.global_model.named_parameters(), has_grad) if g]
+        self.global_params = [server_param for _, server_param in named_params]
+        self.blocks = make_blocks([(name, param.numel()) for name, param in named_params],
+                                  self.aggregation_blocks, self.aggregation_block_size)
+        num_params = sum(param.numel() for param in self.global_params)
+
+        # one contiguous row per client holding the flattened update (client - server)
+        shape = (len(self.selected_clients), num_params)
+        if self.update_buffer is None or self.update_buffer.shape != shape:
+            self.update_buffer = torch.empty(shape, device=self.device)
+            self.global_flat = torch.empty(num_params, device=self.device)
+        flatten_params(self.global_params, self.global_flat)
+        for i, client in enumerate(self.selected_clients):
+            client_params = [client_param for client_param, g in zip(client.model.parameters(), has_grad) if g]
+            flatten_params(client_params, self.update_buffer[i]).sub_(self.global_flat)
+
+        sample_weights = [self.sample_weights[client.id] / tot_samples for client in self.selected_clients]
+        context = AggregationContext(self.update_buffer, sample_weights, self.blocks)
+        losses = None
+        if self.grad_normalization in ('loss', 'loss+'):
+            losses = [client.train_loss for client in self.selected_clients]
+        self.normalizers = gradient_normalizers(self.update_buffer, losses, self.grad_normalization,
+                                                norms=context.norms).clamp_min(1e-12)
+        # the Gram matrix of the normalized updates delta_k / gn_k, without rescaling the K x P buffer
+        gram_scale = torch.outer(self.normalizers, self.normalizers)
+
+        def solve(block, gram):
+            sol, min_norm = MinNormSolver.find_min_norm_element_from_gram(gram.cpu().numpy(),
+                                                                          sample_weights=sample_weights)
+            return sol
+
+        block_sols = context.weights(solve, gram_scale)
+        for name, value in context.diagnostics().items():
+            self.rs_aggregation.setdefault(name, []).append(value)
         for i, client in enumerate(self.selected_clients):
-            self.scale[client.id] = float(sol[i])
+            self.scale[client.id] = [float(sol[i]) for sol in block_sols]
 
     def aggregate_parameters(self):
-        self.global_model = copy.deepcopy(self.selected_clients[0].model)
-        for param in self.global_model.parameters():
-            param.data.zero_()
-
-        for client in self.selected_clients:
-            for server_param, client_param in zip(self.global_model.parameters(), client.model.parameters()):
-                server_param.data += self.scale[client.id] * client_param.data.clone()
+        # sum_k scale_k * client_k = server + sum_k scale_k * gn_k * delta_k / gn_k since the scales of every block
+        # sum up to 1, and parameters without updates are the same on every client
+        scale = torch.tensor([self.scale[client.id] for client in self.selected_clients], device=self.device)
+        for b, (beg, end) in enumerate(self.blocks):
+            self.global_flat[beg:end].addmv_(self.update_buffer[:, beg:end].t(), scale[:, b])
+        unflatten_params(self.global_flat, self.global_params)
+        # running statistics come from the first selected client, as with the former deepcopy of its model
+        for server_buf, client_buf in zip(self.global_model.buffers(), self.selected_clients[0].model.buffers()):
+            server_buf.data.copy_(client_buf.data)
 
     def evaluate(self, acc=None, loss=None, global_test=False):
         if global_test:
             test_data1, test_data2 = read_global_test_data(self.dataset)
+            head = HyperbolicPrototypeHead(self.global_model.predictor, self.args.curvature,
+                                           mode=self.args.prediction_mode)
             data_loader = DataLoader(test_data2, self.batch_size, drop_last=False, shuffle=True)
             self.global_model.eval()
             test_num, test_acc = 0., 0.
@@ -108,10 +152,7 @@ class MGDA(Server):
                 for x, y in data_loader:
                     x = x.to(self.device)
                     y = y.to(self.device)
-                    output = self.global_model.base(x)
-                    output_exp_map = PoincareBall(self.args.curvature).expmap0(output)  # project on the hyperbolic
-                    output_exp_map_norm = F.normalize(output_exp_map, dim=-1, p=2)
-                    output = self.global_model.predictor(output_exp_map_norm).float()
+                    output = head(self.global_model.base(x), reuse_output=True)
                     pred = output.max(1, keepdim=True)[1]
 
                     test_acc += pred.eq(y.view_as(pred)).sum().item()
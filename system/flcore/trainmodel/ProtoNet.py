@@ -1,3 +1,5 @@
+import math
+import time
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,6 +13,8 @@ from PIL import ImageEnhance
 import torchvision
 from torchvision import transforms
 
+from flcore.losses.costripletLoss import arcosh1p
+
 
 def lorenz_factor(x, *, c=1.0, dim=-1, keepdim=False):
     """
@@ -63,6 +67,19 @@ def poincare_mean(x, dim=0, c=1.0):
     return mean.squeeze(dim)
 
 
+def poincare_episode_dist(query, proto, c=1.0, eps=1e-7):
+    """
+    Poincare distances of E x n_query x dim queries to E x way x dim prototypes, E x n_query x way, from
+    arcosh(1 + 2c|q - p|^2 / ((1 - c|q|^2)(1 - c|p|^2))) / sqrt(c) with |q - p|^2 from one bmm, instead of a mobius
+    addition over E x n_query x way x dim.
+    """
+    sq_query = query.pow(2).sum(dim=-1)
+    sq_proto = proto.pow(2).sum(dim=-1)
+    sq_diff = torch.baddbmm(sq_query[:, :, None] + sq_proto[:, None, :], query, proto.transpose(1, 2), alpha=-2)
+    conformal = ((1 - c * sq_query)[:, :, None] * (1 - c * sq_proto)[:, None, :]).clamp_min(eps)
+    return arcosh1p(2 * c * sq_diff.clamp_min_(0) / conformal) / math.sqrt(c)
+
+
 # Basic ConvNet with Pooling layer
 def conv_block(in_channels, out_channels):
     return nn.Sequential(
@@ -135,3 +152,81 @@ class ProtoNet(nn.Module):
             # 3. Logits is calculated based on the Euclidean distance between data query and proto
             logits = (((self.encoder(data_query)[:, None, :] - proto) ** 2).sum(dim=-1) / self.temperature)
         return logits
+
+    def episode_logits(self, proto, query):
+        """
+        Logits of E episodes from encoded features: proto is E x shot x way x dim, query E x n_query x dim, and the
+        result E x n_query x way, as forward episode by episode up to the float32 error of manifold.dist near the
+        boundary of the ball.
+        """
+        # Hyperbolic Space:
+        if self.is_hyperbolic:
+            # Klein-model means over the shots of every episode at once
+            proto = poincare_mean(self.manifold.expmap0(proto), dim=1, c=self.manifold.c.item())
+            query = self.manifold.expmap0(query)
+            return -poincare_episode_dist(query, proto, c=self.manifold.c.item()) / self.temperature
+
+        # Euclidean Space
+        proto = proto.mean(dim=1)
+        sq_dist = torch.baddbmm(query.pow(2).sum(dim=-1)[:, :, None] + proto.pow(2).sum(dim=-1)[:, None, :],
+                                query, proto.transpose(1, 2), alpha=-2)
+        return sq_dist.clamp_min_(0) / self.temperature
+
+    def forward_episodes(self, data_shot, data_query):
+        """
+        E episodes in one pass: data_shot is E x shot x way x C x H x W (shot-major as in forward), data_query
+        E x n_query x C x H x W, and the logits E x n_query x way. The shots and the queries of all the episodes are
+        encoded in one batch each, which is only the same as forward in eval mode because of batch normalization.
+        """
+        num_episodes = data_shot.shape[0]
+        proto = self.encoder(data_shot.flatten(0, 2)).reshape(num_episodes, self.shot, self.way, -1)
+        query = self.encoder(data_query.flatten(0, 1)).reshape(num_episodes, data_query.shape[1], -1)
+        return self.episode_logits(proto, query)
+
+
+def benchmark_episodes(num_episodes=64, episodes_per_batch=16, shot=1, way=5, query=15, dim=1600, image_size=84,
+                       is_hyperbolic=True, encode=True):
+    """
+    Episodes per second of forward one episode at a time against forward_episodes on the cpu, in eval mode.
+    With encode=False only the prototype / distance part is timed, on random features.
+    """
+    model = ProtoNet(shot=shot, way=way, dim=dim, is_hyperbolic=is_hyperbolic).eval()
+    if encode:
+        data = torch.randn(num_episodes, shot + query, way, 3, image_size, image_size)
+    else:
+        data = torch.randn(num_episodes, shot + query, way, dim)
+        model.encoder = nn.Identity()
+
+    def one_by_one():
+        return torch.stack([model(episode[:shot].flatten(0, 1), episode[shot:].flatten(0, 1))
+                            for episode in data])
+
+    def batched():
+        return torch.cat([model.forward_episodes(batch[:, :shot], batch[:, shot:].flatten(1, 2))
+                          for batch in data.split(episodes_per_batch)])
+
+    with torch.no_grad():
+        logits = {}
+        for name, fn in [('episode', one_by_one), ('batched', batched)]:
+            start = time.time()
+            logits[name] = fn()
+            cost = time.time() - start
+            print(f"{name:>8}: {num_episodes / cost:10.1f} episodes/s")
+        if is_hyperbolic and not encode:
+            # the same float32 points on the ball, with the distances in float64, for the first 100 episodes
+            ball, data = model.manifold, data[:100]
+            proto = poincare_mean(ball.expmap0(data[:, :shot]), dim=1, c=ball.c.item())
+            query = ball.expmap0(data[:, shot:].flatten(1, 2))
+            reference = -ball.dist(query.double()[:, :, None, :], proto.double()[:, None, :, :]) / model.temperature
+            for name in logits:
+                logits[name] = logits[name][:100]
+                same = (logits[name].argmax(-1) == reference.argmax(-1)).float().mean().item()
+                print(f"{name:>8}: max |logits - float64| {(logits[name] - reference).abs().max().item():.2e}, "
+                      f"same prediction {same:.4f}")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    for shot in [1, 5]:
+        print(f"5-way {shot}-shot, features")
+        benchmark_episodes(num_episodes=1000, shot=shot, encode=False)
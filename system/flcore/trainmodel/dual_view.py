@@ -0,0 +1,76 @@
+import time
+import functools
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+def _split_batch_norm(bn, num_views, x):
+    """BatchNorm of num_views stacked views, each normalized with its own batch statistics."""
+    if not bn.training and bn.track_running_stats:
+        # running statistics do not depend on the batch
+        return type(bn).forward(bn, x)
+    # running statistics are updated view after view, as with one forward per view
+    return torch.cat([type(bn).forward(bn, view) for view in x.chunk(num_views)], dim=0)
+
+
+@contextmanager
+def split_batch_norm(module, num_views=2):
+    """Within the context, the batch norm layers of module normalize each of num_views equal chunks separately."""
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    for bn in bns:
+        bn.forward = functools.partial(_split_batch_norm, bn, num_views)
+    try:
+        yield
+    finally:
+        for bn in bns:
+            del bn.forward
+
+
+def dual_view_forward(base, x, mixed_x, bn_mode='split'):
+    """
+    base on the clean and the mixed view of a batch, returns (z, z_mixed).
+
+    bn_mode: 'separate' for one forward per view (the former path), otherwise both views go through base as one
+    batch, with 'split' normalizing each view by its own batch statistics (the same outputs as 'separate') and
+    'joint' sharing the statistics of the whole 2B batch, as ClientFedRANE.feature_extract.
+    """
+    if bn_mode == 'separate':
+        return base(x), base(mixed_x)
+    elif bn_mode == 'split':
+        with split_batch_norm(base, 2):
+            z = base(torch.cat((x, mixed_x), dim=0))
+    elif bn_mode == 'joint':
+        z = base(torch.cat((x, mixed_x), dim=0))
+    else:
+        raise NotImplementedError
+    return z[:x.shape[0]], z[x.shape[0]:]
+
+
+def benchmark_dual_view(model, batch_size=64, image_size=32, steps=10):
+    """Forward + backward time of the two views of a batch through model for every bn_mode."""
+    x = torch.randn(batch_size, 3, image_size, image_size)
+    mixed_x = 0.7 * x + 0.3 * x[torch.randperm(batch_size)]
+    model.train()
+    outputs = {}
+    for bn_mode in ['separate', 'split', 'joint']:
+        z, z_mixed = dual_view_forward(model, x, mixed_x, bn_mode)
+        outputs[bn_mode] = torch.cat((z, z_mixed)).detach()
+        start = time.time()
+        for _ in range(steps):
+            model.zero_grad()
+            z, z_mixed = dual_view_forward(model, x, mixed_x, bn_mode)
+            (z.square().mean() + z_mixed.square().mean()).backward()
+        cost = (time.time() - start) / steps
+        diff = (outputs[bn_mode] - outputs['separate']).abs().max().item()
+        print(f"{bn_mode:>9}: {cost * 1e3:8.1f} ms/step, max |z - separate| {diff:.1e}")
+
+
+if __name__ == '__main__':
+    from flcore.trainmodel.resnet import resnet8, resnet18
+    torch.manual_seed(0)
+    for name, model_fn in [('resnet8', resnet8), ('resnet18', resnet18)]:
+        for batch_size in [32, 128]:
+            print(f"{name}, batch size {batch_size}")
+            benchmark_dual_view(model_fn(num_classes=20), batch_size=batch_size)
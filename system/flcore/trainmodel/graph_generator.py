@@ -1,20 +1,102 @@
+import time
+
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 
 
+class SPDInverse(torch.autograd.Function):
+    """
+    Inverse of a batch of SPD matrices through their Cholesky factor. The backward is the one of inverse, -P g P
+    (P is symmetric), two matmuls instead of differentiating through cholesky and cholesky_inverse.
+    """
+
+    @staticmethod
+    def forward(ctx, W):
+        P = torch.cholesky_inverse(torch.linalg.cholesky(W))
+        ctx.save_for_backward(P)
+        return P
+
+    @staticmethod
+    def backward(ctx, grad):
+        P, = ctx.saved_tensors
+        return -torch.matmul(torch.matmul(P, grad), P)
+
+
+class BilinearSimilarity(nn.Module):
+    """
+    Learnt cosine similarity x_i^T L L^T x_j / (|L^T x_i| |L^T x_j|) with L of rank columns. W = U U^T is PSD and
+    exposes its factor U, so the graph is built by the Cholesky / Woodbury solvers as for the correlation.
+    """
+
+    def __init__(self, dim, rank=64):
+        super(BilinearSimilarity, self).__init__()
+        self.proj = nn.Linear(dim, rank, bias=False)
+
+    def factor(self, x):
+        return F.normalize(self.proj(x), dim=-1)
+
+    def forward(self, x):
+        U = self.factor(x)
+        return torch.matmul(U, U.transpose(-1, -2))
+
+
+class PairMLPSimilarity(nn.Module):
+    """
+    s_ij = tanh(w^T relu(V x_i + V x_j + b) + c), an MLP on every pair, symmetric in (i, j). The first layer is
+    applied per sample and broadcast over the pairs, O(n d h + n^2 h), with 1 on the diagonal as the correlation.
+    """
+
+    def __init__(self, dim, hidden=64):
+        super(PairMLPSimilarity, self).__init__()
+        self.first = nn.Linear(dim, hidden, bias=False)
+        self.bias = nn.Parameter(torch.zeros(hidden))
+        self.second = nn.Linear(hidden, 1)
+
+    def forward(self, x):
+        h = self.first(x)  # ..., n, hidden
+        s = torch.tanh(self.second(F.relu(h.unsqueeze(-2) + h.unsqueeze(-3) + self.bias)).squeeze(-1))
+        return s.diagonal_scatter(torch.ones_like(s.diagonal(dim1=-2, dim2=-1)), dim1=-2, dim2=-1)
+
+
+LEARNT_SIMILARITIES = {'bilinear': BilinearSimilarity, 'pair_mlp': PairMLPSimilarity}
+
+
 class GraphGenerator():
-    def __init__(self, thresh=0, sim_type='correlation', set_negative='hard', reg=0.1):
+    def __init__(self, thresh=0, sim_type='correlation', set_negative='hard', reg=0.1, solver='auto', topk=0,
+                 block_size=1024, similarity=None):
         '''
         construct graph by similarity
         Args:
             thresh: similarity threshold for constructing edges of graph
             sim_type: similarity measure
             set_negative: method of handling negative similarity
+            reg: ridge added to the similarity matrix before it is inverted
+            solver: how (W + reg I)^-1 is computed, 'cholesky', 'woodbury', 'inverse' (the former W.inverse()) or
+                'auto' for woodbury when the feature dim is smaller than the batch and cholesky otherwise
+            topk: if > 0, a sparse graph keeping the topk neighbours of every node (symmetrized) instead of the dense
+                fully connected one
+            block_size: rows per block when the topk neighbours are searched
+            similarity: the learnable module of sim_type 'learnt', all pairs (..., n, n) of x (..., n, d) in one call,
+                e.g. BilinearSimilarity or PairMLPSimilarity. Register it in the model (LocalGModel does) to train it
         '''
         self.thresh = thresh
         self.sim = sim_type
         self.set_negative = set_negative
         self.reg = reg
+        self.solver = solver
+        self.topk = topk
+        self.block_size = block_size
+        self.similarity = similarity
+        if sim_type == 'learnt' and similarity is None:
+            raise ValueError("sim_type 'learnt' needs a similarity module")
+        self._eyes = {}  # identity buffers by (n, device, dtype)
+
+    def _eye(self, n, like):
+        key = (n, like.device, like.dtype)
+        if key not in self._eyes:
+            self._eyes[key] = torch.eye(n, device=like.device, dtype=like.dtype)
+        return self._eyes[key]
 
     @staticmethod
     def set_negative_to_zero(W):
@@ -25,50 +107,277 @@ class GraphGenerator():
         n = W.shape[0]
         minimum = torch.min(W)
         W = W - minimum
-        W = W * (torch.ones((n, n)).to(W) - torch.eye(n).to(W))
+        W = W * (1 - self._eye(n, W))
         return W
 
-    def _get_A(self, W):
-        if self.thresh != 'no':
-            W = torch.where(W > self.thresh, W, torch.tensor(0).float().to(W))
-            A = torch.ones_like(W).where(W > self.thresh, torch.tensor(0).float().to(W))
-        else:
-            A = torch.ones_like(W)
+    def _factorized(self):
+        return self.sim in ('correlation', 'cosine') or hasattr(self.similarity, 'factor')
+
+    def _factor(self, x):
+        """U (..., n, r) with W = U U^T for the correlation / cosine / learnt PSD similarity of the rows of x."""
+        if self.sim == 'correlation':
+            x = x - x.mean(dim=-1, keepdim=True)
+            return x / x.norm(dim=-1, keepdim=True)
+        elif self.sim == 'learnt':
+            return self.similarity.factor(x)
+        return x
 
-        return W, A
+    def _precision(self, U):
+        """
+        (U U^T + reg I)^-1 of a batch (..., n, d) of factors. The ridge makes the matrix SPD, so it is inverted by
+        its Cholesky factor, or by the Woodbury identity
+            (U U^T + reg I_n)^-1 = (I_n - U (reg I_d + U^T U)^-1 U^T) / reg
+        which only factorizes a d x d matrix, O(n d^2) instead of O(n^3).
+        """
+        n, d = U.shape[-2:]
+        solver = self.solver
+        if solver == 'auto':
+            solver = 'woodbury' if d < n else 'cholesky'
+        if solver == 'woodbury':
+            C = torch.matmul(U.transpose(-1, -2), U) + self._eye(d, U) * self.reg
+            M = SPDInverse.apply(C)
+            return (self._eye(n, U) - torch.matmul(torch.matmul(U, M), U.transpose(-1, -2))) / self.reg
+        W = torch.matmul(U, U.transpose(-1, -2)) + self._eye(n, U) * self.reg
+        if solver == 'cholesky':
+            return SPDInverse.apply(W)
+        elif solver == 'inverse':
+            return W.inverse()
+        raise NotImplementedError
 
     def _get_W(self, x):
-        if self.sim == 'correlation':
-            x = (x - x.mean(dim=1).unsqueeze(1))
-            norms = x.norm(dim=1)
-            W = torch.mm(x, x.t()) / torch.ger(norms, norms)
-        elif self.sim == 'cosine':
-            W = torch.mm(x, x.t())
+        """Partial correlation graph B (..., n, n) of the rows of x (..., n, d), a batch of graphs at once."""
+        if self._factorized():
+            P = self._precision(self._factor(x))
         elif self.sim == 'learnt':
-            n = x.shape[0]
-            W = torch.zeros(n, n)
-            for i, xi in enumerate(x):
-                for j, xj in enumerate(x[(i + 1):], i + 1):
-                    W[i, j] = W[j, i] = self.sim(xi, xj) + 1e-8
-            W = W.cuda()
+            W = self.similarity(x)
+            # a learnt similarity is not PSD in general
+            P = (W + self._eye(W.shape[-1], W) * self.reg).inverse()
+        else:
+            raise NotImplementedError
 
         # if self.set_negative == 'hard':
         #     W = self.set_negative_to_zero(W.to(x))
         # else:
         #     W = self.set_negative_to_zero_soft(W)
 
-        W += torch.eye(W.shape[0]).to(W.device) * self.reg
-
-        P = W.inverse()
-
-        B = P / (-1 * P.diag())
+        B = P / (-1 * P.diagonal(dim1=-2, dim2=-1)).unsqueeze(-2)
         # Set diagonals to 0. TODO: Use .fill_diag_
-        B = B + torch.eye(B.shape[0]).to(x)
+        B = B + self._eye(B.shape[-1], B)
 
         return B
 
+    def _threshold(self, A):
+        if self.thresh != 'no':
+            A = torch.where(A > self.thresh, A, torch.zeros_like(A))
+        return A
+
     def get_graph(self, x):
+        """
+        Normalized adjacency of x (n, d), or of every graph of a stack x (k, n, d) from one batched factorization.
+        With topk, a sparse COO (n, n) adjacency of a single x (n, d).
+        """
+        if self.topk:
+            return self._sparse_graph(x)
         B = self._get_W(x)
-        A = (B.abs() + B.T.abs()) / 2
+        A = (B.abs() + B.transpose(-1, -2).abs()) / 2
+        A = self._threshold(A)
         A = F.normalize(A, dim=-1)
         return A
+
+    def get_graphs(self, *xs):
+        """get_graph of several equally sized batches, e.g. the raw and the mixup view, as one batched call."""
+        if self.topk:
+            return tuple(self._sparse_graph(x) for x in xs)
+        return self.get_graph(torch.stack(xs)).unbind(0)
+
+    def get_cross_graph(self, S):
+        """
+        Normalized adjacency (n + m, n + m) of the bipartite graph [[0, A], [A^T, 0]] of a cross similarity S (n, m)
+        between two sets of nodes, A the thresholded S with its negative entries handled by set_negative. Nothing is
+        inverted, O(n m) on top of S.
+        """
+        n, m = S.shape
+        A = self.set_negative_to_zero(S) if self.set_negative == 'hard' else S - S.min()
+        A = self._threshold(A)
+        top = torch.cat((S.new_zeros(n, n), F.normalize(A, dim=-1)), dim=1)
+        bottom = torch.cat((F.normalize(A.t(), dim=-1), S.new_zeros(m, m)), dim=1)
+        return torch.cat((top, bottom))
+
+    def get_view_graphs(self, x1, x2, views='joint', S=None):
+        """
+        Graphs of two views x1, x2 (B, d) of a batch as a list of (nodes, adjacency) pairs to run the gnn on:
+            'joint': one graph over the 2B rows, a 2B x 2B factorization
+            'per_view': a graph per view from one batched factorization, two B x B ones
+            'bipartite': only cross-view edges, from the B x B cross similarity S of the views, no factorization. S is
+                e.g. x1 x2^T of already normalized views if given, else U1 U2^T of sim_type
+        """
+        if views == 'joint':
+            x = torch.cat((x1, x2))
+            return [(x, self.get_graph(x))]
+        elif views == 'per_view':
+            return list(zip((x1, x2), self.get_graphs(x1, x2)))
+        elif views == 'bipartite':
+            if S is None:
+                if not self._factorized():
+                    raise NotImplementedError
+                S = torch.matmul(self._factor(x1), self._factor(x2).t())
+            return [(torch.cat((x1, x2)), self.get_cross_graph(S))]
+        raise NotImplementedError
+
+    def _sparse_graph(self, x):
+        """
+        The entries of get_graph(x) on the topk largest off-diagonal entries of every row of A and their transposes,
+        as a sparse COO tensor. With the Woodbury factors the off-diagonal entries of B are
+            B_ij = P_ij / -P_jj = g_ij / (1 - g_jj),   g_ij = (U M U^T)_ij,
+        so the neighbours are searched block_size rows at a time without grad and without the n x n matrices, and
+        the values are rebuilt with grad from the gathered edges only: O(n d^2 + n k d) memory, O(n^2 d) time.
+        """
+        n = x.shape[0]
+        k = min(self.topk, n - 1)
+        U = self._factor(x) if self._factorized() else None
+        if U is not None and (self.solver == 'woodbury' or self.solver == 'auto' and U.shape[1] < n):
+            C = torch.matmul(U.t(), U) + self._eye(U.shape[1], U) * self.reg
+            UM = torch.matmul(U, SPDInverse.apply(C))
+            scale = 1 - (UM * U).sum(dim=-1)  # reg * P_jj > 0
+
+            def entries(rows, cols):
+                return ((UM[rows] * U[cols]).sum(-1).abs() / scale[cols] +
+                        (UM[cols] * U[rows]).sum(-1).abs() / scale[rows]) / 2
+
+            with torch.no_grad():
+                cols = torch.empty(n, k, dtype=torch.long, device=x.device)
+                for beg in range(0, n, self.block_size):
+                    end = min(beg + self.block_size, n)
+                    block = (torch.matmul(UM[beg:end], U.t()).abs() / scale +
+                             torch.matmul(U[beg:end], UM.t()).abs() / scale[beg:end, None]) / 2
+                    block.diagonal(offset=beg).fill_(-float('inf'))
+                    cols[beg:end] = block.topk(k, dim=-1)[1]
+        else:
+            B = self._get_W(x)
+            A = (B.abs() + B.t().abs()) / 2
+
+            def entries(rows, cols):
+                return A[rows, cols]
+
+            with torch.no_grad():
+                cols = A.detach().clone().fill_diagonal_(-float('inf')).topk(k, dim=-1)[1]
+
+        # symmetrize: the union of (i, j) and (j, i), unique and sorted by row
+        rows = torch.arange(n, device=x.device).repeat_interleave(k)
+        key = torch.cat((rows * n + cols.flatten(), cols.flatten() * n + rows)).unique()
+        rows, cols = key // n, key % n
+        values = self._threshold(entries(rows, cols))
+        # F.normalize over the rows of the sparse matrix
+        norms = torch.zeros(n, dtype=values.dtype, device=values.device).index_add(0, rows, values.square()).sqrt()
+        values = values / norms.clamp_min(1e-12)[rows]
+        return torch.sparse_coo_tensor(torch.stack((rows, cols)), values, (n, n), check_invariants=False,
+                                       is_coalesced=True)
+
+
+def benchmark_graph(batch_sizes=(64, 128, 256, 512, 1024), dim=128, steps=10, seed=0):
+    """
+    Forward + backward time of the raw and the mixup graph of a training step for every solver, the former path being
+    two 'inverse' calls, with the max |A - A_former| against it.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    for batch_size in batch_sizes:
+        x = torch.randn(2, batch_size, dim, generator=generator)
+        x[1] = 0.7 * x[0] + 0.3 * x[1]
+        x.requires_grad_()
+        former = GraphGenerator(thresh='no', solver='inverse')
+        reference = torch.stack([former.get_graph(v) for v in x.detach()])
+        for solver in ['inverse', 'cholesky', 'woodbury', 'auto']:
+            graph_generator = GraphGenerator(thresh='no', solver=solver)
+
+            def step():
+                if solver == 'inverse':
+                    A = torch.stack([graph_generator.get_graph(v) for v in x])
+                else:
+                    A = torch.stack(graph_generator.get_graphs(x[0], x[1]))
+                A.square().sum().backward()
+                return A.detach()
+
+            A = step()
+            start = time.time()
+            for _ in range(steps):
+                x.grad = None
+                step()
+            cost = (time.time() - start) / steps
+            diff = (A - reference).abs().max().item()
+            print(f"B={batch_size:5d}, d={dim}, {solver:>8}: {cost * 1e3:8.2f} ms/step, max |A - former| {diff:.1e}")
+
+
+def benchmark_sparse_graph(batch_sizes=(256, 512, 1024, 2048, 4096), dim=128, topk=10, gnn_type='gcn',
+                           dense_max=2048, steps=3, seed=0):
+    """
+    Forward + backward time and activations saved for backward of the graph and one gnn layer on it, dense against
+    topk sparse, up to dense_max nodes for the dense graph.
+    """
+    from utils.mem_utils import saved_bytes
+    from flcore.trainmodel.graph_models import GCNLayer, GAT
+
+    torch.manual_seed(seed)
+    gnn = GCNLayer(dim, dim) if gnn_type == 'gcn' else GAT(dim, dim, 1, 0.)
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, dim, requires_grad=True)
+        for k in [0, topk]:
+            if not k and batch_size > dense_max:
+                continue
+            graph_generator = GraphGenerator(thresh='no', topk=k)
+
+            def step():
+                return gnn(x, graph_generator.get_graph(x)).square().sum()
+
+            loss, saved = saved_bytes(step)
+            loss.backward()
+            start = time.time()
+            for _ in range(steps):
+                x.grad = None
+                step().backward()
+            cost = (time.time() - start) / steps
+            print(f"B={batch_size:5d}, {gnn_type}, {f'top{k}' if k else 'dense':>6}: {cost * 1e3:8.1f} ms/step, "
+                  f"saved for backward {saved / 2 ** 20:7.1f} MB")
+
+
+def benchmark_view_graphs(batch_sizes=(128, 256), dim=512, steps=5, seed=0):
+    """
+    Forward + backward time and activations saved for backward of the graph step of ClientSphereGAug.train_graph for
+    every get_view_graphs mode: the graph(s) of two views, a batch-norm GCN on them and the InfoNCE between the views.
+    """
+    from flcore.losses.btLoss import ViewInfoNCE
+    from utils.mem_utils import saved_bytes
+    from flcore.trainmodel.graph_models import GCN
+
+    torch.manual_seed(seed)
+    gnn = GCN(dim, dim, graph_hops=1, dropout=0.2, batch_norm=True)
+    info_nce = ViewInfoNCE()
+    graph_generator = GraphGenerator(thresh='no')
+    for batch_size in batch_sizes:
+        x = F.normalize(torch.randn(2, batch_size, dim), dim=-1)
+        x[1] = F.normalize(x[0] + 0.5 * x[1], dim=-1)
+        x.requires_grad_()
+        for views in ['joint', 'per_view', 'bipartite']:
+
+            def step():
+                S = torch.matmul(x[0], x[1].t()) if views == 'bipartite' else None
+                graphs = graph_generator.get_view_graphs(x[0], x[1], views, S)
+                Z = F.normalize(torch.cat([gnn(nodes, A) for nodes, A in graphs]), dim=-1)
+                return info_nce(Z[:batch_size], Z[batch_size:])
+
+            loss, saved = saved_bytes(step)
+            loss.backward()
+            start = time.time()
+            for _ in range(steps):
+                x.grad = None
+                step().backward()
+            cost = (time.time() - start) / steps
+            print(f"B={batch_size:4d}, d={dim}, {views:>9}: {cost * 1e3:7.1f} ms/step, "
+                  f"saved for backward {saved / 2 ** 20:6.1f} MB")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    benchmark_graph()
+    benchmark_sparse_graph(gnn_type='gcn')
+    benchmark_sparse_graph(gnn_type='gat', dense_max=1024)
+    benchmark_view_graphs()
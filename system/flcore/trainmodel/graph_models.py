@@ -1,6 +1,5 @@
 from torch import nn
 from .graph_utils import *
-from torch_scatter import scatter_max, scatter_add, scatter_mean
 
 import torch.nn.functional as F
 import torch
@@ -130,20 +129,10 @@ class GNNReID(nn.Module):
 
 
     def _build_GNN_Net(self, embed_dim: int = 2048):
-        # init aggregator
-        if self.gnn_params['aggregator'] == "add":
-            self.aggr = lambda out, row, dim, x_size: scatter_add(out, row,
-                                                                  dim=dim,
-                                                                  dim_size=x_size)
-        if self.gnn_params['aggregator'] == "mean":
-            self.aggr = lambda out, row, dim, x_size: scatter_mean(out,
-                                                                   row,
-                                                                   dim=dim,
-                                                                   dim_size=x_size)
-        if self.gnn_params['aggregator'] == "max":
-            self.aggr = lambda out, row, dim, x_size: scatter_max(out, row,
-                                                                  dim=dim,
-                                                                  dim_size=x_size)
+        # init aggregator, fused into the edge attention of every layer
+        if self.gnn_params['aggregator'] not in ("add", "mean", "max"):
+            raise NotImplementedError
+        self.aggr = self.gnn_params['aggregator']
 
         gnn = GNNNetwork(embed_dim, self.aggr,
                          self.gnn_params, self.gnn_params['num_layers'])
@@ -204,8 +193,9 @@ class GNNNetwork(nn.Module):
 
     def forward(self, feats, edge_index, edge_attr):
         out = list()
+        edges = CSREdges(edge_index, feats.size(0))  # sorted once for all layers
         for layer in self.layers:
-            feats, egde_index, edge_attr = layer(feats, edge_index, edge_attr)
+            feats, _, edge_attr = layer(feats, edges, edge_attr)
             out.append(feats)
         return out, edge_index, edge_attr
 
@@ -215,6 +205,7 @@ class MultiHeadDotProduct(nn.Module):
     Multi head attention like in transformers
     embed_dim: dimension of input embedding
     nhead: number of attention heads
+    aggr: 'add', 'mean' or 'max' for the fused edge_attention, or an aggregation function out, row, dim, x_size
     """
 
     def __init__(self, embed_dim, nhead, aggr, dropout=0.1, mult_attr=0):
@@ -258,6 +249,11 @@ class MultiHeadDotProduct(nn.Module):
         return feats  # , edge_index, edge_attr
 
     def _attention(self, q, k, v, edge_index=None, edge_attr=None, bs=None):
+        if isinstance(self.aggr, str):
+            edges = edge_index if isinstance(edge_index, CSREdges) else CSREdges(edge_index, bs)
+            return edge_attention(q / math.sqrt(self.hdim), k, v, edges, self.aggr,
+                                  edge_attr if self.mult_attr else None, self.dropout)
+
         r, c, e = edge_index[:, 0], edge_index[:, 1], edge_index.shape[0]
 
         scores = torch.matmul(
@@ -345,10 +341,46 @@ class DotAttentionLayer(nn.Module):
 
 
 
+def drop_edges(adj, rate, training=True):
+    """
+    Edge dropout of a dense or sparse COO adjacency: every edge is dropped with probability rate and the kept ones are
+    scaled by 1 / (1 - rate). The dropped edges of a sparse adj are removed, so the next hop runs on fewer edges.
+    """
+    if not training or rate == 0:
+        return adj
+    if not adj.is_sparse:
+        return F.dropout(adj, rate)
+    adj = adj.coalesce()
+    keep = torch.rand(adj._nnz(), device=adj.device) >= rate
+    return torch.sparse_coo_tensor(adj.indices()[:, keep], adj.values()[keep] / (1 - rate), adj.shape,
+                                   check_invariants=False, is_coalesced=True)
+
+
+def linear_propagation(x, adjs, weights):
+    """
+    adjs[-1] ... adjs[0] x weights[0] ... weights[-1], the hops of a GCN without nonlinearity (SGC):
+    A(...A(x W_1)...)W_h = A^h x W_1...W_h. A dense 2-d chain goes to torch.linalg.multi_dot, which picks the
+    cheapest order (e.g. A(Ax) or (AA)x, (xW_1)W_2 or x(W_1W_2)); sparse adjacencies propagate x one hop at a time.
+    """
+    if x.dim() == 2 and not any(adj.is_sparse for adj in adjs):
+        return torch.linalg.multi_dot(adjs[::-1] + [x] + weights)
+    for adj in adjs:
+        x = torch.sparse.mm(adj, x) if adj.is_sparse else torch.matmul(adj, x)
+    for weight in weights:
+        x = torch.matmul(x, weight)
+    return x
+
+
 class GCN(nn.Module):
-    def __init__(self, nfeat, nhid, graph_hops, dropout, batch_norm=False):
+    def __init__(self, nfeat, nhid, graph_hops, dropout, batch_norm=False, edge_dropout_rate=0., fuse=True,
+                 legacy_hops=False):
         super(GCN, self).__init__()
         self.dropout = dropout
+        # the former forward skipped the last layer: graph_hops - 1 layers, graph_hops = 1 being the identity
+        self.legacy_hops = legacy_hops
+        self.batch_norm = batch_norm
+        self.edge_dropout_rate = edge_dropout_rate
+        self.fuse = fuse  # SGC-style propagation whenever the hops are linear, see fused
 
         self.graph_encoders = nn.ModuleList()
         self.graph_encoders.append(GCNLayer(nfeat, nhid, batch_norm=batch_norm))
@@ -356,9 +388,23 @@ class GCN(nn.Module):
         for _ in range(graph_hops-1):
             self.graph_encoders.append(GCNLayer(nhid, nhid, batch_norm=batch_norm))
 
+    def encoders(self):
+        return self.graph_encoders[:-1] if self.legacy_hops else self.graph_encoders
+
+    def fused(self):
+        """Without batch norm, bias and active dropout between the layers the hops are linear."""
+        return (self.fuse and not self.batch_norm and (self.dropout == 0 or not self.training)
+                and all(encoder.bias is None for encoder in self.graph_encoders))
+
     def forward(self, x, node_anchor_adj):
-        for i, encoder in enumerate(self.graph_encoders[:-1]):
-            x = encoder(x, node_anchor_adj)
+        encoders = self.encoders()
+        if len(encoders) == 0:
+            return x
+        adjs = [drop_edges(node_anchor_adj, self.edge_dropout_rate, self.training) for _ in encoders]
+        if self.fused():
+            return linear_propagation(x, adjs, [encoder.weight for encoder in encoders])
+        for encoder, adj in zip(encoders, adjs):
+            x = encoder(x, adj)
             # x = F.relu(encoder(x, node_anchor_adj))
             x = F.dropout(x, self.dropout, training=self.training)
         return x
@@ -384,7 +430,7 @@ class GCNLayer(nn.Module):
 
     def forward(self, input, adj, batch_norm=True):
         support = torch.matmul(input, self.weight)  # careful 是谁乘以谁
-        output = torch.matmul(adj, support)
+        output = torch.sparse.mm(adj, support) if adj.is_sparse else torch.matmul(adj, support)
 
         if self.bias is not None:
             output = output + self.bias
@@ -414,18 +460,6 @@ class GNN(nn.Module):
         # self.gcn= GraphAttentionLayer(self.input_size, self.input_size, dropout=0.5, alpha=0.2, concat=True)
         self.dropout = nn.Dropout(p=dropout)
 
-    def _sparse_dropout(self, x, rate=0.5):
-        noise_shape = x._nnz()  # note 针对sparse 会有的# of zeros todo 我这里没有用sparse 那一套,改为正常的size()/.shape
-        random_tensor = rate
-        random_tensor += torch.rand(noise_shape).tp(x.device)
-        dropout_mask = torch.floor(random_tensor).type(torch.bool)
-        i = x._indices()
-        v = x._values()
-        i = i[:, dropout_mask]
-        v = v[dropout_mask]
-        out = torch.sparse.FloatTensor(i, v, x.shape).to(x.device)
-        return out * (1. / (1 - rate))
-
     def forward(self, hidden, A, edge_dropout=False, msg_dropout=False):
         '''
         :param A:
@@ -438,7 +472,7 @@ class GNN(nn.Module):
 
         for i in range(self.step):
             # update satellite
-            A_ = self._sparse_dropout(A, self.edge_dropout_rate) if edge_dropout else A
+            A_ = drop_edges(A, self.edge_dropout_rate, self.training) if edge_dropout else A
             agg_embed = self.gcn(agg_embed, A_, self.batch_norm)
             # agg_embed = self.gcn(agg_embed, A_)
             if msg_dropout:
@@ -449,6 +483,36 @@ class GNN(nn.Module):
 
 
 
+def gat_attention(Wh, a, adj, alpha):
+    """
+    GAT attention of H heads at once, Wh [H, N, F'] and a [H, 2F'] (the a_T weights). The score of the pair
+    (Wh_i || Wh_j) is a_1 . Wh_i + a_2 . Wh_j, so the [H, N, N] scores are the sum of two projections broadcast over
+    the pairs instead of a_T on the [N, N, 2F'] pair features, with one mask adj > 0 for all heads. A sparse adj
+    keeps its E edges only, the heads stacked as one block diagonal [HN, HN] matrix. Returns [H, N, F'].
+    """
+    H, N, F_ = Wh.shape
+    s1 = torch.matmul(Wh, a[:, :F_, None])  # [H, N, 1]
+    s2 = torch.matmul(Wh, a[:, F_:, None]).transpose(1, 2)  # [H, 1, N]
+
+    if adj.is_sparse:
+        # softmax over the edges of every row
+        adj = adj.coalesce()
+        r, c = adj.indices()[:, adj.values() > 0]
+        e = F.leaky_relu(s1[:, r, 0] + s2[:, 0, c], negative_slope=alpha)  # [H, E]
+        e_max = e.new_full((H, N), -float('inf')).scatter_reduce(1, r.expand(H, -1), e.detach(), 'amax')
+        e = (e - e_max[:, r]).exp()
+        e = e / e.new_zeros(H, N).index_add(1, r, e)[:, r]
+        offset = torch.arange(H, device=r.device).unsqueeze(1) * N
+        edges = torch.stack(((r + offset).flatten(), (c + offset).flatten()))
+        attn_scores = torch.sparse_coo_tensor(edges, e.flatten(), (H * N, H * N), check_invariants=False,
+                                              is_coalesced=True)
+        return torch.sparse.mm(attn_scores, Wh.reshape(H * N, F_)).view(H, N, F_)
+
+    e = F.leaky_relu(s1 + s2, negative_slope=alpha)  # [H, N, N]
+    attn_scores = F.softmax(e.masked_fill(adj <= 0, -1e18), dim=-1)  # [H, N, N]
+    return torch.matmul(attn_scores, Wh)  # [H, N, F']
+
+
 class Attention(nn.Module):
     # single head attention
     def __init__(self, in_features, out_features, alpha=0.1):
@@ -463,28 +527,8 @@ class Attention(nn.Module):
 
     def forward(self, h, adj):
         # h : a tensor with size [N, F] where N be a number of nodes and F be a number of features
-        N = h.size(0)
         Wh = self.W(h)  # h -> Wh : [N, F] -> [N, F']
-
-        # H1 : [N, N, F'], H2 : [N, N, F'], attn_input = [N, N, 2F']
-
-        # H1 = [[h1 h1 ... h1]   |  H2 = [[h1 h2 ... hN]   |   attn_input = [[h1||h1 h1||h2 ... h1||hN]
-        #       [h2 h2 ... h2]   |        [h1 h2 ... hN]   |                 [h2||h1 h2||h2 ... h2||hN]
-        #            ...         |             ...         |                         ...
-        #       [hN hN ... hN]]  |        [h1 h2 ... hN]]  |                 [hN||h1 hN||h2 ... hN||hN]]
-
-        H1 = Wh.unsqueeze(1).repeat(1, N, 1)
-        H2 = Wh.unsqueeze(0).repeat(N, 1, 1)
-        attn_input = torch.cat([H1, H2], dim=-1)
-
-        e = F.leaky_relu(self.a_T(attn_input).squeeze(-1), negative_slope=self.alpha)  # [N, N]
-
-        attn_mask = -1e18 * torch.ones_like(e)
-        masked_e = torch.where(adj > 0, e, attn_mask)
-        attn_scores = F.softmax(masked_e, dim=-1)  # [N, N]
-
-        h_prime = torch.mm(attn_scores, Wh)  # [N, F']
-
+        h_prime = gat_attention(Wh.unsqueeze(0), self.a_T.weight, adj, self.alpha)[0]  # [N, F']
         return F.elu(h_prime)  # [N, F']
 
 
@@ -493,29 +537,22 @@ class GraphAttentionLayer(nn.Module):
     def __init__(self, in_features, out_features, num_heads, alpha, concat=False):
         super(GraphAttentionLayer, self).__init__()
         self.concat = concat
+        self.alpha = alpha
         self.attentions = nn.ModuleList([Attention(in_features, out_features, alpha) for _ in range(num_heads)])
 
     def forward(self, input, adj):
-        # input (= X) : a tensor with size [N, F]
+        # input (= X) : a tensor with size [N, F], all heads in one batched op
+        W = torch.stack([attention.W.weight for attention in self.attentions])  # [H, F', F]
+        a = torch.cat([attention.a_T.weight for attention in self.attentions])  # [H, 2F']
+        Wh = torch.matmul(input, W.transpose(1, 2))  # [H, N, F']
+        outputs = F.elu(gat_attention(Wh, a, adj, self.alpha))  # [H, N, F']
 
         if self.concat:
             # concatenate
-            outputs = []
-            for attention in self.attentions:
-                outputs.append(attention(input, adj))
-
-            return torch.cat(outputs, dim=-1)  # [N, KF']
-
+            return outputs.transpose(0, 1).reshape(input.size(0), -1)  # [N, KF']
         else:
             # average
-            output = None
-            for attention in self.attentions:
-                if output == None:
-                    output = attention(input, adj)
-                else:
-                    output += attention(input, adj)
-
-            return output / len(self.attentions)  # [N, F']
+            return outputs.mean(dim=0)  # [N, F']
 
 
 class DotAttentionCleanLayer(nn.Module):
@@ -552,10 +589,7 @@ class GSAT(nn.Module):
     def __init__(self,nfeat, nhid, graph_hops, dropout):
         super(GSAT, self).__init__()
         self.dropout = dropout
-        aggr = lambda out, row, dim, x_size: scatter_mean(out,
-                                                          row,
-                                                          dim=dim,
-                                                          dim_size=x_size)
+        aggr = 'mean'
         self.graph_encoders = nn.ModuleList()
 
         for _ in range(graph_hops):
@@ -564,13 +598,20 @@ class GSAT(nn.Module):
 
     def forward(self, x, node_anchor_adj):
         edge_attr, edge_index= self._get_A(node_anchor_adj)
+        edges = CSREdges(edge_index, x.size(0))  # sorted once for all layers
 
         for i, encoder in enumerate(self.graph_encoders):
-            x, egde_index, edge_attr = encoder(x, edge_index, edge_attr)
+            x, _, edge_attr = encoder(x, edges, edge_attr)
             x = F.dropout(x, self.dropout, training=self.training)
         return x
 
     def _get_A(self, W, thresh=None):
+        if W.is_sparse:
+            W = W.coalesce()
+            A, W = W.indices().t(), W.values()
+            if thresh is not None:
+                A, W = A[W > thresh], W[W > thresh]
+            return W, A
         if thresh is not None:
             W  = torch.where(W > thresh, W, torch.tensor(0).float().to(W))
             A = torch.ones_like(W).where(W > thresh, torch.tensor(0).float().to(W))
@@ -598,4 +639,115 @@ class GAT(nn.Module):
             x = encoder(x, node_anchor_adj)
             # x = F.relu(encoder(x, node_anchor_adj))
             x = F.dropout(x, self.dropout, training=self.training)
-        return x
\ No newline at end of file
+        return x
+
+def benchmark_gat(sizes=(128, 256, 512, 1024), dim=128, num_heads=2, steps=5, seed=0):
+    """
+    Forward + backward time and activations saved for backward of a GraphAttentionLayer on the FedRANE graph, the
+    former pair concatenation per head against gat_attention, with the max |out - former|.
+    """
+    import time
+    from utils.mem_utils import saved_bytes
+    from flcore.trainmodel.graph_generator import GraphGenerator
+
+    def former(layer, h, adj):
+        outputs = []
+        for attention in layer.attentions:
+            Wh = attention.W(h)
+            N = Wh.size(0)
+            attn_input = torch.cat([Wh.unsqueeze(1).repeat(1, N, 1), Wh.unsqueeze(0).repeat(N, 1, 1)], dim=-1)
+            e = F.leaky_relu(attention.a_T(attn_input).squeeze(-1), negative_slope=attention.alpha)
+            attn_scores = F.softmax(torch.where(adj > 0, e, -1e18 * torch.ones_like(e)), dim=-1)
+            outputs.append(F.elu(torch.mm(attn_scores, Wh)))
+        return sum(outputs) / len(outputs)
+
+    torch.manual_seed(seed)
+    layer = GraphAttentionLayer(dim, dim, num_heads=num_heads, alpha=0.1)
+    for N in sizes:
+        h = torch.randn(N, dim, requires_grad=True)
+        adj = GraphGenerator(thresh='no').get_graph(h.detach())
+        outputs = {}
+        for name, fn in [('former', former), ('decomposed', lambda layer, h, adj: layer(h, adj))]:
+            out, saved = saved_bytes(lambda: fn(layer, h, adj))
+            outputs[name] = out.detach()
+            del out
+            start = time.time()
+            for _ in range(steps):
+                fn(layer, h, adj).square().sum().backward()
+            cost = (time.time() - start) / steps
+            diff = (outputs[name] - outputs['former']).abs().max().item()
+            print(f"N={N:5d}, {name:>10}: {cost * 1e3:8.1f} ms/step, saved for backward {saved / 2 ** 20:7.1f} MB, "
+                  f"max |out - former| {diff:.1e}")
+
+
+def benchmark_edge_attention(batch_sizes=(64, 128, 256), dim=512, num_heads=2, topk=10, steps=5, seed=0):
+    """
+    Forward + backward time and activations saved for backward of MultiHeadDotProduct with the former aggregation
+    function and with the fused edge_attention, on all pairs (GSAT) and on a topk edge set, with max |out - former|.
+    """
+    import time
+    from utils.mem_utils import saved_bytes
+    from flcore.trainmodel.graph_generator import GraphGenerator
+
+    torch.manual_seed(seed)
+    fused = MultiHeadDotProduct(dim, num_heads, 'add', dropout=0.)
+    former = MultiHeadDotProduct(dim, num_heads, lambda out, row, dim, x_size: out.new_zeros(
+        out.shape[:dim] + (x_size,) + out.shape[dim + 1:]).index_add(dim, row, out), dropout=0.)
+    former.load_state_dict(fused.state_dict())
+    for batch_size in batch_sizes:
+        feats = torch.randn(batch_size, dim, requires_grad=True)
+        for name, k in [('all pairs', 0), (f'top{topk}', topk)]:
+            adj = GraphGenerator(thresh='no', topk=k).get_graph(feats.detach())
+            edge_index = adj.coalesce().indices().t() if k else torch.nonzero(torch.ones_like(adj))
+            outputs = {}
+            for att_name, att in [('former', former), ('fused', fused)]:
+                out, saved = saved_bytes(lambda: att(feats, edge_index, None))
+                outputs[att_name] = out.detach()
+                del out
+                start = time.time()
+                for _ in range(steps):
+                    att(feats, edge_index, None).square().sum().backward()
+                cost = (time.time() - start) / steps
+                diff = (outputs[att_name] - outputs['former']).abs().max().item()
+                print(f"B={batch_size:4d}, {name:>9} ({edge_index.shape[0]:6d} edges), {att_name:>6}: "
+                      f"{cost * 1e3:7.1f} ms/step, saved for backward {saved / 2 ** 20:6.1f} MB, "
+                      f"max |out - former| {diff:.1e}")
+
+
+def benchmark_gcn(hops=(1, 2, 3, 4), batch_sizes=(128, 256), dim=512, topk=10, steps=5, seed=0):
+    """
+    Forward + backward time and activations saved for backward of a linear GCN (no batch norm, no dropout) layer by
+    layer and with the fused linear_propagation, on the dense and on a topk FedRANE graph, with max |out - layered|.
+    """
+    import time
+    from utils.mem_utils import saved_bytes
+    from flcore.trainmodel.graph_generator import GraphGenerator
+
+    for num_hops in hops:
+        torch.manual_seed(seed)
+        fused = GCN(dim, dim, graph_hops=num_hops, dropout=0.)
+        layered = GCN(dim, dim, graph_hops=num_hops, dropout=0., fuse=False)
+        layered.load_state_dict(fused.state_dict())
+        for batch_size in batch_sizes:
+            feats = torch.randn(batch_size, dim, requires_grad=True)
+            for name, k in [('dense', 0), (f'top{topk}', topk)]:
+                adj = GraphGenerator(thresh='no', topk=k).get_graph(feats)
+                outputs = {}
+                for gcn_name, gcn in [('layered', layered), ('fused', fused)]:
+                    out, saved = saved_bytes(lambda: gcn(feats, adj))
+                    outputs[gcn_name] = out.detach()
+                    del out
+                    start = time.time()
+                    for _ in range(steps):
+                        gcn(feats, adj).square().sum().backward(retain_graph=True)
+                    cost = (time.time() - start) / steps
+                    diff = (outputs[gcn_name] - outputs['layered']).abs().max().item()
+                    print(f"hops={num_hops}, B={batch_size:4d}, {name:>5}, {gcn_name:>7}: {cost * 1e3:7.1f} ms/step, "
+                          f"saved for backward {saved / 2 ** 20:6.1f} MB, max |out - layered| {diff:.1e}")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    benchmark_gat()
+    benchmark_edge_attention()
+    benchmark_gcn()
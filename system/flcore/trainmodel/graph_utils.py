@@ -1,6 +1,5 @@
 from torch import nn
 import torch
-from torch_scatter import scatter_max, scatter_add
 import numpy as np
 import logging
 import math
@@ -168,9 +167,76 @@ def weights_init_classifier(m):
 
 
 def softmax(src, index, dim, dim_size, margin: float = 0.):
-    src_max = torch.clamp(scatter_max(src.float(), index, dim=dim, dim_size=dim_size)[0], min=0.).to(src)
+    shape = list(src.shape)
+    shape[dim] = dim_size
+    expanded = index.view([-1 if d == dim % src.dim() else 1 for d in range(src.dim())]).expand_as(src)
+    # the zeros clamp the segment max at 0 and fill the empty segments
+    src_max = src.new_zeros(shape, dtype=torch.float).scatter_reduce(dim, expanded, src.float(), 'amax').to(src)
     src = (src - src_max.index_select(dim=dim, index=index)).exp()
-    denom = scatter_add(src, index, dim=dim, dim_size=dim_size)
+    denom = src.new_zeros(shape).index_add(dim, index, src)
     out = src / (denom + (margin - src_max).exp()).index_select(dim, index)
 
     return out
+
+
+class CSREdges(object):
+    """
+    edge_index [E, 2] of edges (source r -> target c) sorted by target once, so every layer of a network reuses the
+    CSR ordering: the sorted r and c, the permutation of the edge attributes and the in-degree of every node.
+    """
+
+    def __init__(self, edge_index, num_nodes):
+        r, c = edge_index[:, 0], edge_index[:, 1]
+        key = c * num_nodes + r
+        key, self.order = key.sort()
+        self.r, self.c = r[self.order], c[self.order]
+        self.num_nodes = num_nodes
+        self.num_edges = edge_index.shape[0]
+        self.degree = torch.bincount(self.c, minlength=num_nodes)
+        self.unique = bool((key[1:] != key[:-1]).all())
+        # all pairs or close: dense [N, N] scores and aggregation instead of per edge gathers
+        self.dense = self.unique and self.num_edges * 4 > num_nodes ** 2
+
+    def edge_attr(self, edge_attr):
+        return edge_attr[self.order]
+
+
+def edge_attention(q, k, v, edges, aggr='add', edge_attr=None, dropout=None):
+    """
+    Fused attention over the edges of a CSREdges, for heads q, k, v [H, N, d] already scaled: the scores q_c . k_r,
+    the segment softmax over the edges into every target c with the zero logit of softmax(), and the aggregation of
+    the messages score * v_r into c ('add', 'mean' or 'max'), as one sparse or dense matmul for all heads instead of
+    the [H, E, d] messages. Returns [H, N, d].
+    """
+    H, N, d = v.shape
+    r, c = edges.r, edges.c
+    if edges.dense:
+        scores = torch.matmul(q, k.transpose(1, 2))[:, c, r]  # H x E
+    else:
+        scores = (q.index_select(1, c) * k.index_select(1, r)).sum(-1)  # H x E
+    src_max = scores.new_zeros(H, N).scatter_reduce(1, c.expand(H, -1), scores.detach(), 'amax')  # >= 0
+    scores = (scores - src_max[:, c]).exp()
+    denom = scores.new_zeros(H, N).index_add(1, c, scores) + (-src_max).exp()
+    scores = scores / denom[:, c]
+    if dropout is not None:
+        scores = dropout(scores)
+    if edge_attr is not None:
+        scores = scores * edges.edge_attr(edge_attr)
+
+    if aggr == 'max':
+        messages = scores.unsqueeze(-1) * v.index_select(1, r)  # H x E x d
+        index = c.view(1, -1, 1).expand(H, -1, d)
+        return messages.new_zeros(H, N, d).scatter_reduce(1, index, messages, 'amax', include_self=False)
+    if edges.dense:
+        attn = scores.new_zeros(H, N * N).index_copy(1, c * N + r, scores).view(H, N, N)
+        out = torch.matmul(attn, v)
+    else:
+        # heads as one block diagonal [HN, HN] matrix
+        offset = torch.arange(H, device=r.device).unsqueeze(1) * N
+        index = torch.stack(((c + offset).flatten(), (r + offset).flatten()))
+        attn = torch.sparse_coo_tensor(index, scores.flatten(), (H * N, H * N), check_invariants=False,
+                                       is_coalesced=edges.unique)
+        out = torch.sparse.mm(attn, v.reshape(H * N, d)).view(H, N, d)
+    if aggr == 'mean':
+        out = out / edges.degree.clamp(min=1).to(out).view(1, -1, 1)
+    return out
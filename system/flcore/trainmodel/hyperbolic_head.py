@@ -0,0 +1,132 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from geoopt import PoincareBall
+
+from flcore.losses.costripletLoss import poincare_pairwise_dist
+
+
+def prototype_logits(x, weight, bias=None, out=None):
+    """
+    predictor(normalize(expmap0(x))) in one pass.
+    expmap0 only rescales x by tanh(sqrt(c)|x|) / (sqrt(c)|x|) > 0, and so does the projection into the ball, hence
+    normalize(expmap0(x)) = normalize(x) for any curvature, and the logits are one addmm on the normalized features.
+    """
+    z = F.normalize(x, p=2, dim=-1)
+    if bias is None:
+        return torch.mm(z, weight.t(), out=out)
+    return torch.addmm(bias, z, weight.t(), out=out)
+
+
+class HyperbolicPrototypeHead(nn.Module):
+    """
+    Inference head of the hyperbolic clients, with the class polars read from the predictor (args.predictor.weight)
+    and the manifold built once. The predictor is shared, not copied, so the head follows set_parameters and
+    fine-tuning of the model it was built from.
+
+    mode: 'cosine' for the logits expmap0 -> normalize -> predictor, 'distance' for the negative Poincare distances
+    of expmap0(x) to the polars, so the argmax is the nearest prototype. The distances are computed chunk_size
+    classes at a time.
+    """
+
+    def __init__(self, predictor, curvature=1., mode='cosine', chunk_size=1024):
+        super(HyperbolicPrototypeHead, self).__init__()
+        if mode not in ('cosine', 'distance'):
+            raise ValueError(f"unknown prediction mode {mode!r}, expected 'cosine' or 'distance'")
+        self.predictor = predictor
+        self.curvature = curvature
+        self.ball = PoincareBall(curvature)
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self._out = None
+
+    def expmap0(self, x):
+        """Points on the ball, only needed for visualization or distance-based prediction."""
+        return self.ball.expmap0(x)
+
+    def forward(self, x, reuse_output=False):
+        """
+        Float32 scores of the base features x. With reuse_output, the scores are written into a buffer kept across
+        calls, so they must be consumed before the next call; this is only done outside autograd.
+        """
+        weight, bias = self.predictor.weight, self.predictor.bias
+        out = None
+        if reuse_output and not torch.is_grad_enabled():
+            shape = (x.shape[0], weight.shape[0])
+            if self._out is None or self._out.shape != shape or self._out.device != weight.device \
+                    or self._out.is_inference() != torch.is_inference_mode_enabled():
+                self._out = weight.new_empty(shape)
+            out = self._out
+        x = x.to(weight.dtype)
+        if self.mode == 'distance':
+            dist = poincare_pairwise_dist(self.ball.expmap0(x), weight, self.curvature, chunk_size=self.chunk_size,
+                                          out=out)
+            return dist.neg_().float()
+        return prototype_logits(x, weight, bias, out=out).float()
+
+
+def benchmark_head(batch_size=256, dim=20, num_classes=100, curvature=1., num_batches=200, device="cpu"):
+    """Throughput of the former evaluation path against HyperbolicPrototypeHead on random features."""
+    predictor = nn.Linear(dim, num_classes).to(device)
+    predictor.weight.data = F.normalize(torch.randn(num_classes, dim, device=device), dim=-1)
+    predictor.bias.data.zero_()
+    predictor.requires_grad_(False)
+    head = HyperbolicPrototypeHead(predictor, curvature)
+    features = [torch.randn(batch_size, dim, device=device) for _ in range(num_batches)]
+
+    def former(x):
+        output_exp_map = PoincareBall(curvature).expmap0(x)
+        output_exp_map_norm = F.normalize(output_exp_map, dim=-1, p=2)
+        return predictor(output_exp_map_norm).float()
+
+    max_diff = max((former(x) - head(x)).abs().max().item() for x in features[:10])
+    with torch.no_grad():
+        for name, fn in [('former', former), ('head', lambda x: head(x, reuse_output=True))]:
+            start = time.time()
+            for x in features:
+                fn(x).max(1, keepdim=True)
+            cost = time.time() - start
+            print(f"{name:>8}: {num_batches * batch_size / cost:12.0f} samples/s")
+    print(f"max |logits diff|: {max_diff:.2e}")
+
+
+def benchmark_distance(batch_size=256, dim=20, num_classes=200, curvature=1., num_batches=50, chunk_size=1024,
+                       device="cpu"):
+    """The former repeat/reshape nearest-prototype prediction against the distance mode of the head."""
+    predictor = nn.Linear(dim, num_classes, bias=False).to(device)
+    predictor.weight.data = F.normalize(torch.randn(num_classes, dim, device=device), dim=-1) * 0.9
+    predictor.requires_grad_(False)
+    polars = predictor.weight.data
+    head = HyperbolicPrototypeHead(predictor, curvature, mode='distance', chunk_size=chunk_size)
+    ball = PoincareBall(curvature)
+    features = [torch.randn(batch_size, dim, device=device) for _ in range(num_batches)]
+
+    def former(x):
+        output_exp_map = ball.expmap0(x)
+        output_exp_map = output_exp_map.repeat(1, num_classes).reshape(x.shape[0], num_classes, polars.shape[1])
+        y_exp_map = polars.repeat(x.shape[0], 1).reshape(x.shape[0], num_classes, polars.shape[1])
+        return -ball.dist(output_exp_map, y_exp_map, dim=-1)
+
+    with torch.no_grad():
+        agree = sum((former(x).argmax(1) == head(x).argmax(1)).float().mean().item() for x in features) / num_batches
+        for name, fn, temp in [('former', former, 2 * batch_size * num_classes * dim),
+                               ('head', lambda x: head(x, reuse_output=True), batch_size * min(chunk_size, num_classes))]:
+            start = time.time()
+            for x in features:
+                fn(x).argmax(1)
+            cost = time.time() - start
+            print(f"{name:>8}: {num_batches * batch_size / cost:12.0f} samples/s, "
+                  f"largest temporary ~{temp * 4 / 1024:.0f} KB")
+    print(f"same prediction: {agree:.4f}")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    for batch_size in [64, 256, 1024]:
+        print(f"batch size {batch_size}")
+        benchmark_head(batch_size=batch_size)
+    for num_classes in [200, 1000]:
+        print(f"{num_classes} classes, batch size 256")
+        benchmark_distance(num_classes=num_classes)
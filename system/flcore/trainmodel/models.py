@@ -25,6 +25,8 @@ class LocalGModel(nn.Module):
         super(LocalGModel, self).__init__()
         self.base = base
         self.graph_generator = graph_generator
+        # a learnt similarity of the graph generator is trained, moved and aggregated with the model
+        self.similarity = graph_generator.similarity
         self.gnn = gnn
         self.predictor = predictor
         self.alpha= alpha
@@ -32,12 +34,12 @@ class LocalGModel(nn.Module):
 
     def forward(self, x):
         out = self.base(x)
-        A = self.model.graph_generator.get_graph(out)
-        preds, Z1_aug = self.model.gnn(out, A)  # careful 把preds 利用起来
+        A = self.graph_generator.get_graph(out)
+        Z1_aug = F.normalize(self.gnn(out, A), dim=-1)
         # Z1_edge_attr, Z1_edge_index, Z1_aug = self.graph_generator.get_graph(out)
         # preds, Z1_aug = self.gnn(Z1_aug, Z1_edge_index) # careful 把preds 利用起来
         # preds, Z1_aug = self.gnn(Z1_aug, Z1_edge_index, Z1_edge_attr, self.output_train_gnn) # careful 把preds 利用起来
-        out = self.alpha* out +(1-self.alpha)*Z1_aug[-1]  # careful
+        out = self.alpha* out +(1-self.alpha)*Z1_aug  # careful
         out = self.predictor(out)
         return out
 
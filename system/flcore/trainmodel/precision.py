@@ -0,0 +1,100 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class PrecisionPolicy(object):
+    """
+    Where lower precision is allowed during training. With mode 'bf16' only the base forward runs under bfloat16
+    autocast (its backward follows the same dtypes), and its outputs are cast back to float32, so expmap0, the
+    Poincare distances / arcosh and the loss reductions after it stay in float32. 'fp32' changes nothing.
+    """
+
+    def __init__(self, mode='fp32', device='cpu'):
+        if mode not in ('fp32', 'bf16'):
+            raise NotImplementedError
+        self.mode = mode
+        self.enabled = mode == 'bf16'
+        self.device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=torch.bfloat16, enabled=self.enabled)
+
+    def __call__(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) under autocast, with the output tensor (or tuple of tensors) back in float32."""
+        if not self.enabled:
+            return fn(*args, **kwargs)
+        with self.autocast():
+            out = fn(*args, **kwargs)
+        if isinstance(out, tuple):
+            return tuple(o.float() for o in out)
+        return out.float()
+
+
+def benchmark_precision(num_classes=10, dim=20, batch_size=64, steps=100, image_size=32, seed=0, lr=0.05):
+    """
+    Trains the same ResNet-8 base with the hyperbolic triplet loss on synthetic class-conditional images in fp32 and
+    in bf16 from one seed, then reports the step time, the activations saved for backward and the test accuracy.
+    """
+    from geoopt import PoincareBall
+    from flcore.trainmodel.resnet import resnet8
+    from flcore.trainmodel.hyperbolic_head import HyperbolicPrototypeHead
+    from flcore.losses.costripletLoss import PoincareTripletLoss, PrototypeTable
+    from utils.mem_utils import saved_bytes
+
+    generator = torch.Generator().manual_seed(seed)
+    means = torch.randn(num_classes, 3, image_size, image_size, generator=generator)
+
+    def sample(num):
+        y = torch.randint(num_classes, (num,), generator=generator)
+        return means[y] + 4 * torch.randn(num, 3, image_size, image_size, generator=generator), y
+
+    train_data = [sample(batch_size) for _ in range(steps)]
+    test_x, test_y = sample(512)
+    y_negs = [(y + torch.randint(1, num_classes, y.shape, generator=generator)) % num_classes for _, y in train_data]
+
+    torch.manual_seed(seed)
+    init = resnet8(num_classes=dim).state_dict()
+    predictor = nn.Linear(dim, num_classes)
+    predictor.weight.data = F.normalize(torch.randn(num_classes, dim, generator=generator), dim=-1) * 0.9
+    predictor.bias.data.zero_()
+    predictor.requires_grad_(False)
+    ball = PoincareBall(1.)
+    criterion = PoincareTripletLoss(ball, margin=1., prototypes=PrototypeTable(predictor.weight.data, 1.))
+    head = HyperbolicPrototypeHead(predictor, 1.)
+
+    preds = {}
+    for mode in ['fp32', 'bf16']:
+        policy = PrecisionPolicy(mode)
+        base = resnet8(num_classes=dim)
+        base.load_state_dict(init)
+        base.train()
+        optimizer = torch.optim.SGD(base.parameters(), lr=lr, momentum=0.9)
+
+        def step(x, y, y_neg):
+            z = ball.expmap0(policy(base, x))
+            return criterion(z, y, y_neg).mean()
+
+        _, saved = saved_bytes(lambda: step(train_data[0][0], train_data[0][1], y_negs[0]))
+        start = time.time()
+        for (x, y), y_neg in zip(train_data, y_negs):
+            optimizer.zero_grad()
+            loss = step(x, y, y_neg)
+            loss.backward()
+            optimizer.step()
+        cost = (time.time() - start) / steps
+
+        base.eval()
+        with torch.inference_mode():
+            preds[mode] = head(base(test_x)).argmax(dim=1)
+        acc = (preds[mode] == test_y).float().mean().item()
+        print(f"{mode}: {cost * 1e3:7.1f} ms/step, {batch_size / cost:7.1f} samples/s, "
+              f"saved for backward {saved / 2 ** 20:6.1f} MB, last loss {loss.item():.4f}, test acc {acc:.4f}")
+    print(f"same test prediction: {(preds['fp32'] == preds['bf16']).float().mean().item():.4f}")
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    benchmark_precision()
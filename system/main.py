@@ -22,9 +22,10 @@ from flcore.servers.serverFedRANEAug import FedRANEAug
 from flcore.trainmodel.models import *
 from flcore.trainmodel.resnet import *
 from flcore.trainmodel.graph_models import GNNReID, GCN, GAT,GSAT
-from flcore.trainmodel.graph_generator import GraphGenerator
+from flcore.trainmodel.graph_generator import GraphGenerator, LEARNT_SIMILARITIES
 
 from utils.mem_utils import MemReporter
+from utils.prototypes import load_prototypes
 
 # from utils.plot import plot_result
 
@@ -156,7 +157,8 @@ def run():
 
             args.predictor.weight.data = torch.from_numpy(
 
-                np.load(args.hyperbolic_proto_dir.format(args.HyperbolicFed_dim, args.num_classes))).float().to(
+                load_prototypes(args.hyperbolic_proto_dir.format(args.HyperbolicFed_dim, args.num_classes),
+                                args.HyperbolicFed_dim, args.num_classes)).float().to(
 
                 args.device) * args.mult_slope
 
@@ -176,7 +178,8 @@ def run():
 
             # todo tammes opt every moment
             classpolars = torch.from_numpy(
-                np.load(args.hyperbolic_proto_dir.format(args.HyperbolicFed_dim, args.num_classes))).float().to(
+                load_prototypes(args.hyperbolic_proto_dir.format(args.HyperbolicFed_dim, args.num_classes),
+                                args.HyperbolicFed_dim, args.num_classes)).float().to(
                 args.device) * args.mult_slope
             # calculate radius of ball
             radius = 1. / math.sqrt(args.curvature)
@@ -189,15 +192,20 @@ def run():
             server = HyperbolicFed(args, i)
         elif args.algorithm == "FedRANE":
             graph_gen_config = {
-                'sim_type': 'correlation',
+                'sim_type': args.graph_sim,
                 'thresh': 'no',  # 0
                 'set_negative': 'hard',
+                'topk': args.graph_topk,
             }
+            if args.graph_sim == 'learnt':
+                graph_gen_config['similarity'] = LEARNT_SIMILARITIES[args.learnt_sim](args.model.fc.in_features)
             graph_generator = GraphGenerator(**graph_gen_config)
 
             if args.gnn_type == "gcn":
+                sgc = args.gcn_propagation == 'sgc'  # linear hops, fused with the weights
                 gnn = GCN(args.model.fc.in_features, args.model.fc.in_features, graph_hops=args.graph_n_hops,
-                          dropout=0.2, batch_norm=True)
+                          dropout=0. if sgc else 0.2, batch_norm=not sgc, edge_dropout_rate=args.gcn_edge_dropout,
+                          fuse=sgc, legacy_hops=args.gcn_layers == 'legacy')
             elif args.gnn_type == "gat":
                 gnn = GAT(args.model.fc.in_features, args.model.fc.in_features, graph_hops=args.graph_n_hops,
                           dropout=0.2)
@@ -217,15 +225,20 @@ def run():
 
         elif args.algorithm == "FedRANEAug":
             graph_gen_config = {
-                'sim_type': 'correlation',
+                'sim_type': args.graph_sim,
                 'thresh': 'no',  # 0
                 'set_negative': 'hard',
+                'topk': args.graph_topk,
             }
+            if args.graph_sim == 'learnt':
+                graph_gen_config['similarity'] = LEARNT_SIMILARITIES[args.learnt_sim](args.model.fc.in_features)
             graph_generator = GraphGenerator(**graph_gen_config)
 
             if args.gnn_type == "gcn":
+                sgc = args.gcn_propagation == 'sgc'  # linear hops, fused with the weights
                 gnn = GCN(args.model.fc.in_features, args.model.fc.in_features, graph_hops=args.graph_n_hops,
-                          dropout=0.2, batch_norm=True)
+                          dropout=0. if sgc else 0.2, batch_norm=not sgc, edge_dropout_rate=args.gcn_edge_dropout,
+                          fuse=sgc, legacy_hops=args.gcn_layers == 'legacy')
             elif args.gnn_type == "gat":
                 gnn = GAT(args.model.fc.in_features, args.model.fc.in_features, graph_hops=args.graph_n_hops,
                           dropout=0.2)
@@ -265,6 +278,8 @@ if __name__ == "__main__":
     parser.add_argument('-dev', "--device", type=str, default="cuda",
                         choices=["cpu", "cuda"])
     parser.add_argument('-did', "--device_id", type=str, default="1")
+    parser.add_argument('-prec', "--precision", type=str, default="fp32", choices=["fp32", "bf16"],
+                        help="bf16 autocast for the base forward of the hyperbolic, MGDA and FedRANE clients")
     parser.add_argument('-data', "--dataset", type=str, default="cifar10")
     parser.add_argument('-nb', "--num_classes", type=int, default=10)
     parser.add_argument('-m', "--model", type=str, default="dnn")
@@ -334,14 +349,44 @@ if __name__ == "__main__":
 
     parser.add_argument('-testpm', "--test_pm", type=bool, default=False,
                         help="Use the distribution probability to test")
+    parser.add_argument('-pred_mode', "--prediction_mode", type=str, default="cosine",
+                        choices=["cosine", "distance"],
+                        help="hyperbolic prediction: cosine logits or distance to the nearest prototype")
+    parser.add_argument('-dv_bn', "--dual_view_bn", type=str, default="split",
+                        choices=["split", "joint", "separate"],
+                        help="clean and mixup views in one base forward with batch norm statistics per view (split) "
+                             "or over both views (joint), or one forward per view (separate)")
 
     # FedRANE
     parser.add_argument("-reg_graph_aug", "--reg_graph_aug", type=float, default=0.,
                         help="regularization on graph augmentation")
     parser.add_argument("-graph_n_hops", "--graph_n_hops", type=int, default=1, help="num of the gnn layers")
+    parser.add_argument("-gcn_layers", "--gcn_layers", type=str, default="legacy", choices=["legacy", "all"],
+                        help="gcn layers applied: 'legacy' skips the last one as the original code, so graph_n_hops 1 "
+                             "is the identity; 'all' applies graph_n_hops layers, required by -gcn_propagation sgc")
+    parser.add_argument("-gcn_propagation", "--gcn_propagation", type=str, default="layered",
+                        choices=["layered", "sgc"],
+                        help="'layered': batch norm and dropout after every gcn layer; 'sgc': linear gcn without "
+                             "them, A^h X W_1...W_h computed as one fused chain, needs -gcn_layers all")
+    parser.add_argument("-gcn_edge_dropout", "--gcn_edge_dropout", type=float, default=0.,
+                        help="edge dropout rate of the gcn adjacency, a fresh mask per hop")
+    parser.add_argument("-graph_topk", "--graph_topk", type=int, default=0,
+                        help="sparse graph of the topk neighbours per sample, 0 for the dense graph")
+    parser.add_argument("-graph_sim", "--graph_sim", type=str, default="correlation",
+                        choices=["correlation", "cosine", "learnt"], help="similarity of the FedRANE graph")
+    parser.add_argument("-learnt_sim", "--learnt_sim", type=str, default="bilinear", choices=["bilinear", "pair_mlp"],
+                        help="learnable similarity module of -graph_sim learnt, trained through the gcn edge weights")
+    parser.add_argument("-graph_views", "--graph_views", type=str, default="joint",
+                        choices=["joint", "per_view", "bipartite"],
+                        help="FedRANEAug graph of the two augmented views: one over both, one per view or "
+                             "cross-view only")
     parser.add_argument("-use_sam", "--use_sam", type=bool, default=False, help="control grad sharpness or not")
     parser.add_argument("-sam_rho", "--sam_rho", type=float, default=0.5, help="hyper-param for sam& asam ")
     parser.add_argument("-sam_eta", "--sam_eta", type=float, default=0.2, help="hyper-param for asam ")
+    parser.add_argument("-sam_k", "--sam_k", type=int, default=1,
+                        help="asam ascent every k steps, LookSAM reuse of its direction in between, 1 for every step")
+    parser.add_argument("-sam_alpha", "--sam_alpha", type=float, default=0.1,
+                        help="LookSAM weight of the reused sharpness direction (-sam_k > 1)")
     parser.add_argument("-info_nce_temperature", "--info_nce_temperature", type=float, default=0.8,
                         help="hyper-param for asam ")
     parser.add_argument('-aggregate_all', "--aggregate_all", type=bool, default=True,
@@ -350,6 +395,19 @@ if __name__ == "__main__":
     parser.add_argument('-gnn_type', "--gnn_type", type=str, default='gat',
                         help='gnn agumentation type: gcn, gat, gsat')
 
+    # conflict-averse aggregation
+    parser.add_argument('-mtm', "--multi_task_method", type=str, default="Nash",
+                        help="CAG, MGDA, PCG, Nash or AVG")
+    parser.add_argument('-cagrad_c', "--cagrad_c", type=float, default=0.5)
+    parser.add_argument('-agg_blocks', "--aggregation_blocks", type=str, default="none",
+                        choices=["none", "layer", "base", "chunk"],
+                        help="solve the aggregation weights per block: none, layer, base or chunk")
+    parser.add_argument('-agg_block_size', "--aggregation_block_size", type=int, default=2 ** 20,
+                        help="num of parameters per block for the chunk mode")
+    parser.add_argument('-grad_norm', "--grad_normalization", type=str, default=None,
+                        choices=["l2", "loss", "loss+", "none"],
+                        help="normalize the client updates before solving the weights: l2, loss, loss+ or none; "
+                             "defaults to l2 for MGDA and none for FedRANE")
 
     # few_shot learning
     parser.add_argument("-shot", "--shot", type=int, default=1)
@@ -359,6 +417,8 @@ if __name__ == "__main__":
 
     parser.add_argument("-fine_tuning_steps", "--fine_tuning_steps", type=int, default=10)
     args = parser.parse_args()
+    if args.gcn_propagation == 'sgc' and args.gcn_layers == 'legacy':
+        parser.error("-gcn_propagation sgc needs -gcn_layers all: the legacy layers drop the last hop")
     print(args)
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.device_id
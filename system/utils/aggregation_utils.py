@@ -0,0 +1,354 @@
+import math
+import time
+
+import cvxpy as cp
+import numpy as np
+import torch
+from scipy.optimize import minimize
+
+from utils.min_norm_solvers import MinNormSolver
+
+# number of parameters processed at once along the P dimension of a K x P update matrix
+CHUNK_SIZE = 2 ** 20
+# per-round statistics of AggregationContext.diagnostics, weighted_mean_norm only with sample weights
+AGGREGATION_DIAGNOSTICS = ('mean_cosine', 'min_cosine', 'conflict_ratio', 'mean_update_norm', 'weighted_mean_norm')
+
+
+def gram_matrix(updates, chunk_size=CHUNK_SIZE):
+    """
+    Inner products between the rows of a K x P update matrix.
+    The P dimension is processed in chunks, so no K x P temporary is ever allocated.
+    """
+    num_clients, dim = updates.shape
+    gram = updates.new_zeros(num_clients, num_clients)
+    for beg in range(0, dim, chunk_size):
+        chunk = updates[:, beg:beg + chunk_size]
+        gram.addmm_(chunk, chunk.t())
+    return gram
+
+
+def combine_updates(updates, weights, chunk_size=CHUNK_SIZE, out=None):
+    """
+    Weighted sum of the rows of a K x P update matrix, i.e. weights @ updates, written chunk by chunk into `out`.
+    """
+    dim = updates.shape[1]
+    weights = weights.to(device=updates.device, dtype=updates.dtype)
+    if out is None:
+        out = updates.new_empty(dim)
+    for beg in range(0, dim, chunk_size):
+        chunk = updates[:, beg:beg + chunk_size]
+        torch.mv(chunk.t(), weights, out=out[beg:beg + chunk.shape[1]])
+    return out
+
+
+def flatten_params(params, out):
+    """Copy the tensors in `params` one after another into the 1-D tensor `out`."""
+    beg = 0
+    for param in params:
+        numel = param.numel()
+        out[beg:beg + numel].copy_(param.data.reshape(-1))
+        beg += numel
+    return out
+
+
+def unflatten_params(flat, params):
+    """Inverse of flatten_params: copy consecutive slices of `flat` back into the tensors in `params`."""
+    beg = 0
+    for param in params:
+        numel = param.numel()
+        param.data.copy_(flat[beg:beg + numel].view_as(param))
+        beg += numel
+
+
+def pcgrad_weights(gram, rng=None, eps=1e-8):
+    """
+    PCGrad (Yu et al., 2020) solved in the span of the client updates.
+
+    Every projected update stays a linear combination of the original ones, g_i' = sum_k C[i, k] g_k, so the
+    sequential projections only need the K x K Gram matrix: <g_i', g_j> = (C @ G)[i, j].
+    Returns the weights w such that mean_i g_i' = w @ updates.
+    """
+    num_clients = gram.shape[0]
+    coef = torch.eye(num_clients, dtype=gram.dtype, device=gram.device)
+    if num_clients < 2:
+        return coef.mean(dim=0)
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # every client visits the other K-1 clients in its own random order
+    keys = rng.random((num_clients, num_clients))
+    np.fill_diagonal(keys, np.inf)
+    shuffled_task_indices = torch.from_numpy(np.argsort(keys, axis=1)[:, :-1].T.copy()).to(gram.device)
+
+    # same scaling as projecting onto g_j / (||g_j|| + eps)
+    sq_norms = (gram.diagonal().clamp_min(0).sqrt() + eps).pow(2)
+    rows = torch.arange(num_clients, device=gram.device)
+    for task_indices in shuffled_task_indices:
+        dot = (coef * gram[task_indices]).sum(dim=1)  # <g_i', g_{task_indices[i]}>
+        coef[rows, task_indices] -= torch.clamp_max(dot, 0) / sq_norms[task_indices]
+    return coef.mean(dim=0)
+
+
+def cagrad_weights(gram, sample_weights, cagrad_c, scale=100.):
+    """
+    CAGrad (Liu et al., 2021) from the Gram matrix of the client updates, which are divided by `scale` for the solver.
+    Returns the weights w such that (g0 + lmbda * gw) / (1 + lmbda) = w @ updates.
+    """
+    num_clients = gram.shape[0]
+    A = gram.detach().cpu().double().numpy() / scale ** 2
+    x_start = np.asarray(sample_weights, dtype=np.float64)
+    b = x_start.copy()
+    c = cagrad_c * np.sqrt(max(A.sum(), 0.)) / num_clients  # cagrad_c * ||g0||, g0 = mean of the updates
+    bnds = tuple((0, 1) for x in x_start)
+    cons = ({'type': 'eq', 'fun': lambda x: 1 - sum(x)})
+
+    def objfn(x):
+        return (x.reshape(1, num_clients).dot(A).dot(b.reshape(num_clients, 1)) +
+                c * np.sqrt(x.reshape(1, num_clients).dot(A).dot(x.reshape(num_clients, 1)) + 1e-8)).sum()
+
+    res = minimize(objfn, x_start, bounds=bnds, constraints=cons)
+    w = res.x
+    gw_norm = np.sqrt(max(w.dot(A).dot(w), 0.))
+    lmbda = c / (gw_norm + 1e-4)
+    return torch.from_numpy((1. / num_clients + lmbda * w) / (1 + lmbda)).to(gram)
+
+
+def mgda_weights(gram, sample_weights=None):
+    """Min-norm element of the convex hull of the client updates (Sener & Koltun, 2018)."""
+    sol, min_norm = MinNormSolver.find_min_norm_element_from_gram(gram.detach().cpu().numpy(), sample_weights)
+    return torch.from_numpy(np.asarray(sol, dtype=np.float64)).to(gram)
+
+
+class NashSolver:
+    """
+    Nash bargaining weights (Navon et al., 2022) for K client updates. The cvxpy problem is built once and the
+    previous solution is kept as the warm start of the next round, so keep one solver per parameter block.
+    """
+
+    def __init__(self, num_clients, optim_niter=20):
+        self.num_clients = num_clients
+        self.optim_niter = optim_niter
+        self.alpha_param = cp.Variable(shape=(num_clients,), nonneg=True)
+        self.prvs_alpha_param = cp.Parameter(
+            shape=(num_clients,), value=np.ones(num_clients, dtype=np.float32)
+        )
+        self.G_param = cp.Parameter(
+            shape=(num_clients, num_clients), value=np.eye(num_clients)
+        )
+        self.normalization_factor_param = cp.Parameter(
+            shape=(1,), value=np.array([1.0])
+        )
+        G_prvs_alpha = self.G_param @ self.prvs_alpha_param
+        prvs_phi_tag = 1 / self.prvs_alpha_param + (1 / G_prvs_alpha) @ self.G_param
+        self.phi_alpha = prvs_phi_tag @ (self.alpha_param - self.prvs_alpha_param)
+        self.prvs_alpha = np.ones(num_clients, dtype=np.float32)
+        G_alpha = self.G_param @ self.alpha_param
+        constraint = []
+        for i in range(num_clients):
+            constraint.append(
+                -cp.log(self.alpha_param[i] * self.normalization_factor_param)
+                - cp.log(G_alpha[i])
+                <= 0
+            )
+        obj = cp.Minimize(
+            cp.sum(G_alpha) + self.phi_alpha / self.normalization_factor_param
+        )
+        self.prob = cp.Problem(obj, constraint)
+
+    def stop_criteria(self, gtg, alpha_t):
+        return (
+                (self.alpha_param.value is None)
+                or (np.linalg.norm(gtg @ alpha_t - 1 / (alpha_t + 1e-10)) < 1e-3)
+                or (np.linalg.norm(self.alpha_param.value - self.prvs_alpha_param.value) < 1e-6)
+        )
+
+    def solve_optimization(self, gtg, alpha_t):
+        self.G_param.value = gtg
+        self.normalization_factor_param.value = self.normalization_factor
+
+        for _ in range(self.optim_niter):
+            self.alpha_param.value = alpha_t
+            self.prvs_alpha_param.value = alpha_t
+            try:
+                self.prob.solve(solver=cp.ECOS, warm_start=True, max_iters=100)
+            except:
+                self.alpha_param.value = self.prvs_alpha_param.value
+            if self.stop_criteria(gtg, alpha_t):
+                break
+            alpha_t = self.alpha_param.value
+
+        if alpha_t is not None:
+            self.prvs_alpha = alpha_t
+        return self.prvs_alpha
+
+    def weights(self, gram, sample_weights):
+        GTG = gram.detach()
+        self.normalization_factor = (
+            torch.norm(GTG).cpu().numpy().reshape((1,))
+        )
+        GTG = GTG / self.normalization_factor.item()
+        alpha = self.solve_optimization(GTG.cpu().numpy(), np.asarray(sample_weights))
+        alpha = np.asarray(alpha, dtype=np.float64)
+        return torch.from_numpy(alpha / alpha.sum()).to(gram)
+
+
+def pcgrad(updates, rng=None, chunk_size=CHUNK_SIZE):
+    """
+    Averaged PCGrad update of the rows of a K x P matrix, computed with one Gram matrix and one weighted sum.
+    """
+    weights = pcgrad_weights(gram_matrix(updates, chunk_size), rng)
+    return combine_updates(updates, weights, chunk_size)
+
+
+def make_blocks(named_numels, mode="none", block_size=CHUNK_SIZE):
+    """
+    Partition the flattened parameters, given as (name, numel) pairs in flattening order, into (beg, end) blocks.
+
+    mode: 'none' for one global block, 'layer' for one block per module, 'base' for one block per child of the
+    top-level modules (base.conv1, base.layer1, ..., predictor) and 'chunk' for size-balanced chunks of about
+    block_size parameters.
+    """
+    total = sum(numel for _, numel in named_numels)
+    if mode == "none":
+        return [(0, total)]
+    elif mode == "chunk":
+        num_blocks = max(1, math.ceil(total / block_size))
+        bounds = np.linspace(0, total, num_blocks + 1).round().astype(int)
+        return [(int(beg), int(end)) for beg, end in zip(bounds[:-1], bounds[1:])]
+    elif mode == "layer":
+        key = lambda name: name.rsplit('.', 1)[0]
+    elif mode == "base":
+        key = lambda name: '.'.join(name.split('.')[:2]) if name.count('.') > 1 else name.split('.')[0]
+    else:
+        raise NotImplementedError
+
+    blocks = []
+    beg, prev_key = 0, None
+    for name, numel in named_numels:
+        if blocks and key(name) == prev_key:
+            blocks[-1] = (blocks[-1][0], beg + numel)
+        else:
+            blocks.append((beg, beg + numel))
+        prev_key = key(name)
+        beg += numel
+    return blocks
+
+
+class AggregationContext:
+    """
+    Per-round cache of the K x P client updates and of what the aggregators derive from them: the Gram matrix of
+    every parameter block, the norms and the cosine matrix. Everything is computed on first use, so CAGrad, MGDA,
+    PCGrad and Nash share the inner products, and the diagnostics come from the cached Gram matrices at no extra
+    pass over P.
+    """
+
+    def __init__(self, updates, sample_weights=None, blocks=None, chunk_size=CHUNK_SIZE):
+        self.updates = updates
+        self.sample_weights = sample_weights
+        self.blocks = blocks if blocks is not None else [(0, updates.shape[1])]
+        self.chunk_size = chunk_size
+        self._block_grams = None
+
+    @property
+    def block_grams(self):
+        if self._block_grams is None:
+            self._block_grams = [gram_matrix(self.updates[:, start:end], self.chunk_size) for start, end in self.blocks]
+        return self._block_grams
+
+    @property
+    def gram(self):
+        grams = self.block_grams
+        return grams[0] if len(grams) == 1 else torch.stack(grams).sum(0)
+
+    @property
+    def norms(self):
+        return self.gram.diagonal().clamp_min(0).sqrt()
+
+    @property
+    def cosine(self):
+        norms = self.norms.clamp_min(1e-12)
+        return self.gram / torch.outer(norms, norms)
+
+    def weights(self, solve, gram_scale=1.):
+        """
+        One weighting of the K updates per block: `solve(block_idx, gram)` maps the K x K Gram matrix of a block,
+        divided by `gram_scale`, to K weights.
+        """
+        return [solve(b, gram / gram_scale) for b, gram in enumerate(self.block_grams)]
+
+    def combine(self, weights, out=None):
+        return combine_blockwise(self.updates, self.blocks, weights, self.chunk_size, out)
+
+    def diagnostics(self):
+        """
+        Conflict statistics of the round, read from the cached Gram matrices only. Returns an empty dict when no
+        Gram matrix was needed in this round.
+        """
+        if self._block_grams is None:
+            return dict()
+        num_clients = self.updates.shape[0]
+        cosine = self.cosine
+        off_diag = cosine[~torch.eye(num_clients, dtype=torch.bool, device=cosine.device)]
+        if off_diag.numel() == 0:
+            off_diag = cosine.new_ones(1)
+        stats = [off_diag.mean(), off_diag.min(), (off_diag < 0).to(cosine.dtype).mean(), self.norms.mean()]
+        if self.sample_weights is not None:
+            # ||sum_k w_k update_k||^2 = w^T G w
+            w = torch.as_tensor(self.sample_weights).to(self.gram)
+            stats.append(w.dot(self.gram.mv(w)).clamp_min(0).sqrt())
+        return dict(zip(AGGREGATION_DIAGNOSTICS, torch.stack(stats).tolist()))  # one device sync
+
+
+def combine_blockwise(updates, blocks, weights, chunk_size=CHUNK_SIZE, out=None):
+    """Assemble the P-dim update from one weighting of the rows of `updates` per block."""
+    if out is None:
+        out = updates.new_empty(updates.shape[1])
+    for (beg, end), w in zip(blocks, weights):
+        combine_updates(updates[:, beg:end], w, chunk_size, out=out[beg:end])
+    return out
+
+
+def _pcgrad_reference(grads):
+    # the previous implementation of FedRANE.pcgrad, kept for benchmarking; grads: P x K
+    from copy import deepcopy
+    rng = np.random.default_rng()
+    num_clients = grads.shape[1]
+    grad_vec = grads.t()
+
+    shuffled_task_indices = np.zeros((num_clients, num_clients - 1), dtype=int)
+    for i in range(num_clients):
+        task_indices = np.arange(num_clients)
+        task_indices[i] = task_indices[-1]
+        shuffled_task_indices[i] = task_indices[:-1]
+        rng.shuffle(shuffled_task_indices[i])
+    shuffled_task_indices = shuffled_task_indices.T
+
+    normalized_grad_vec = grad_vec / (grad_vec.norm(dim=1, keepdim=True) + 1e-8)
+    modified_grad_vec = deepcopy(grad_vec)
+    for task_indices in shuffled_task_indices:
+        normalized_shuffled_grad = normalized_grad_vec[task_indices]
+        dot = (modified_grad_vec * normalized_shuffled_grad).sum(dim=1, keepdim=True)
+        modified_grad_vec -= torch.clamp_max(dot, 0) * normalized_shuffled_grad
+    return modified_grad_vec.mean(dim=0)
+
+
+def benchmark_pcgrad(num_clients=20, dim=11_173_962, repeats=3, device="cpu"):
+    """Compare the Gram-based PCGrad against the previous implementation; dim defaults to the size of ResNet-18."""
+    grads = torch.randn(dim, num_clients, device=device)  # FedRANE layout: P x K
+    for name, fn in [("reference", lambda: _pcgrad_reference(grads)),
+                     ("gram", lambda: pcgrad(grads.t()))]:
+        fn()
+        start = time.time()
+        for _ in range(repeats):
+            fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        print(f"pcgrad {name:>9} K={num_clients} P={dim}: {(time.time() - start) / repeats:.3f}s")
+
+    # the projection order is random, so check against a reference run with a single competitor per client
+    pair = grads[:, :2]
+    print("max abs diff (K=2):", (_pcgrad_reference(pair) - pcgrad(pair.t())).abs().max().item())
+
+
+if __name__ == '__main__':
+    benchmark_pcgrad()
@@ -162,6 +162,32 @@ class CategoriesSampler:
             yield batch
 
 
+class EpisodeSampler(CategoriesSampler):
+    """
+    n_episode episodes per batch, sampled at once: the indices of a batch are n_episode x n_per x n_cls flattened,
+    so the loaded images reshape to (n_episode, n_per, n_cls, ...) with the shots first as in CategoriesSampler.
+    """
+
+    def __init__(self, label, n_batch, n_cls, n_per, n_episode=16):
+        super(EpisodeSampler, self).__init__(label, n_batch, n_cls, n_per)
+        self.n_episode = n_episode
+        # class x sample table padded with -1, so the samples of every episode are drawn by one argsort
+        self.counts = torch.tensor([len(ind) for ind in self.m_ind])
+        self.table = torch.full((len(self.m_ind), int(self.counts.max())), -1, dtype=torch.long)
+        for i, ind in enumerate(self.m_ind):
+            self.table[i, :len(ind)] = ind
+
+    def __iter__(self):
+        num_classes, max_count = self.table.shape
+        for i_batch in range(self.n_batch):
+            classes = torch.rand(self.n_episode, num_classes).argsort(dim=1)[:, :self.n_cls]
+            keys = torch.rand(self.n_episode, self.n_cls, max_count)
+            keys.masked_fill_(self.table[classes] < 0, 2.)  # padding sorts after every sample
+            pos = keys.argsort(dim=2)[:, :, :self.n_per]
+            batch = self.table[classes].gather(2, pos)  # n_episode x n_cls x n_per
+            yield batch.transpose(1, 2).reshape(-1)
+
+
 if __name__ == '__main__':
     import pandas as pd
 
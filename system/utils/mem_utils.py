@@ -11,6 +11,23 @@ from calmsize import size as calmsize
 def readable_size(num_bytes: int) -> str:
     return '' if isnan(num_bytes) else '{:.2f}'.format(calmsize(num_bytes))
 
+
+def saved_bytes(fn):
+    """Bytes of the tensors saved for backward while running fn()."""
+    saved = []
+
+    def pack(tensor):
+        if tensor.is_sparse:  # numel is the dense size
+            saved.append(sum(t.numel() * t.element_size() for t in (tensor._indices(), tensor._values())))
+        else:
+            saved.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, sum(saved)
+
+
 LEN = 79
 
 # some pytorch low-level memory management constant
@@ -138,6 +138,58 @@ class MinNormSolver:
             sol_vec = new_sol_vec
             # iter_count += 1
 
+    def _min_norm_2d_from_gram(grad_mat):
+        """
+        Same as _min_norm_2d, but reads the inner products from the n x n Gram matrix grad_mat
+        """
+        dmin = 1e8
+        sol = None
+        n = grad_mat.shape[0]
+        for i in range(n):
+            for j in range(i + 1, n):
+                c, d = MinNormSolver._min_norm_element_from2(grad_mat[i, i], grad_mat[i, j], grad_mat[j, j])
+                if d < dmin:
+                    dmin = d
+                    sol = [(i, j), c, d]
+        return sol
+
+    def find_min_norm_element_from_gram(grad_mat, sample_weights=None):
+        """
+        Same as find_min_norm_element, but takes the Gram matrix grad_mat[i, j] = <vecs[i], vecs[j]> instead of
+        the vectors, so the inner products can be computed with a single matmul over flattened vectors.
+        """
+        grad_mat = np.asarray(grad_mat, dtype=np.float64)
+        n = grad_mat.shape[0]
+        if n == 1:
+            return np.ones(1), grad_mat[0, 0]
+
+        init_sol = MinNormSolver._min_norm_2d_from_gram(grad_mat)
+        sol_vec = np.zeros(n)
+        sol_vec[init_sol[0][0]] = init_sol[1]
+        sol_vec[init_sol[0][1]] = 1 - init_sol[1]
+        if sample_weights is not None:
+            sol_vec = np.array(sample_weights, dtype=np.float64)
+
+        if n < 3:
+            # This is optimal for n=2, so return the solution
+            return sol_vec, init_sol[2]
+
+        nd = init_sol[2]
+        for iter_count in range(MinNormSolver.MAX_ITER):
+            grad_dir = -1.0 * np.dot(grad_mat, sol_vec)
+            new_point = MinNormSolver._next_point(sol_vec, grad_dir, n)
+            # Re-compute the inner products for line search
+            v1v1 = np.dot(sol_vec, np.dot(grad_mat, sol_vec))
+            v1v2 = np.dot(sol_vec, np.dot(grad_mat, new_point))
+            v2v2 = np.dot(new_point, np.dot(grad_mat, new_point))
+            nc, nd = MinNormSolver._min_norm_element_from2(v1v1, v1v2, v2v2)
+            new_sol_vec = nc * sol_vec + (1 - nc) * new_point
+            change = new_sol_vec - sol_vec
+            if np.sum(np.abs(change)) < MinNormSolver.STOP_CRIT:
+                return sol_vec, nd
+            sol_vec = new_sol_vec
+        return sol_vec, nd
+
     def find_min_norm_element_FW(vecs, sample_weights=None):
         """
         Given a list of vectors (vecs), this method finds the minimum norm element in the convex hull
@@ -184,20 +236,40 @@ class MinNormSolver:
             sol_vec = new_sol_vec
 
 
-def gradient_normalizers(grads, losses, normalization_type):
-    gn = {}
+def gradient_normalizers(grads, losses, normalization_type, norms=None):
+    """
+    Normalizers of K task (client) gradients, computed in one batched call.
+
+    grads: K x P tensor with one flattened gradient per row, or the former dict task -> list of per-layer grads
+    losses: K losses (tensor or sequence) for 'loss' and 'loss+', or a dict task -> loss for the dict input
+    norms: optional precomputed l2 norms of the K gradients, to skip the reduction over P
+    Returns a K tensor on the device of the gradients, or a dict task -> normalizer for the dict input.
+    """
+    if isinstance(grads, dict):
+        tasks = list(grads)
+        if norms is None and normalization_type in ('l2', 'loss+'):
+            # one device sync for all the tasks and layers
+            norms = torch.stack([torch.stack([gr.pow(2).sum() for gr in grads[t]]).sum() for t in tasks]).sqrt().cpu()
+        if losses is not None:
+            losses = [losses[t] for t in tasks]
+        gn = gradient_normalizers(torch.empty(len(tasks), 0), losses, normalization_type, norms=norms)
+        return {t: gn[i] for i, t in enumerate(tasks)}
+
+    if normalization_type in ('l2', 'loss+') and norms is None:
+        norms = grads.norm(dim=1)
+    if normalization_type in ('loss', 'loss+'):
+        if not torch.is_tensor(losses):
+            losses = torch.stack([torch.as_tensor(loss, dtype=torch.float) for loss in losses])
+        losses = losses.to(grads.device, grads.dtype)
+
     if normalization_type == 'l2':
-        for t in grads:
-            gn[t] = np.sqrt(sum([gr.pow(2).sum().data.cpu() for gr in grads[t]]))
+        gn = torch.as_tensor(norms).to(grads.device, grads.dtype)
     elif normalization_type == 'loss':
-        for t in grads:
-            gn[t] = losses[t]
+        gn = losses
     elif normalization_type == 'loss+':
-        for t in grads:
-            gn[t] = losses[t] * np.sqrt(sum([gr.pow(2).sum().data.cpu() for gr in grads[t]]))
+        gn = losses * torch.as_tensor(norms).to(grads.device, grads.dtype)
     elif normalization_type == 'none':
-        for t in grads:
-            gn[t] = 1.0
+        gn = grads.new_ones(grads.shape[0])
     else:
-        print('ERROR: Invalid Normalization Type')
+        raise ValueError(f"invalid gradient normalization type {normalization_type!r}")
     return gn
@@ -10,14 +10,13 @@
 #
 import math
 import os
-import sys
+import time
 import numpy as np
-import random
 import argparse
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-from torch import nn
+from torch.nn import Parameter
 
 
 #
@@ -35,6 +34,11 @@ def parse_args():
     parser.add_argument('-w', dest="wtvfile", default="", type=str)
     parser.add_argument('-n', dest="nn", default=2, type=int)
     parser.add_argument('-mani', dest="manifold", default="hyperbolic", type=str) # hyperspherical hyperbolic
+    parser.add_argument('-b', dest="block_size", default=1024, type=int)  # rows of the similarity matrix per block
+    parser.add_argument('-dev', dest="device", default="cpu", type=str)
+    parser.add_argument('-log', dest="log_every", default=500, type=int)
+    parser.add_argument('-o', dest="output", default="", type=str)  # also save to this path, e.g. the -hb_p_dir file
+    parser.add_argument('-f', dest="force", action="store_true")  # regenerate even if cached
     args = parser.parse_args()
     return args
 
@@ -42,14 +46,23 @@ def parse_args():
 #
 # Compute the loss related to the hyper-spherical prototypes
 #
-def prototype_loss(prototypes):
-    # Dot product of normalized prototypes is cos sim
-    product = torch.matmul(prototypes, prototypes.T) + 1
-    # remove diagonal from loss
-    product -= 2. * torch.diag(torch.diag(product))
+def prototype_loss(prototypes, block_size=None):
+    # Dot product of normalized prototypes is cos sim. Only the most similar other prototype of every row enters the
+    # loss, so it is searched block_size rows at a time outside autograd and the loss is rebuilt from the C pairs,
+    # with the same value and gradient as the max over the full C x C matrix.
+    num_classes = prototypes.shape[0]
+    block_size = block_size or num_classes
+    nearest = torch.empty(num_classes, dtype=torch.long, device=prototypes.device)
+    with torch.no_grad():
+        for beg in range(0, num_classes, block_size):
+            end = min(beg + block_size, num_classes)
+            product = torch.matmul(prototypes[beg:end], prototypes.T)
+            # remove diagonal from loss
+            product.diagonal(offset=beg).fill_(-float("inf"))
+            nearest[beg:end] = product.max(dim=1)[1]
     # Minimize maximum consine similarity
-    loss = product.max(dim=1)[0]
-    return loss.mean(), product.max()  # hypersphere get the max val
+    max_sim = (prototypes * prototypes[nearest]).sum(dim=1) + 1
+    return max_sim.mean(), max_sim.max()  # hypersphere get the max val
 
 
 #
@@ -65,6 +78,23 @@ def prototype_unify(num_classes):
     return set_prototypes
 
 
+#
+# Triplets (i, nearest neighbour of i, i, other class) from the word embedding similarities
+#
+def build_triplets(wtv, nn=2):
+    wtv = F.normalize(torch.as_tensor(wtv).float(), p=2, dim=1)
+    wtvsim = torch.matmul(wtv, wtv.T)
+    sorder = torch.argsort(wtvsim, dim=1, descending=True)
+    nns, others = sorder[:, :nn], sorder[:, nn:-1]
+    num_classes, num_others = others.shape
+    anchors = torch.arange(num_classes).reshape(-1, 1, 1).expand(-1, nn, num_others)
+    triplets = torch.stack([anchors,
+                            nns.unsqueeze(2).expand(-1, -1, num_others),
+                            anchors,
+                            others.unsqueeze(1).expand(-1, nn, -1)], dim=-1)
+    return triplets.reshape(-1, 4)
+
+
 #
 # Compute the semantic relation loss
 #
@@ -79,78 +109,82 @@ def prototype_loss_sem(prototypes, triplets):
 #
 # Generating prototypes
 #
+def generate_prototypes(classes, dims, epochs=5000, learning_rate=0.1, momentum=0.9, seed=300, wtv=None, nn=2,
+                        block_size=1024, device="cpu", log_every=500):
+    """
+    Projected SGD on the unit sphere: one parameter and one optimizer for all epochs, so the momentum is kept, and
+    the prototypes are renormalized in place after every step. Returns a classes x dims float tensor on the cpu.
+    """
+    if dims == 2:
+        return F.normalize(prototype_unify(classes), p=2, dim=1).float()
+    elif dims < 2:
+        raise Exception("Dimension is incorrect")
+
+    generator = torch.Generator().manual_seed(seed)
+    prototypes = torch.randn(classes, dims, generator=generator)
+    prototypes = Parameter(F.normalize(prototypes, p=2, dim=1).to(device))
+    optimizer = optim.SGD([prototypes], lr=learning_rate, momentum=momentum)
+    triplets = build_triplets(wtv, nn).to(device) if wtv is not None else None
+
+    for i in range(epochs):
+        # compute loss
+        loss, sep = prototype_loss(prototypes, block_size)  # note 直接优化,没有语义信息作为privileged info
+        if triplets is not None:
+            loss = loss + prototype_loss_sem(prototypes, triplets)[0]
+
+        # update
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        # renormalze prototypes
+        with torch.no_grad():
+            prototypes.copy_(F.normalize(prototypes, p=2, dim=1))
+        if log_every and (i % log_every == 0 or i == epochs - 1):
+            print(f"{i}/{epochs}: loss {loss.item():.4f}, max sim {sep.item() - 1:.4f}")
+    return prototypes.detach().cpu()
+
+
+def prototype_path(resdir, dims, classes, seed=300, manifold="hyperbolic"):
+    return os.path.join(resdir, f"{manifold}-prototypes-{dims}-{classes}-{seed}.npy")
+
+
+def get_prototypes(classes, dims, seed=300, manifold="hyperbolic", resdir="../prototypes", force=False, **kwargs):
+    """Prototypes cached under resdir by (dims, classes, seed, manifold), generated on a miss."""
+    path = prototype_path(resdir, dims, classes, seed, manifold)
+    if os.path.exists(path) and not force:
+        return np.load(path)
+    prototypes = generate_prototypes(classes, dims, seed=seed, **kwargs).numpy()
+    os.makedirs(resdir, exist_ok=True)
+    np.save(path, prototypes)
+    return prototypes
+
+
+def load_prototypes(path, dims, classes, seed=300, manifold="hyperbolic", **kwargs):
+    """np.load of a prototype file, generating it through the cache next to it if it does not exist yet."""
+    if os.path.exists(path):
+        return np.load(path)
+    print(f"{path} not found, generating {classes} prototypes in {dims} dims")
+    prototypes = get_prototypes(classes, dims, seed, manifold, resdir=os.path.dirname(path) or ".", **kwargs)
+    np.save(path, prototypes)
+    return prototypes
+
+
 if __name__ == '__main__':
     args = parse_args()
-    # os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-    device = torch.device("cuda")
-    kwargs = {'num_workers': 64, 'pin_memory': True}
-
-    # Set seed.
-    seed = args.seed
-    torch.manual_seed(seed)
-    np.random.seed(seed)
-    random.seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
 
     # init prototypes and optimizer
     if os.path.exists(args.wtvfile):  # note use pretrained word embeddings as semantic information
-        user_wtv = True
-        wtvv = np.load(args.wtvfile)
-        for i in range(wtvv.shape[0]):
-            wtvv[i] /= np.linalg.norm(wtvv[i])
-        wtvv = torch.from_numpy(wtvv.vectors)  # careful unk data for converting
-        wtvsim = torch.matmul(wtvv, wtvv.T).float()
-
-        # precompute triplets
-        nns, others = [], []
-        for i in range(wtvv.shape[0]):
-            sorder = np.argsort(wtvsim[i, :])[::-1]
-            nns.append(sorder[:args.nn])
-            others.append(sorder[args.nn:-1])
-
-        triplets = []
-        for i in range(wtvv.shape[0]):
-            for j in range(len(nns[i])):
-                for k in range(len(others[i])):
-                    triplets.append([i, j, i, k])
-        triplets = np.array(triplets).astype(int)
+        wtv = np.load(args.wtvfile)
     else:
-        use_wtv = False
-        triplets = None
-
-    # Init prototypes
-    prototypes = torch.randn(args.classes, args.dims)
-    prototypes = nn.Parameter(F.normalize(prototypes, p=2, dim=1))
-    optimizer = optim.SGD([prototypes], lr=args.learning_rate, momentum=args.momentum)
-
-    # optimize for separation
-    if args.dims > 2:
-        for i in range(args.epochs):
-            # compute loss
-            loss1, sep = prototype_loss(prototypes)  # note 直接优化,没有语义信息作为privileged info
-            print(loss1, sep)
-
-            if use_wtv:
-                loss2 = prototype_loss_sem(prototypes, triplets)
-                loss = loss1 + loss2
-            else:
-                loss = loss1
-
-            # update
-            loss.backward()
-            optimizer.step()
-            # renormalze prototypes
-            prototypes = nn.Parameter(F.normalize(prototypes, p=2, dim=1))
-            optimizer = optim.SGD([prototypes], lr=args.learning_rate, momentum=args.momentum)
-            print(f"{i}/{args.epochs}: {sep}")
-    elif args.dims == 2:
-        prototypes = prototype_unify(args.classes)
-        prototypes = nn.Parameter(F.normalize(prototypes, p=2, dim=1))
-    else:
-        raise Exception("Dimension is incorrect")
-
-    if not os.path.exists(args.resdir):
-        os.makedirs(args.resdir)
+        wtv = None
+
+    start = time.time()
+    prototypes = get_prototypes(args.classes, args.dims, args.seed, args.manifold, args.resdir, args.force,
+                                epochs=args.epochs, learning_rate=args.learning_rate, momentum=args.momentum,
+                                wtv=wtv, nn=args.nn, block_size=args.block_size, device=args.device,
+                                log_every=args.log_every)
+    print(f"{args.classes} prototypes in {args.dims} dims: {time.time() - start:.2f}s, "
+          f"max cosine similarity {(prototypes @ prototypes.T - 2 * np.eye(args.classes)).max():.4f}")
     # save
-    np.save(os.path.join(args.resdir, f"{args.manifold}-prototypes-{args.dims}-{args.classes}.npy"), prototypes.data.numpy())
+    if args.output:
+        np.save(args.output, prototypes)